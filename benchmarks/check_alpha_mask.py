@@ -0,0 +1,149 @@
+import importlib
+import math
+import sys
+
+from .run import load_plugin
+
+# alpha_maskで作るmaskが、以前のlevelsフィルタマスクによる実装 (DiffusionEngine.create_mask_pixels_with_levels_filter)
+# と同じになることを確かめる
+#   uv run python -m benchmarks.check_alpha_mask                 # 変換表だけを、levelsフィルタの式と比べる
+#   PYTHONPATH=. kritarunner -s benchmarks.check_alpha_mask      # Kritaで実際にフィルタをかけた結果とも比べる
+# 変換表の比べ方はKritaのフィルタを式に写したものなので、Krita上の結果と同じになることはkritarunnerでしか確かめられない
+
+# levelsフィルタ (channel_4 = "0;1;10;0;1") の設定
+LEVELS_GAMMA = 10.0
+LEVELS_FILTER_COUNT = 2
+
+# Kritaで比べるドキュメントの大きさ
+# layerのalphaは列ごとに0から255まで、base layerのalphaは行ごとに0から255まで変える
+CHECK_WIDTH = 256
+CHECK_HEIGHT = 65
+BASE_ALPHA_STEP = 4
+# 色によってmaskが変わらないことを、base layerとlayerの色 (B, G, R) の組み合わせごとに確かめる
+BASE_COLORS = {
+    "white": (255, 255, 255),
+    "black": (0, 0, 0),
+    "lineart gray": (64, 64, 64),
+    "red": (0, 0, 255),
+    "skin": (180, 200, 240),
+}
+LAYER_COLORS = {
+    "black": (0, 0, 0),
+    "white": (255, 255, 255),
+    "green": (0, 255, 0),
+    "shadow blue": (160, 96, 80),
+}
+# Kritaの実装ではA/U8への変換を挟むので、1段階の丸めの差までは同じとみなす
+MAX_FILTER_DIFFERENCE = 1
+
+
+# Kritaのlevelsフィルタと同じく、16bitの変換表を引いてから8bitに戻す
+def levels_filter_u8(value: int, gamma: float) -> int:
+    transferred = round(0xFFFF * math.pow(value / 255, 1 / gamma))
+    return (transferred - (transferred >> 8) + 128) >> 8
+
+
+class Checks:
+    def __init__(self):
+        self.failures = []
+
+    def expect(self, condition: bool, message: str):
+        print(f"{'ok' if condition else 'FAILED'}: {message}", flush=True)
+        if not condition:
+            self.failures.append(message)
+
+    def check_tables(self):
+        alpha_mask = importlib.import_module("diffusion_drawing.alpha_mask")
+
+        expected_lut = []
+        for value in range(256):
+            for _ in range(LEVELS_FILTER_COUNT):
+                value = levels_filter_u8(value, LEVELS_GAMMA)
+            expected_lut.append(value)
+        self.expect(list(alpha_mask.BINARIZE_LUT) == expected_lut, "BINARIZE_LUT matches two levels filters")
+
+        # normalで重ねたときのalphaは a + b - a * b / 255
+        layer_alpha = bytes(range(256))
+        union_matches = all(
+            list(alpha_mask.union_alpha(bytes([base] * 256), layer_alpha))
+            == [base + layer - round(base * layer / 255) for layer in range(256)]
+            for base in range(256))
+        self.expect(union_matches, "union_alpha matches normal blending of the alpha channels")
+
+        mask = alpha_mask.build_mask(bytes([0] * 256), layer_alpha)
+        self.expect(list(mask) == expected_lut, "build_mask over a transparent base is the binarized alpha")
+
+    def check_krita_filter(self):
+        for base_name, base_color in BASE_COLORS.items():
+            for layer_name, layer_color in LAYER_COLORS.items():
+                self.check_krita_filter_colors(base_color, layer_color, f"{layer_name} over {base_name}")
+
+    def check_krita_filter_colors(self, base_color: tuple[int, int, int], layer_color: tuple[int, int, int],
+                                  name: str):
+        import krita
+        from PyQt5.QtCore import QByteArray
+
+        alpha_mask = importlib.import_module("diffusion_drawing.alpha_mask")
+        engine = importlib.import_module("diffusion_drawing.engine")
+        width, height = CHECK_WIDTH, CHECK_HEIGHT
+
+        document = krita.Krita.instance().createDocument(width, height, "alpha mask check", "RGBA", "U8", "", 300.0)
+        base_layer = document.createNode("base", "paintLayer")
+        base_layer.setPixelData(
+            QByteArray(bytes(channel for y in range(height) for _ in range(width)
+                             for channel in (*base_color, min(y * BASE_ALPHA_STEP, 255)))), 0, 0, width, height)
+        layer = document.createNode("layer", "paintLayer")
+        layer.setPixelData(
+            QByteArray(bytes(channel for _ in range(height) for x in range(width) for channel in (*layer_color, x))),
+            0, 0, width, height)
+        document.rootNode().addChildNode(base_layer, None)
+        document.rootNode().addChildNode(layer, None)
+        document.refreshProjection()
+        document.waitForDone()
+
+        try:
+            base_pixels = base_layer.projectionPixelData(0, 0, width, height)
+            expected = bytes(engine.DiffusionEngine.create_mask_pixels_with_levels_filter(
+                document, layer, base_pixels, width, height))
+
+            pixel_format = alpha_mask.PixelFormat.of(document.colorModel(), document.colorDepth())
+            base_alpha = alpha_mask.read_alpha(base_layer, pixel_format, width, height)
+            built = alpha_mask.build_mask(base_alpha, alpha_mask.read_alpha(layer, pixel_format, width, height))
+            self.expect_same_mask(built, expected, f"build_mask ({name})")
+
+            transparency_mask = document.createTransparencyMask("mask")
+            alpha_mask.fill_transparency_mask(transparency_mask, layer, base_alpha, pixel_format, width, height)
+            layer.addChildNode(transparency_mask, None)
+            filled = bytes(transparency_mask.pixelData(0, 0, width, height))
+            self.expect_same_mask(filled, expected, f"fill_transparency_mask ({name})")
+        finally:
+            document.close()
+
+    def expect_same_mask(self, mask: bytes, expected: bytes, name: str):
+        if len(mask) != len(expected):
+            self.expect(False, f"{name} returns {len(mask)} bytes, the levels filter {len(expected)}")
+            return
+        differences = [abs(a - b) for a, b in zip(mask, expected)]
+        self.expect(max(differences) <= MAX_FILTER_DIFFERENCE,
+                    f"{name} matches the levels filter (max difference {max(differences)}, "
+                    f"{sum(1 for d in differences if d)} pixel(s) differ)")
+
+
+def main() -> int:
+    load_plugin()
+    checks = Checks()
+    checks.check_tables()
+    return 1 if checks.failures else 0
+
+
+# kritarunnerから呼ばれる
+def __main__(args: list[str]):
+    load_plugin()
+    checks = Checks()
+    checks.check_tables()
+    checks.check_krita_filter()
+    return 1 if checks.failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import asyncio
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+from PyQt5.QtWidgets import QApplication
+
+from .fake_comfyui import FakeComfyUIController, FakeComfyUIServer
+from .run import load_plugin
+
+# 2台のFakeComfyUIServerに対してBackendPoolの振り分けとキャンセルを確かめる
+# 1台だけで使うとき (BufferedDiffusionControllerがHTTP APIで止める) のキャンセルも確かめる
+#   uv run python -m benchmarks.check_backend_pool
+# サーバーは他の人と共有している前提なので、キャンセルで他の人のpromptを止めていないことも確かめる
+
+LATENCY = 0.3
+
+
+def write_inputs(work_dir: str) -> tuple[str, str, str]:
+    image = QImage(64, 64, QImage.Format_ARGB32)
+    image.fill(Qt.white)
+    scribble_path = os.path.join(work_dir, "scribble.png")
+    image.save(scribble_path, "PNG")
+    image.fill(Qt.transparent)
+    lineart_path = os.path.join(work_dir, "lineart.png")
+    image.save(lineart_path, "PNG")
+    return scribble_path, lineart_path, os.path.join(work_dir, "output.png")
+
+
+def expect(failures: list[str], condition: bool, message: str):
+    print(f"{'ok' if condition else 'FAILED'}: {message}", flush=True)
+    if not condition:
+        failures.append(message)
+
+
+async def wait_until(condition, timeout: float = 5.0):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("timed out")
+        await asyncio.sleep(0.01)
+
+
+async def check_pool(work_dir: str) -> list[str]:
+    backend_pool = importlib.import_module("diffusion_drawing.backend_pool")
+    servers = [FakeComfyUIServer(LATENCY), FakeComfyUIServer(LATENCY)]
+    for server in servers:
+        await server.start()
+    servers_by_address = {server.address: server for server in servers}
+    pool = backend_pool.BackendPool(list(servers_by_address),
+                                    lambda address: FakeComfyUIController(address, servers_by_address[address]))
+    paths = write_inputs(work_dir)
+    failures = []
+
+    async def health_check():
+        for backend in pool.backends:
+            await pool.health_check(backend)
+
+    try:
+        # 他の人のpromptが積まれているサーバーは避ける
+        busy, idle = servers
+        busy.queue_prompt()
+        busy.queue_prompt()
+        await health_check()
+        await pool.scribble_to_line(*paths)
+        expect(failures, len(idle.history) == 1, "the request goes to the idle backend")
+        await wait_until(lambda: not busy.pending and busy.running is None)
+
+        # キューで待っている間にキャンセルしたら、自分のpromptをキューから消すだけで、実行中の他の人のpromptは止めない
+        others = busy.queue_prompt()
+        idle.queue_prompt()
+        idle.queue_prompt()
+        await health_check()
+        await wait_until(lambda: busy.running == others)
+        task = asyncio.ensure_future(pool.scribble_to_line(*paths))
+        await wait_until(lambda: len(busy.pending) == 1)
+        ours = busy.pending[0]
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        expect(failures, busy.deleted == [ours], "a pending prompt is deleted from the queue")
+        expect(failures, busy.interrupted == [], "a running prompt of another client is not interrupted")
+        await wait_until(lambda: others in busy.history)
+        expect(failures, busy.history[others] == "success", "the other client's prompt finishes")
+        await wait_until(lambda: not idle.pending and idle.running is None)
+
+        # 自分のpromptが実行中ならinterruptする
+        await health_check()
+        task = asyncio.ensure_future(pool.scribble_to_line(*paths))
+        await wait_until(lambda: any(server.running is not None for server in servers))
+        server = next(server for server in servers if server.running is not None)
+        ours = server.running
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await wait_until(lambda: ours in server.history)
+        expect(failures, server.interrupted == [ours] and server.history[ours] == "interrupted",
+               "our running prompt is interrupted")
+
+        # 落ちたサーバーは外して、残りのサーバーで続ける
+        await busy.stop()
+        await health_check()
+        expect(failures, not pool.backends[0].healthy and pool.backends[1].healthy,
+               "a stopped backend is marked down")
+        finished = len(idle.history)
+        await pool.scribble_to_line(*paths)
+        expect(failures, len(idle.history) == finished + 1, "requests fail over to the remaining backend")
+    finally:
+        pool.close()
+        for server in servers:
+            if server.server.is_serving():
+                await server.stop()
+    return failures
+
+
+# promptのidを受け取らないcontroller (どれが自分のpromptか分からない)
+class AnonymousComfyUIController(FakeComfyUIController):
+    async def scribble_to_line(self, scribble_path: str, lineart_path: str, output_path: str):
+        await super().scribble_to_line(scribble_path, lineart_path, output_path)
+
+
+async def check_single_backend(work_dir: str) -> list[str]:
+    buffered_controller = importlib.import_module("diffusion_drawing.buffered_controller")
+    http_client = importlib.import_module("diffusion_drawing.http_client")
+    backend_pool = importlib.import_module("diffusion_drawing.backend_pool")
+    server = FakeComfyUIServer(LATENCY)
+    await server.start()
+    scribble_path, lineart_path, _ = write_inputs(work_dir)
+    with open(scribble_path, "rb") as f:
+        scribble = f.read()
+    with open(lineart_path, "rb") as f:
+        lineart = f.read()
+    failures = []
+
+    # エンジンと同じく、controllerが繋いでいるサーバーのHTTP APIでキャンセルする
+    def buffered(controller):
+        host, port = backend_pool.parse_address(backend_pool.single_backend_address(controller))
+        return buffered_controller.BufferedDiffusionController(controller,
+                                                               backend=http_client.HttpConnectionPool(host, port))
+
+    # キャンセルしたときに実行中だったpromptを返す
+    async def cancel_when(controller, condition) -> str | None:
+        task = asyncio.ensure_future(controller.scribble_to_line(scribble, lineart))
+        await wait_until(condition)
+        running = server.running
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return running
+
+    try:
+        # キューで待っている自分のpromptだけを消し、実行中の他の人のpromptは止めない
+        controller = buffered(FakeComfyUIController(server.address, server))
+        others = server.queue_prompt()
+        await wait_until(lambda: server.running == others)
+        await cancel_when(controller, lambda: len(server.pending) == 1)
+        expect(failures, len(server.deleted) == 1 and server.interrupted == [],
+               "a single backend deletes our pending prompt and leaves the other client's running one")
+        await wait_until(lambda: others in server.history)
+        expect(failures, server.history[others] == "success", "the other client's prompt finishes")
+
+        # 自分のpromptが実行中ならinterruptする
+        ours = await cancel_when(controller, lambda: server.running is not None)
+        await wait_until(lambda: ours in server.history)
+        expect(failures, server.interrupted == [ours] and server.history[ours] == "interrupted",
+               "a single backend interrupts our running prompt")
+        controller.close()
+
+        # promptのidが分からないcontrollerでも、実行中のpromptは止める
+        controller = buffered(AnonymousComfyUIController(server.address, server))
+        ours = await cancel_when(controller, lambda: server.running is not None)
+        await wait_until(lambda: ours in server.history)
+        expect(failures, server.interrupted[-1:] == [ours] and server.history[ours] == "interrupted",
+               "a single backend interrupts the running prompt when the controller sends no prompt id")
+        controller.close()
+    finally:
+        await server.stop()
+    return failures
+
+
+def main() -> int:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    load_plugin()
+    work_dir = tempfile.mkdtemp(prefix="diffusion_drawing_pool_")
+    try:
+        loop = asyncio.get_event_loop()
+        failures = loop.run_until_complete(check_pool(work_dir))
+        failures += loop.run_until_complete(check_single_backend(work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
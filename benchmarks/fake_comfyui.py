@@ -0,0 +1,140 @@
+import asyncio
+import json
+import uuid
+
+from .fake_controller import FakeDiffusionController
+
+# BackendPoolを確かめるための、ComfyUIのHTTP APIのうちpoolが使う分だけを真似たサーバー
+#   GET /queue, POST /queue {"delete": [...]}, POST /interrupt
+# promptは1つずつ順に実行し、実行にはlatency秒かかる (/wsには応じないので、poolはヘルスチェックだけで動く)
+
+
+class FakeComfyUIServer:
+    def __init__(self, latency: float = 0.2):
+        self.latency = latency
+        self.pending: list[str] = []
+        self.running: str | None = None
+        self.history: dict[str, str] = {}
+        self.deleted: list[str] = []
+        self.interrupted: list[str] = []
+        self.writers: set[asyncio.StreamWriter] = set()
+        self.server: asyncio.AbstractServer | None = None
+        self.worker: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()
+        self.interrupt_running = asyncio.Event()
+
+    @property
+    def address(self) -> str:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"{host}:{port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.worker = asyncio.ensure_future(self.run_prompts())
+
+    # 落ちたサーバーの代わりなので、開いている接続も切る
+    async def stop(self):
+        self.worker.cancel()
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    # 他の人がこのサーバーに投げたpromptの代わり
+    def queue_prompt(self, prompt_id: str | None = None) -> str:
+        prompt_id = prompt_id or uuid.uuid4().hex
+        self.pending.append(prompt_id)
+        self.wakeup.set()
+        return prompt_id
+
+    async def run_prompts(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            self.running = self.pending.pop(0)
+            self.interrupt_running.clear()
+            try:
+                await asyncio.wait_for(self.interrupt_running.wait(), self.latency)
+                self.history[self.running] = "interrupted"
+            except asyncio.TimeoutError:
+                self.history[self.running] = "success"
+            self.running = None
+
+    def queue(self) -> dict:
+        return {"queue_running": [[0, self.running, {}, {}, []]] if self.running is not None else [],
+                "queue_pending": [[i + 1, prompt_id, {}, {}, []] for i, prompt_id in enumerate(self.pending)]}
+
+    def route(self, method: str, path: str, body: bytes) -> tuple[int, dict]:
+        if method == "GET" and path == "/queue":
+            return 200, self.queue()
+        if method == "POST" and path == "/queue":
+            for prompt_id in json.loads(body).get("delete", []):
+                if prompt_id in self.pending:
+                    self.pending.remove(prompt_id)
+                    self.deleted.append(prompt_id)
+            return 200, {}
+        if method == "POST" and path == "/interrupt":
+            # prompt_idを指定されたときは、それが実行中のときだけ止める
+            prompt_id = json.loads(body or b"{}").get("prompt_id")
+            if self.running is not None and prompt_id in (None, self.running):
+                self.interrupted.append(self.running)
+                self.interrupt_running.set()
+            return 200, {}
+        return 404, {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = self.route(method, path, body)
+                data = json.dumps(response).encode()
+                writer.write(f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+# FakeDiffusionControllerと同じ画像を返すが、その前にサーバーにpromptを積んで実行が終わるのを待つ
+# 本物のcontrollerと同じく、キャンセルされてもサーバーに積んだpromptはそのまま残る
+class FakeComfyUIController(FakeDiffusionController):
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, address: str, server: FakeComfyUIServer):
+        super().__init__(address)
+        self.server = server
+
+    async def run_prompt(self, prompt_id: str | None):
+        if not self.server.server.is_serving():
+            raise ConnectionRefusedError(f"{self.address} is not running")
+        prompt_id = self.server.queue_prompt(prompt_id)
+        while prompt_id not in self.server.history:
+            await asyncio.sleep(self.POLL_INTERVAL)
+        if self.server.history[prompt_id] != "success":
+            raise RuntimeError(f"prompt {prompt_id} was interrupted")
+
+    async def scribble_to_line(self, scribble_path: str, lineart_path: str, output_path: str,
+                               prompt_id: str | None = None):
+        await self.run_prompt(prompt_id)
+        await super().scribble_to_line(scribble_path, lineart_path, output_path)
+
+    async def detail_colored(self, image_path: str, basecolor_image_path: str, lineart_path: str,
+                             basecolor_path: str, shadow_path: str, light_path: str, shadow_output_path: str,
+                             light_output_path: str, prompt_id: str | None = None):
+        await self.run_prompt(prompt_id)
+        await super().detail_colored(image_path, basecolor_image_path, lineart_path, basecolor_path, shadow_path,
+                                     light_path, shadow_output_path, light_output_path)
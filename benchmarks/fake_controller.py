@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, QPainter
+
+
+# ComfyUIを使わずに、DiffusionControllerと同じファイルパスのAPIで入力と同じサイズの画像を返す
+# latencyを指定すると、推論にかかる時間の代わりにその秒数だけ待つ
+# input_formatsを指定すると、その入力形式 (diffusion_drawing.wire_format) を受け取れると申告する
+class FakeDiffusionController:
+    def __init__(self, address: str | None = None, latency: float = 0.0, input_formats: list[str] = ()):
+        self.address = address
+        self.latency = latency
+        self.input_formats = frozenset(input_formats)
+        self.calls = 0
+        self.bytes_received = 0
+
+    def read_image(self, path: str) -> QImage:
+        self.bytes_received += os.path.getsize(path)
+        return QImage(path)
+
+    # 1チャンネルで送られたmaskはalphaに戻し、切り出されたものは元の位置に置きなおす
+    def read_mask(self, path: str, placement: tuple[int, int, int, int] | None) -> QImage:
+        image = self.read_image(path)
+        if not image.hasAlphaChannel():
+            image = image.convertToFormat(QImage.Format_Grayscale8)
+            image.reinterpretAsFormat(QImage.Format_Alpha8)
+        image = image.convertToFormat(QImage.Format_ARGB32)
+        if placement is None:
+            return image
+        x, y, width, height = placement
+        mask = QImage(width, height, QImage.Format_ARGB32)
+        mask.fill(Qt.transparent)
+        painter = QPainter(mask)
+        painter.drawImage(x, y, image)
+        painter.end()
+        return mask
+
+    async def scribble_to_line(self, scribble_path: str, lineart_path: str, output_path: str,
+                               placements: list[tuple[int, int, int, int] | None] | None = None):
+        placements = placements or [None] * 2
+        self.calls += 1
+        scribble = self.read_image(scribble_path)
+        lineart = self.read_mask(lineart_path, placements[1])
+        await asyncio.sleep(self.latency)
+
+        output = scribble.convertToFormat(QImage.Format_Grayscale8).convertToFormat(QImage.Format_ARGB32)
+        painter = QPainter(output)
+        painter.drawImage(0, 0, lineart)
+        painter.end()
+        output.save(output_path, "PNG")
+
+    async def detail_colored(self, image_path: str, basecolor_image_path: str, lineart_path: str,
+                             basecolor_path: str, shadow_path: str, light_path: str, shadow_output_path: str,
+                             light_output_path: str, placements: list[tuple[int, int, int, int] | None] | None = None):
+        placements = placements or [None] * 6
+        self.calls += 1
+        image = self.read_image(image_path)
+        basecolor_image = self.read_image(basecolor_image_path)
+        for path, placement in zip((lineart_path, basecolor_path, shadow_path, light_path), placements[2:]):
+            self.read_mask(path, placement)
+        await asyncio.sleep(self.latency)
+
+        shadow = basecolor_image.convertToFormat(QImage.Format_ARGB32)
+        painter = QPainter(shadow)
+        painter.setCompositionMode(QPainter.CompositionMode_Multiply)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        shadow.save(shadow_output_path, "PNG")
+
+        light = image.convertToFormat(QImage.Format_ARGB32)
+        light.invertPixels()
+        light.save(light_output_path, "PNG")
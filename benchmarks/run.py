@@ -0,0 +1,342 @@
+import argparse
+import gc
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from itertools import product
+from typing import Callable
+
+from PyQt5.QtCore import PYQT_VERSION_STR, QT_VERSION_STR, QStandardPaths
+from PyQt5.QtWidgets import QApplication
+
+from .fake_controller import FakeDiffusionController
+from .synthetic_document import LABEL_MIXES, DocumentSpec, SyntheticDocument, build_document
+
+# krita-python-mockとPyQt5があれば、Kritaを起動せずにdockerのキャンバス操作を計測する
+#   uv run python -m benchmarks.run --save
+#   uv run python -m benchmarks.run --compare benchmarks/baselines/baseline.json
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_DIR = os.path.join(REPOSITORY_DIR, "diffusion_drawing")
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "baseline.json")
+
+QUICK_GRID = {"sizes": [512, 1024], "layers": [4, 16], "depths": [0, 2], "label_mixes": ["uniform"]}
+FULL_GRID = {"sizes": [512, 1024, 2048, 4096], "layers": [4, 16, 64], "depths": [0, 2, 4],
+             "label_mixes": list(LABEL_MIXES)}
+
+DEFAULT_REPEATS = 3
+# baselineよりこの割合を超えて悪くなったものを回帰とみなす
+DEFAULT_TOLERANCE = 0.2
+# これより小さい時間の差は誤差として扱う
+MIN_TIME_DIFFERENCE = 0.005
+
+METRICS = ("wall_time", "peak_memory", "bytes_written")
+# diffusion_drawing.wire_format の形式 (プラグインはBenchを作るまで読み込めないので、ここに並べておく)
+INPUT_FORMATS = ("gray8", "alpha8", "alpha1", "crop")
+
+
+# パッケージの__init__はKrita本体にdockerを登録しようとするので、モジュールだけを読み込む
+def load_plugin():
+    spec = importlib.machinery.ModuleSpec("diffusion_drawing", None, is_package=True)
+    package = importlib.util.module_from_spec(spec)
+    package.__path__ = [PLUGIN_DIR]
+    sys.modules["diffusion_drawing"] = package
+    return importlib.import_module("diffusion_drawing.diffusion_drawing")
+
+
+# Linuxでは/proc/self/clear_refsでピークRSSをリセットできるので、Qtの画像も含めたメモリ使用量を測る
+# それ以外の環境ではtracemallocでPythonが確保した分だけを測る
+class MemoryProbe:
+    def __init__(self):
+        self.method = "rss" if self.reset_peak_rss() else "tracemalloc"
+        self.baseline = 0
+
+    @staticmethod
+    def read_status(field: str) -> int | None:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def reset_peak_rss(self) -> bool:
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            return False
+        return self.read_status("VmHWM") is not None
+
+    def start(self):
+        if self.method == "rss":
+            self.reset_peak_rss()
+            self.baseline = self.read_status("VmRSS")
+        else:
+            tracemalloc.start()
+
+    def stop(self) -> int:
+        if self.method == "rss":
+            return max(self.read_status("VmHWM") - self.baseline, 0)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+
+# write系のシステムコールに渡したバイト数 (tmpfsへの書き込みも含む)
+def written_bytes() -> int | None:
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+@dataclass
+class Measurement:
+    wall_time: float
+    wall_time_min: float
+    peak_memory: int
+    bytes_written: int | None
+
+
+class Bench:
+    def __init__(self, backend_latency: float, work_dir: str, input_formats: list[str] = ()):
+        self.module = load_plugin()
+        self.engine_module = importlib.import_module("diffusion_drawing.engine")
+        self.work_dir = work_dir
+        self.controller = FakeDiffusionController(latency=backend_latency, input_formats=input_formats)
+        # ComfyUIの代わりにfake controllerを使う
+        backend_pool = importlib.import_module("diffusion_drawing.backend_pool")
+        os.environ.pop(backend_pool.BACKENDS_ENVIRONMENT_VARIABLE, None)
+        self.engine_module.DiffusionController = lambda *args: self.controller
+        self.docker = self.module.DiffusionDrawingDocker()
+        self.engine = self.docker.engine
+        self.memory = MemoryProbe()
+
+    def prepare_document(self, spec: DocumentSpec) -> SyntheticDocument:
+        document = build_document(spec)
+        self.docker.active_document = document
+        self.docker.initialize_document()
+        return document
+
+    # 生成結果のキャッシュと前回の入力が残っていると計測にならないので、毎回空にする
+    def reset_generation_state(self):
+        self.engine.dirty_regions.snapshots.clear()
+        self.engine.result_cache = self.engine_module.ResultCache(tempfile.mkdtemp(dir=self.work_dir))
+        self.engine.cached_controller.cache = self.engine.result_cache
+
+    def measure(self, base: SyntheticDocument, operation: Callable[[SyntheticDocument], None],
+                repeats: int) -> Measurement:
+        times = []
+        peaks = []
+        written = []
+        # 1回目はQtのプラグイン読み込みなどが入るので、捨てる
+        for iteration in range(repeats + 1):
+            document = base.clone()
+            self.docker.active_document = document
+            self.reset_generation_state()
+            gc.collect()
+
+            self.memory.start()
+            before = written_bytes()
+            start = time.perf_counter()
+            operation(document)
+            elapsed = time.perf_counter() - start
+            after = written_bytes()
+            peak = self.memory.stop()
+            document.close()
+            if iteration == 0:
+                continue
+
+            times.append(elapsed)
+            peaks.append(peak)
+            if before is not None and after is not None:
+                written.append(after - before)
+        return Measurement(statistics.median(times), min(times), max(peaks),
+                           round(statistics.median(written)) if written else None)
+
+    def operations(self) -> dict[str, Callable[[SyntheticDocument], None]]:
+        module = self.engine_module
+        label_export = importlib.import_module("diffusion_drawing.label_export")
+        engine = self.engine
+        docker = self.docker
+
+        def export_image_filtered_color_label(document: SyntheticDocument):
+            label_export.export_images_filtered_color_label(document, [
+                (label_export.LabelExport.of([module.SCRIBBLE_COLOR_LABEL], False),
+                 os.path.join(self.work_dir, "export.png"))])
+
+        # dockerがlayerを隠すのは、書き出し用のcloneの上でだけ
+        def show_labels(document: SyntheticDocument):
+            exporter = label_export.LabelCompositeExporter(document)
+            try:
+                exporter.show_labels(frozenset([module.LINEART_COLOR_LABEL]))
+            finally:
+                exporter.close()
+
+        def apply_layer_mask_filtered_color_label(document: SyntheticDocument):
+            engine.apply_layer_mask_filtered_color_label(document, [module.LINEART_COLOR_LABEL])
+
+        def create_transparency_mask_from_layer_filtered_color_label(document: SyntheticDocument):
+            system_layers = engine.system_layers(document)
+            engine.create_transparency_mask_from_layer_filtered_color_label(
+                document, [module.LINEART_COLOR_LABEL], document.nodeByUniqueID(system_layers.lineart))
+
+        def transfer_all(document: SyntheticDocument):
+            docker.transfer_all()
+
+        def gen_lineart_inner(document: SyntheticDocument):
+            docker.event_loop.run_until_complete(docker.gen_lineart_inner(document))
+
+        def gen_detail_inner(document: SyntheticDocument):
+            docker.event_loop.run_until_complete(docker.gen_detail_inner(document))
+
+        return {operation.__name__: operation for operation in (
+            export_image_filtered_color_label,
+            show_labels,
+            apply_layer_mask_filtered_color_label,
+            create_transparency_mask_from_layer_filtered_color_label,
+            transfer_all,
+            gen_lineart_inner,
+            gen_detail_inner,
+        )}
+
+    def close(self):
+        for system_layers in self.engine.document_nodes_map.values():
+            shutil.rmtree(system_layers.result_dir, ignore_errors=True)
+        self.engine.document_nodes_map.clear()
+
+
+def document_specs(grid: dict) -> list[DocumentSpec]:
+    return [DocumentSpec(size, size, layers, depth, label_mix)
+            for size, layers, depth, label_mix in
+            product(grid["sizes"], grid["layers"], grid["depths"], grid["label_mixes"])]
+
+
+def format_bytes(value: int | None) -> str:
+    return "-" if value is None else f"{value / 2 ** 20:.1f} MiB"
+
+
+def compare(results: dict[str, dict], baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        for metric in METRICS:
+            old = previous.get(metric)
+            new = result.get(metric)
+            if old is None or new is None or new <= old * (1 + tolerance):
+                continue
+            if metric == "wall_time" and new - old < MIN_TIME_DIFFERENCE:
+                continue
+            regressions.append(f"{name} {metric}: {old} -> {new} ({new / old - 1:+.0%})" if old else
+                               f"{name} {metric}: {old} -> {new}")
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the DiffusionDrawing docker on synthetic documents")
+    parser.add_argument("--full", action="store_true", help="run the full grid instead of the quick one")
+    parser.add_argument("--sizes", type=int, nargs="+", help="canvas sizes (square)")
+    parser.add_argument("--layers", type=int, nargs="+", help="layer counts")
+    parser.add_argument("--depths", type=int, nargs="+", help="group nesting depths")
+    parser.add_argument("--label-mixes", nargs="+", choices=LABEL_MIXES, help="color label distributions")
+    parser.add_argument("--operations", nargs="+", help="operations to run (default: all)")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--backend-latency", type=float, default=0.0,
+                        help="seconds the fake backend waits per call instead of running inference")
+    parser.add_argument("--input-formats", nargs="*", default=[], choices=INPUT_FORMATS,
+                        help="input formats the fake backend accepts (default: RGBA PNG only)")
+    parser.add_argument("--save", nargs="?", const=DEFAULT_BASELINE_PATH, help="write results as a baseline JSON")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    grid = dict(FULL_GRID if args.full else QUICK_GRID)
+    for key in grid:
+        if getattr(args, key):
+            grid[key] = getattr(args, key)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    # 計測中に作るresult cacheがユーザーのキャッシュディレクトリに入らないようにする
+    QStandardPaths.setTestModeEnabled(True)
+
+    work_dir = tempfile.mkdtemp(prefix="diffusion_drawing_bench_")
+    bench = Bench(args.backend_latency, work_dir, args.input_formats)
+    operations = bench.operations()
+    if args.operations:
+        unknown = set(args.operations) - operations.keys()
+        if unknown:
+            raise SystemExit(f"unknown operations: {', '.join(sorted(unknown))}")
+        operations = {name: operations[name] for name in args.operations}
+
+    results = {}
+    try:
+        for spec in document_specs(grid):
+            base = bench.prepare_document(spec)
+            for operation_name, operation in operations.items():
+                name = f"{operation_name}/{spec.name()}"
+                measurement = bench.measure(base, operation, args.repeats)
+                results[name] = asdict(measurement)
+                print(f"{name:<90} {measurement.wall_time * 1000:10.1f} ms  "
+                      f"peak {format_bytes(measurement.peak_memory):>11}  "
+                      f"written {format_bytes(measurement.bytes_written):>11}", flush=True)
+            base.close()
+    finally:
+        bench.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"backend received {format_bytes(bench.controller.bytes_received)} in {bench.controller.calls} call(s)")
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "qt": QT_VERSION_STR,
+            "pyqt": PYQT_VERSION_STR,
+            "memory_method": bench.memory.method,
+        },
+        "settings": {"grid": grid, "repeats": args.repeats, "backend_latency": args.backend_latency,
+                     "input_formats": args.input_formats, "backend_bytes_received": bench.controller.bytes_received},
+        "results": results,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"no regressions against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
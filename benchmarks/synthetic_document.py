@@ -0,0 +1,395 @@
+import random
+from dataclasses import dataclass
+
+from PyQt5.QtCore import QByteArray, QPoint, QRect, QSize, QUuid, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+# krita-python-mockのDocument/Nodeは中身が空なので、dockerが使う分だけのAPIをQImageで実装した合成ドキュメント
+# 画素はKritaのRGBA U8と同じく B, G, R, A の順 (QImage.Format_ARGB32) で持つ
+
+COMPOSITION_MODES = {
+    "normal": QPainter.CompositionMode_SourceOver,
+    "multiply": QPainter.CompositionMode_Multiply,
+    "add": QPainter.CompositionMode_Plus,
+}
+
+LABEL_MIXES = ("uniform", "unlabelled", "single")
+
+
+class SyntheticNode:
+    def __init__(self, document: "SyntheticDocument", name: str, node_type: str):
+        self.document = document
+        self.node_name = name
+        self.node_type = node_type
+        self.unique_id = QUuid.createUuid()
+        self.color_label = 0
+        self.is_visible = True
+        self.is_locked = False
+        self.inherit_alpha = False
+        self.opacity_value = 255
+        self.blending_mode = "normal"
+        self.parent: SyntheticNode | None = None
+        self.children: list[SyntheticNode] = []
+        # 描かれている範囲だけを持つ (transparency maskはキャンバス全体のalphaをAlpha8で持つ)
+        self.offset = QPoint(0, 0)
+        self.image = QImage()
+        self.path = ""
+
+    def name(self) -> str:
+        return self.node_name
+
+    def type(self) -> str:
+        return self.node_type
+
+    def uniqueId(self) -> QUuid:
+        return self.unique_id
+
+    def colorLabel(self) -> int:
+        return self.color_label
+
+    def setColorLabel(self, label: int):
+        self.color_label = label
+
+    def visible(self) -> bool:
+        return self.is_visible
+
+    def setVisible(self, visible: bool):
+        self.is_visible = visible
+
+    def locked(self) -> bool:
+        return self.is_locked
+
+    def setLocked(self, locked: bool):
+        self.is_locked = locked
+
+    def setInheritAlpha(self, inherit_alpha: bool):
+        self.inherit_alpha = inherit_alpha
+
+    def opacity(self) -> int:
+        return self.opacity_value
+
+    def setOpacity(self, opacity: int):
+        self.opacity_value = opacity
+
+    def blendingMode(self) -> str:
+        return self.blending_mode
+
+    def setBlendingMode(self, mode: str):
+        self.blending_mode = mode
+
+    def parentNode(self) -> "SyntheticNode | None":
+        return self.parent
+
+    def childNodes(self) -> list["SyntheticNode"]:
+        return list(self.children)
+
+    def addChildNode(self, child: "SyntheticNode", above: "SyntheticNode | None") -> bool:
+        index = self.children.index(above) + 1 if above in self.children else len(self.children)
+        self.children.insert(index, child)
+        child.parent = self
+        return True
+
+    def removeChildNode(self, child: "SyntheticNode") -> bool:
+        if child not in self.children:
+            return False
+        self.children.remove(child)
+        child.parent = None
+        return True
+
+    def bounds(self) -> QRect:
+        if self.node_type == "grouplayer":
+            bounds = QRect()
+            for child in self.children:
+                bounds = bounds.united(child.bounds())
+            return bounds
+        if self.image.isNull():
+            return QRect()
+        return QRect(self.offset, self.image.size())
+
+    def resetCache(self):
+        if self.node_type == "filelayer":
+            image = QImage(self.path)
+            if image.size() != self.document.size():
+                image = image.scaled(self.document.size())
+            self.image = image.convertToFormat(QImage.Format_ARGB32)
+
+    def transparency_mask(self) -> QImage | None:
+        masks = [child for child in self.children if child.node_type == "transparencymask" and child.is_visible]
+        if not masks:
+            return None
+        alpha = masks[0].image
+        if len(masks) > 1:
+            alpha = alpha.copy()
+            painter = QPainter(alpha)
+            painter.setCompositionMode(QPainter.CompositionMode_DestinationIn)
+            for mask in masks[1:]:
+                painter.drawImage(0, 0, mask.image)
+            painter.end()
+        return alpha
+
+    # 子のtransparency maskまで適用した、このnode単体の見た目
+    def render(self, target: QImage, origin: QPoint):
+        if self.node_type == "grouplayer":
+            for child in self.children:
+                if child.is_visible and child.node_type != "transparencymask":
+                    composite(target, child, origin)
+            return
+        if self.image.isNull():
+            return
+
+        mask = self.transparency_mask()
+        painter = QPainter(target)
+        if mask is None:
+            painter.drawImage(self.offset - origin, self.image)
+        else:
+            layer = QImage(target.size(), QImage.Format_ARGB32)
+            layer.fill(0)
+            layer_painter = QPainter(layer)
+            layer_painter.drawImage(self.offset - origin, self.image)
+            layer_painter.setCompositionMode(QPainter.CompositionMode_DestinationIn)
+            layer_painter.drawImage(-origin, mask)
+            layer_painter.end()
+            painter.drawImage(0, 0, layer)
+        painter.end()
+
+    def projection_image(self, rect: QRect) -> QImage:
+        image = QImage(rect.size(), QImage.Format_ARGB32)
+        image.fill(0)
+        self.render(image, rect.topLeft())
+        return image
+
+    def projectionPixelData(self, x: int, y: int, w: int, h: int) -> QByteArray:
+        if self.node_type == "transparencymask":
+            return image_bytes(self.image.copy(x, y, w, h))
+        return image_bytes(self.projection_image(QRect(x, y, w, h)))
+
+    def pixelData(self, x: int, y: int, w: int, h: int) -> QByteArray:
+        if self.node_type == "transparencymask":
+            return image_bytes(self.image.copy(x, y, w, h))
+        image = QImage(w, h, QImage.Format_ARGB32)
+        image.fill(0)
+        painter = QPainter(image)
+        painter.drawImage(self.offset - QPoint(x, y), self.image)
+        painter.end()
+        return image_bytes(image)
+
+    # Kritaと同じく、ロックされたnodeには書き込まない
+    def setPixelData(self, data: bytes, x: int, y: int, w: int, h: int) -> bool:
+        if self.is_locked:
+            return False
+        data = bytes(data)
+        if self.node_type == "transparencymask":
+            bits = self.image.bits()
+            bits.setsize(self.image.sizeInBytes())
+            bytes_per_line = self.image.bytesPerLine()
+            for row in range(h):
+                start = (y + row) * bytes_per_line + x
+                bits[start:start + w] = data[row * w:(row + 1) * w]
+            return True
+
+        patch = QImage(data, w, h, w * 4, QImage.Format_ARGB32)
+        rect = QRect(x, y, w, h).united(self.bounds())
+        image = QImage(rect.size(), QImage.Format_ARGB32)
+        image.fill(0)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        if not self.image.isNull():
+            painter.drawImage(self.offset - rect.topLeft(), self.image)
+        painter.drawImage(QPoint(x, y) - rect.topLeft(), patch)
+        painter.end()
+        self.offset = rect.topLeft()
+        self.image = image
+        return True
+
+    def clone_into(self, document: "SyntheticDocument") -> "SyntheticNode":
+        node = SyntheticNode(document, self.node_name, self.node_type)
+        node.unique_id = self.unique_id
+        node.color_label = self.color_label
+        node.is_visible = self.is_visible
+        node.is_locked = self.is_locked
+        node.inherit_alpha = self.inherit_alpha
+        node.opacity_value = self.opacity_value
+        node.blending_mode = self.blending_mode
+        node.offset = QPoint(self.offset)
+        node.image = self.image.copy()
+        node.path = self.path
+        for child in self.children:
+            node.addChildNode(child.clone_into(document), None)
+        return node
+
+
+def composite(target: QImage, node: SyntheticNode, origin: QPoint):
+    layer = node.projection_image(QRect(origin, target.size()))
+    painter = QPainter(target)
+    painter.setOpacity(node.opacity_value / 255)
+    painter.setCompositionMode(COMPOSITION_MODES.get(node.blending_mode, QPainter.CompositionMode_SourceOver))
+    painter.drawImage(0, 0, layer)
+    painter.end()
+
+
+def image_bytes(image: QImage) -> QByteArray:
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    if image.bytesPerLine() == image.width() * image.depth() // 8:
+        return QByteArray(bits.asstring())
+    row_size = image.width() * image.depth() // 8
+    data = bits.asstring()
+    return QByteArray(b"".join(data[y * image.bytesPerLine():y * image.bytesPerLine() + row_size]
+                               for y in range(image.height())))
+
+
+class SyntheticDocument:
+    def __init__(self, width: int, height: int):
+        self.document_width = width
+        self.document_height = height
+        self.root = SyntheticNode(self, "root", "grouplayer")
+        self.active_node: SyntheticNode | None = None
+        self.batchmode = False
+        self.projection_cache: QImage | None = None
+        self.closed = False
+        self.file_name = ""
+
+    def width(self) -> int:
+        return self.document_width
+
+    def height(self) -> int:
+        return self.document_height
+
+    def size(self) -> QSize:
+        return QSize(self.document_width, self.document_height)
+
+    def colorModel(self) -> str:
+        return "RGBA"
+
+    def colorDepth(self) -> str:
+        return "U8"
+
+    def colorProfile(self) -> str:
+        return "sRGB-elle-V2-srgbtrc.icc"
+
+    def resolution(self) -> int:
+        return 72
+
+    def fileName(self) -> str:
+        return self.file_name
+
+    def rootNode(self) -> SyntheticNode:
+        return self.root
+
+    def setBatchmode(self, batchmode: bool):
+        self.batchmode = batchmode
+
+    def activeNode(self) -> SyntheticNode | None:
+        return self.active_node
+
+    def setActiveNode(self, node: SyntheticNode):
+        self.active_node = node
+
+    def nodeByUniqueID(self, unique_id: QUuid) -> SyntheticNode | None:
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.unique_id == unique_id:
+                return node
+            stack.extend(node.children)
+        return None
+
+    def clone(self) -> "SyntheticDocument":
+        document = SyntheticDocument(self.document_width, self.document_height)
+        document.root = self.root.clone_into(document)
+        return document
+
+    def close(self) -> bool:
+        self.closed = True
+        self.root = SyntheticNode(self, "root", "grouplayer")
+        self.projection_cache = None
+        return True
+
+    # Kritaと同じく、合成はrefreshProjectionで行い、projectionはその結果を読むだけにする
+    def refreshProjection(self):
+        self.projection_cache = self.root.projection_image(QRect(0, 0, self.document_width, self.document_height))
+
+    def waitForDone(self):
+        pass
+
+    def projection(self, x: int, y: int, w: int, h: int) -> QImage:
+        if self.projection_cache is None:
+            self.refreshProjection()
+        return self.projection_cache.copy(x, y, w, h)
+
+    def createNode(self, name: str, node_type: str) -> SyntheticNode:
+        return SyntheticNode(self, name, node_type.lower())
+
+    def createTransparencyMask(self, name: str) -> SyntheticNode:
+        mask = SyntheticNode(self, name, "transparencymask")
+        mask.image = QImage(self.document_width, self.document_height, QImage.Format_Alpha8)
+        mask.image.fill(0)
+        return mask
+
+    def createFileLayer(self, name: str, path: str, scaling_method: str) -> SyntheticNode:
+        layer = SyntheticNode(self, name, "filelayer")
+        layer.path = path
+        layer.resetCache()
+        return layer
+
+
+@dataclass(frozen=True)
+class DocumentSpec:
+    width: int
+    height: int
+    layers: int
+    depth: int
+    label_mix: str
+    seed: int = 0
+
+    def name(self) -> str:
+        return f"{self.width}x{self.height}-l{self.layers}-d{self.depth}-{self.label_mix}"
+
+
+def layer_label(index: int, label_mix: str) -> int:
+    if label_mix == "uniform":
+        # 無し, scribble, lineart, base color, shadow, light を順番に
+        return index % 6
+    if label_mix == "unlabelled":
+        # 生成に使うlabelは1枚ずつで、残りはlabel無し
+        return index + 1 if index < 5 else 0
+    if label_mix == "single":
+        return 2
+    raise ValueError(f"unknown label mix: {label_mix}")
+
+
+def draw_layer(image: QImage, rng: random.Random):
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.setPen(Qt.NoPen)
+    for _ in range(8):
+        painter.setBrush(QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.choice((128, 255))))
+        w = rng.randint(image.width() // 8, image.width() // 2)
+        h = rng.randint(image.height() // 8, image.height() // 2)
+        painter.drawEllipse(rng.randrange(image.width() - w + 1), rng.randrange(image.height() - h + 1), w, h)
+    painter.end()
+
+
+# specの通りにlayerを並べたドキュメントを作る
+# layerはdepth段までのgroupに順に振り分け、各layerはキャンバスの1/4四方程度の範囲に描く
+def build_document(spec: DocumentSpec) -> SyntheticDocument:
+    rng = random.Random(spec.seed)
+    document = SyntheticDocument(spec.width, spec.height)
+
+    groups = [document.root]
+    for level in range(spec.depth):
+        group = document.createNode(f"group {level}", "groupLayer")
+        groups[-1].addChildNode(group, None)
+        groups.append(group)
+
+    for index in range(spec.layers):
+        layer = document.createNode(f"layer {index}", "paintLayer")
+        layer.setColorLabel(layer_label(index, spec.label_mix))
+        w = max(spec.width // 4, 1)
+        h = max(spec.height // 4, 1)
+        layer.offset = QPoint(rng.randrange(spec.width - w + 1), rng.randrange(spec.height - h + 1))
+        layer.image = QImage(w, h, QImage.Format_ARGB32)
+        layer.image.fill(0)
+        draw_layer(layer.image, rng)
+        groups[index % len(groups)].addChildNode(layer, None)
+    return document
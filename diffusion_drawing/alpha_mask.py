@@ -0,0 +1,129 @@
+import hashlib
+import math
+import struct
+from dataclasses import dataclass
+
+import krita
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Kritaのcolor modelごとのチャンネル数 (alphaは常に最後のチャンネル)
+COLOR_MODEL_CHANNELS = {"A": 1, "GRAYA": 2, "RGBA": 4, "XYZA": 4, "LABA": 4, "YCbCrA": 4, "CMYKA": 5}
+COLOR_DEPTH_TYPECODES = {"U8": "B", "U16": "H", "F16": "e", "F32": "f"}
+
+# 巨大なキャンバスでもメモリを食わないように、この行数ごとに読み書きする
+MASK_STRIP_HEIGHT = 256
+
+# 以前のlevelsフィルタマスク (channel_4 = "0;1;10;0;1") を2枚重ねたものと同じ変換
+LEVELS_ALPHA_GAMMA = 10.0
+LEVELS_FILTER_COUNT = 2
+
+
+def levels_lut(gamma: float) -> bytes:
+    return bytes(round(255 * math.pow(i / 255, 1 / gamma)) for i in range(256))
+
+
+def binarize_lut() -> bytes:
+    lut = bytes(range(256))
+    for _ in range(LEVELS_FILTER_COUNT):
+        lut = lut.translate(levels_lut(LEVELS_ALPHA_GAMMA))
+    return lut
+
+
+BINARIZE_LUT = binarize_lut()
+
+
+def uint8_mult(a: int, b: int) -> int:
+    t = a * b + 0x80
+    return ((t >> 8) + t) >> 8
+
+
+# normalで重ねたときのalpha (a + b - a * b) の表
+UNION_ALPHA_TABLE = bytes(a + b - uint8_mult(a, b) for a in range(256) for b in range(256))
+
+
+@dataclass(frozen=True)
+class PixelFormat:
+    channels: int
+    typecode: str
+
+    @staticmethod
+    def of(color_model: str, color_depth: str) -> "PixelFormat | None":
+        if color_model not in COLOR_MODEL_CHANNELS or color_depth not in COLOR_DEPTH_TYPECODES:
+            return None
+        return PixelFormat(COLOR_MODEL_CHANNELS[color_model], COLOR_DEPTH_TYPECODES[color_depth])
+
+    def alpha_u8(self, pixels: bytes) -> bytes:
+        if self.typecode == "B":
+            return bytes(pixels[self.channels - 1::self.channels])
+
+        if numpy is not None:
+            alpha = numpy.frombuffer(pixels, dtype=numpy.dtype(self.typecode))[self.channels - 1::self.channels]
+            if self.typecode == "H":
+                return ((alpha.astype(numpy.uint32) * 255 + 32767) // 65535).astype(numpy.uint8).tobytes()
+            return numpy.rint(numpy.clip(alpha, 0.0, 1.0) * 255).astype(numpy.uint8).tobytes()
+
+        count = len(pixels) // struct.calcsize(self.typecode)
+        alpha = struct.unpack(f"={count}{self.typecode}", pixels)[self.channels - 1::self.channels]
+        if self.typecode == "H":
+            return bytes((a * 255 + 32767) // 65535 for a in alpha)
+        return bytes(round(min(max(a, 0.0), 1.0) * 255) for a in alpha)
+
+
+def union_alpha(base_alpha: bytes, alpha: bytes) -> bytes:
+    if numpy is not None:
+        a = numpy.frombuffer(base_alpha, dtype=numpy.uint8).astype(numpy.uint32)
+        b = numpy.frombuffer(alpha, dtype=numpy.uint8).astype(numpy.uint32)
+        t = a * b + 0x80
+        return (a + b - (((t >> 8) + t) >> 8)).astype(numpy.uint8).tobytes()
+    return bytes(UNION_ALPHA_TABLE[(a << 8) | b] for a, b in zip(base_alpha, alpha))
+
+
+# base layerのalphaと、2値化したlayerのalphaをnormalで重ねたものをmaskにする
+# (以前は一時ドキュメント上でlevelsフィルタと白い塗りつぶしレイヤーを重ねて、A/U8へ変換していた)
+def build_mask(base_alpha: bytes, layer_alpha: bytes) -> bytes:
+    return union_alpha(base_alpha, layer_alpha.translate(BINARIZE_LUT))
+
+
+def strips(height: int):
+    for top in range(0, height, MASK_STRIP_HEIGHT):
+        yield top, min(MASK_STRIP_HEIGHT, height - top)
+
+
+def read_alpha(node: krita.Node, pixel_format: PixelFormat, width: int, height: int) -> bytes:
+    alpha = bytearray()
+    for top, strip_height in strips(height):
+        alpha += pixel_format.alpha_u8(bytes(node.projectionPixelData(0, top, width, strip_height)))
+    return bytes(alpha)
+
+
+def fill_transparency_mask(transparency_mask: krita.Node, node: krita.Node, base_alpha: bytes,
+                           pixel_format: PixelFormat, width: int, height: int):
+    bounds = node.bounds()
+    for top, strip_height in strips(height):
+        base = base_alpha[top * width:(top + strip_height) * width]
+        if bounds.isEmpty() or top + strip_height <= bounds.top() or bounds.bottom() < top:
+            # layerに何も描かれていない行はbase layerのalphaそのまま
+            mask = base
+        else:
+            pixels = bytes(node.projectionPixelData(0, top, width, strip_height))
+            mask = build_mask(base, pixel_format.alpha_u8(pixels))
+        transparency_mask.setPixelData(mask, 0, top, width, strip_height)
+
+
+def alpha_digest(alpha: bytes) -> bytes:
+    return hashlib.blake2b(alpha, digest_size=16).digest()
+
+
+# maskの入力 (base layerのalphaとlayer自身の画素) が同じなら同じ値になる
+def mask_signature(base_alpha_digest: bytes, node: krita.Node) -> bytes:
+    bounds = node.bounds()
+    h = hashlib.blake2b(base_alpha_digest, digest_size=16)
+    h.update(struct.pack("=4i", bounds.left(), bounds.top(), bounds.width(), bounds.height()))
+    if not bounds.isEmpty():
+        for top, strip_height in strips(bounds.height()):
+            h.update(bytes(node.pixelData(bounds.left(), bounds.top() + top, bounds.width(), strip_height)))
+    return h.digest()
@@ -0,0 +1,226 @@
+import asyncio
+import inspect
+import json
+import os
+import uuid
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, TypeVar
+from urllib.parse import urlsplit
+
+from .diffusion_controller import DiffusionController
+from .http_client import CONNECTION_ERRORS, WEBSOCKET_TEXT, HttpConnectionPool, WebSocketConnection
+from .buffered_controller import accepts_kwarg, controller_arguments
+from .prompt_queue import cancel_prompts
+from .wire_format import Placement, negotiated_formats
+
+HEALTH_CHECK_INTERVAL = 5.0
+WEBSOCKET_RECONNECT_INTERVAL = 5.0
+DEFAULT_PORT = 8188
+# 1台だけで使うときに、controllerがどのサーバーに繋いでいるか分からなければここだと思う (ComfyUIの既定)
+DEFAULT_BACKEND_ADDRESS = f"127.0.0.1:{DEFAULT_PORT}"
+
+# カンマ区切りで複数のComfyUIサーバーを指定すると、空いているサーバーに振り分ける
+BACKENDS_ENVIRONMENT_VARIABLE = "DIFFUSION_DRAWING_BACKENDS"
+
+T = TypeVar("T")
+
+
+def configured_backend_addresses() -> list[str]:
+    addresses = os.environ.get(BACKENDS_ENVIRONMENT_VARIABLE, "").split(",")
+    return [address.strip() for address in addresses if address.strip()]
+
+
+def single_backend_address(controller: DiffusionController) -> str:
+    return getattr(controller, "address", None) or DEFAULT_BACKEND_ADDRESS
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    if "://" not in address:
+        address = "http://" + address
+    parts = urlsplit(address)
+    return parts.hostname, parts.port or DEFAULT_PORT
+
+
+# サーバーごとのcontrollerは接続先を受け取って作る
+# 接続先を受け取らないcontrollerでは振り分けられないので、分かるエラーにする
+def create_controller(controller_factory: Callable[[str], DiffusionController], address: str) -> DiffusionController:
+    try:
+        inspect.signature(controller_factory).bind(address)
+    except TypeError as e:
+        name = getattr(controller_factory, "__name__", controller_factory)
+        raise RuntimeError(f"{BACKENDS_ENVIRONMENT_VARIABLE} is set, but {name} does not take a server address") from e
+    except ValueError:
+        # signatureが分からないときは、そのまま呼んでみる
+        pass
+    return controller_factory(address)
+
+
+@dataclass
+class Backend:
+    address: str
+    # 画像のアップロード、生成、結果のダウンロードはcontrollerが自分の接続で行う
+    controller: DiffusionController
+    # キューの確認とキャンセル (/queue, /interrupt) だけに使う
+    http: HttpConnectionPool
+    healthy: bool = True
+    # サーバーのキューに残っているprompt数
+    queue_depth: int = 0
+    # このプロセスから投げて結果を待っている数
+    in_flight: int = 0
+    tasks: list[asyncio.Task] = field(default_factory=list)
+
+    def load(self) -> int:
+        return self.queue_depth + self.in_flight
+
+
+# 複数のComfyUIサーバーに、キューが一番空いているものから順に振り分ける
+# DiffusionControllerと同じファイルパスのAPIを持つので、そのまま置き換えて使える
+class BackendPool:
+    def __init__(self, addresses: list[str], controller_factory: Callable[[str], DiffusionController]):
+        self.client_id = uuid.uuid4().hex
+        self.backends = []
+        for address in addresses:
+            host, port = parse_address(address)
+            self.backends.append(Backend(address, create_controller(controller_factory, address),
+                                         HttpConnectionPool(host, port)))
+
+    def start(self):
+        for backend in self.backends:
+            backend.tasks.append(asyncio.ensure_future(self.health_check_loop(backend)))
+            backend.tasks.append(asyncio.ensure_future(self.listen(backend)))
+
+    def close(self):
+        for backend in self.backends:
+            for task in backend.tasks:
+                task.cancel()
+            backend.tasks.clear()
+            backend.http.close()
+
+    async def health_check(self, backend: Backend):
+        try:
+            status, body = await backend.http.request("GET", "/queue")
+            if status != 200:
+                raise ConnectionError(f"/queue returned status {status}")
+            queue = json.loads(body)
+            backend.queue_depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+            backend.healthy = True
+        except CONNECTION_ERRORS + (ValueError,):
+            backend.healthy = False
+
+    async def health_check_loop(self, backend: Backend):
+        while True:
+            await self.health_check(backend)
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+    # websocketに流れてくるstatusからキューの長さを随時更新する
+    async def listen(self, backend: Backend):
+        host, port = parse_address(backend.address)
+        while True:
+            try:
+                websocket = await WebSocketConnection.connect(host, port, f"/ws?clientId={self.client_id}")
+                try:
+                    while True:
+                        opcode, payload = await websocket.receive()
+                        if opcode == WEBSOCKET_TEXT:
+                            self.handle_message(backend, json.loads(payload))
+                finally:
+                    websocket.close()
+            except CONNECTION_ERRORS + (ValueError,):
+                pass
+            await asyncio.sleep(WEBSOCKET_RECONNECT_INTERVAL)
+
+    def handle_message(self, backend: Backend, message: dict):
+        if message.get("type") == "status":
+            exec_info = message.get("data", {}).get("status", {}).get("exec_info", {})
+            if "queue_remaining" in exec_info:
+                backend.queue_depth = exec_info["queue_remaining"]
+                backend.healthy = True
+
+    def candidates(self) -> list[Backend]:
+        # 落ちているように見えるサーバーも、他が全部だめだったときのために最後に試す
+        return sorted(self.backends, key=lambda backend: (not backend.healthy, backend.load()))
+
+    # callには、このcallで投げるpromptのidを記録するリストも渡す
+    async def dispatch(self, call: Callable[[DiffusionController, list[str]], Awaitable[T]]) -> T:
+        error = None
+        for backend in self.candidates():
+            backend.in_flight += 1
+            prompt_ids = []
+            try:
+                return await call(backend.controller, prompt_ids)
+            except CONNECTION_ERRORS as e:
+                # 繋がらないサーバーは次のヘルスチェックまで外して、別のサーバーで試す
+                backend.healthy = False
+                error = e
+            except asyncio.CancelledError:
+                # promptのidが分からないcontrollerでは、どれが自分のものか分からないので何もしない
+                await cancel_prompts(backend.http, prompt_ids)
+                raise
+            finally:
+                backend.in_flight -= 1
+        raise ConnectionError("no backend available") from error
+
+    # どのサーバーに送っても受け取れる入力形式だけを申告する
+    @property
+    def input_formats(self) -> frozenset[str]:
+        return frozenset.intersection(*[negotiated_formats(backend.controller) for backend in self.backends])
+
+    # どのサーバーに送ってもseed違いの候補を生成できるときだけ申告する
+    @property
+    def supports_variants(self) -> bool:
+        return all(hasattr(backend.controller, "detail_colored_variants")
+                   or accepts_kwarg(backend.controller.detail_colored, "parameters") for backend in self.backends)
+
+    # どのサーバーに送っても生成中のpreviewを流してもらえるときだけ申告する
+    @property
+    def supports_preview(self) -> bool:
+        return all(accepts_kwarg(backend.controller.scribble_to_line, "preview")
+                   or accepts_kwarg(backend.controller.detail_colored, "preview") for backend in self.backends)
+
+    # どのサーバーでも自分のpromptを見分けられるときだけ、キャンセルでバックエンドのpromptも止められる
+    @property
+    def supports_interrupt(self) -> bool:
+        return all(accepts_kwarg(backend.controller.scribble_to_line, "prompt_id")
+                   and accepts_kwarg(backend.controller.detail_colored, "prompt_id") for backend in self.backends)
+
+    async def scribble_to_line(self, scribble_path: str, lineart_path: str, output_path: str,
+                               preview: Callable[[bytes], None] | None = None, parameters: dict | None = None,
+                               placements: list[Placement | None] | None = None):
+        return await self.dispatch(
+            lambda controller, prompt_ids: controller.scribble_to_line(
+                scribble_path, lineart_path, output_path,
+                **controller_arguments(controller.scribble_to_line, preview, parameters, placements, prompt_ids)))
+
+    async def detail_colored(self, image_path: str, basecolor_image_path: str, lineart_path: str,
+                             basecolor_path: str, shadow_path: str, light_path: str, shadow_output_path: str,
+                             light_output_path: str, preview: Callable[[bytes], None] | None = None,
+                             parameters: dict | None = None, placements: list[Placement | None] | None = None):
+        return await self.dispatch(
+            lambda controller, prompt_ids: controller.detail_colored(
+                image_path, basecolor_image_path, lineart_path, basecolor_path, shadow_path, light_path,
+                shadow_output_path, light_output_path,
+                **controller_arguments(controller.detail_colored, preview, parameters, placements, prompt_ids)))
+
+    # 1台のサーバーでまとめて生成する (まとめて受け取れないcontrollerなら、同じサーバーでseedをparametersで渡して生成する)
+    async def detail_colored_variants(self, image_path: str, basecolor_image_path: str, lineart_path: str,
+                                      basecolor_path: str, shadow_path: str, light_path: str, seeds: list[int],
+                                      output_paths: list[tuple[str, str]],
+                                      preview: Callable[[bytes], None] | None = None, parameters: dict | None = None,
+                                      placements: list[Placement | None] | None = None):
+        if not self.supports_variants:
+            raise RuntimeError("the backend cannot generate with a given seed")
+        input_paths = [image_path, basecolor_image_path, lineart_path, basecolor_path, shadow_path, light_path]
+
+        async def call(controller: DiffusionController, prompt_ids: list[str]):
+            detail_colored_variants = getattr(controller, "detail_colored_variants", None)
+            if detail_colored_variants is not None:
+                return await detail_colored_variants(
+                    *input_paths, seeds, output_paths,
+                    **controller_arguments(detail_colored_variants, preview, parameters, placements, prompt_ids))
+            for seed, (shadow_output_path, light_output_path) in zip(seeds, output_paths):
+                await controller.detail_colored(
+                    *input_paths, shadow_output_path, light_output_path,
+                    **controller_arguments(controller.detail_colored, preview, {**(parameters or {}), "seed": seed},
+                                           placements, prompt_ids))
+
+        return await self.dispatch(call)
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+# フォルダ単位でlineartとshadow/lightを生成しなおすbatchの起動側
+# Krita本体は読み込まないので、Kritaの外から直接実行する
+#   python diffusion_drawing/batch.py chapter01 --output out/chapter01 --workers 4 --max-requests 8
+# ドキュメントはworker (kritarunner -s diffusion_drawing.batch_worker) がまとめていくつかずつ処理する
+# 終わったドキュメントは出力先のjournalに記録され、途中で止めても同じコマンドで続きから再開する
+
+WORKER_MODULE = "diffusion_drawing.batch_worker"
+DEFAULT_KRITA_RUNNER = "kritarunner"
+DOCUMENT_EXTENSIONS = (".kra", ".ora", ".psd", ".tif", ".tiff")
+OPERATIONS = ("lineart", "detail", "transfer")
+DEFAULT_OPERATIONS = ["lineart", "detail"]
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_REQUESTS = 4
+# Kritaの起動には数秒かかるので、1つのworkerでいくつかのドキュメントをまとめて処理する
+DEFAULT_DOCUMENTS_PER_WORKER = 4
+
+STATE_DIR_NAME = ".diffusion_drawing_batch"
+REPORT_FILE_NAME = "report.json"
+
+
+@dataclass
+class Document:
+    source: str
+    output: str
+    # 入力ファイルが書き換えられていたら、前に終わっていてもやりなおす
+    signature: list[int]
+
+    def entry(self) -> dict:
+        return {"source": self.source, "output": self.output, "signature": self.signature}
+
+
+def file_signature(path: str) -> list[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def find_documents(inputs: list[str], output_dir: str) -> list[Document]:
+    documents = []
+    for input_path in inputs:
+        input_path = os.path.abspath(input_path)
+        if os.path.isfile(input_path):
+            paths = [(input_path, os.path.basename(input_path))]
+        else:
+            paths = []
+            for directory, _, file_names in os.walk(input_path):
+                for file_name in file_names:
+                    if file_name.lower().endswith(DOCUMENT_EXTENSIONS):
+                        path = os.path.join(directory, file_name)
+                        paths.append((path, os.path.relpath(path, input_path)))
+        for path, relative_path in sorted(paths):
+            documents.append(Document(path, os.path.join(output_dir, relative_path), file_signature(path)))
+    return documents
+
+
+def read_journal(state_dir: str) -> list[dict]:
+    records = []
+    journal_dir = os.path.join(state_dir, "journal")
+    if not os.path.isdir(journal_dir):
+        return records
+    for file_name in sorted(os.listdir(journal_dir)):
+        with open(os.path.join(journal_dir, file_name)) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # workerが書き込み途中で止められた行
+                    pass
+    return records
+
+
+def pending_documents(documents: list[Document], records: list[dict]) -> list[Document]:
+    done = {(record["source"], tuple(record["signature"])) for record in records if record["status"] == "done"}
+    return [document for document in documents if (document.source, tuple(document.signature)) not in done]
+
+
+class BatchRunner:
+    def __init__(self, args: argparse.Namespace, state_dir: str):
+        self.args = args
+        self.state_dir = state_dir
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        for name in ("jobs", "journal", "logs"):
+            os.makedirs(os.path.join(state_dir, name), exist_ok=True)
+
+    def write_job(self, index: int, documents: list[Document], max_concurrent_requests: int) -> str:
+        name = f"{self.run_id}-{index:04d}"
+        job = {
+            "documents": [document.entry() for document in documents],
+            "operations": self.args.operations,
+            "full": self.args.full,
+            "max_concurrent_requests": max_concurrent_requests,
+            "cache_dir": self.args.cache_dir,
+            "journal": os.path.join(self.state_dir, "journal", f"{name}.jsonl"),
+        }
+        path = os.path.join(self.state_dir, "jobs", f"{name}.json")
+        with open(path, "w") as f:
+            json.dump(job, f)
+        return path
+
+    def run_worker(self, job_path: str) -> int:
+        name = os.path.splitext(os.path.basename(job_path))[0]
+        with open(os.path.join(self.state_dir, "logs", f"{name}.log"), "w") as log:
+            return subprocess.run([self.args.krita_runner, "-s", WORKER_MODULE, job_path],
+                                  stdout=log, stderr=subprocess.STDOUT).returncode
+
+    # worker数はリクエストの上限を超えないようにして、上限をworkerで等分する
+    def run(self, documents: list[Document]) -> bool:
+        chunk_size = self.args.documents_per_worker
+        chunks = [documents[i:i + chunk_size] for i in range(0, len(documents), chunk_size)]
+        workers = max(min(self.args.workers, self.args.max_requests, len(chunks)), 1)
+        requests_per_worker = max(self.args.max_requests // workers, 1)
+        job_paths = [self.write_job(index, chunk, requests_per_worker) for index, chunk in enumerate(chunks)]
+
+        print(f"{len(documents)} document(s) in {len(chunks)} job(s), {workers} worker(s), "
+              f"{requests_per_worker} backend request(s) per worker", flush=True)
+        succeeded = True
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {executor.submit(self.run_worker, job_path): job_path for job_path in job_paths}
+            for future in as_completed(futures):
+                returncode = future.result()
+                if returncode != 0:
+                    succeeded = False
+                    print(f"worker for {os.path.basename(futures[future])} exited with {returncode}", flush=True)
+        finally:
+            # Ctrl+Cのときは、まだ始まっていないjobを捨てる (workerにも同じシグナルが届く)
+            executor.shutdown(wait=True, cancel_futures=True)
+        return succeeded
+
+
+def throughput_report(records: list[dict], run_start: float, run_end: float, settings: dict) -> dict:
+    records = [record for record in records if record.get("finished", 0) >= run_start]
+    done = [record for record in records if record["status"] == "done"]
+    failed = [record for record in records if record["status"] != "done"]
+    wall_time = run_end - run_start
+    stages = {}
+    for record in done:
+        for name, duration in record.get("stages", {}).items():
+            stages[name] = stages.get(name, 0.0) + duration
+    seconds = [record["seconds"] for record in done]
+    return {
+        "settings": settings,
+        "wall_time": wall_time,
+        "documents_done": len(done),
+        "documents_failed": len(failed),
+        "documents_per_minute": len(done) / wall_time * 60 if wall_time > 0 else 0.0,
+        "megapixels_per_second": sum(record["pixels"] for record in done) / 1e6 / wall_time if wall_time > 0 else 0.0,
+        "document_seconds": {"median": statistics.median(seconds), "max": max(seconds)} if seconds else None,
+        "stage_totals": dict(sorted(stages.items(), key=lambda item: -item[1])),
+        "failures": [{"source": record["source"], "error": record.get("error")} for record in failed],
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"done: {report['documents_done']}, failed: {report['documents_failed']}, "
+        f"wall time: {report['wall_time']:.1f} s",
+        f"throughput: {report['documents_per_minute']:.2f} documents/min, "
+        f"{report['megapixels_per_second']:.2f} MP/s",
+    ]
+    if report["document_seconds"] is not None:
+        lines.append(f"per document: median {report['document_seconds']['median']:.1f} s, "
+                     f"max {report['document_seconds']['max']:.1f} s")
+    for name, duration in list(report["stage_totals"].items())[:8]:
+        lines.append(f"  {name}: {duration:.1f} s")
+    for failure in report["failures"]:
+        lines.append(f"FAILED {failure['source']}: {failure['error']}")
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Regenerate lineart and shading for many documents without the UI")
+    parser.add_argument("inputs", nargs="+", help="documents or folders of documents")
+    parser.add_argument("--output", required=True, help="folder to save the processed documents to")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=DEFAULT_OPERATIONS)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Krita processes run at once")
+    parser.add_argument("--max-requests", type=int, default=DEFAULT_MAX_REQUESTS,
+                        help="backend requests in flight across all workers")
+    parser.add_argument("--documents-per-worker", type=int, default=DEFAULT_DOCUMENTS_PER_WORKER)
+    parser.add_argument("--full", action="store_true",
+                        help="regenerate everything, ignoring cached results (e.g. after a model update)")
+    parser.add_argument("--restart", action="store_true", help="forget the progress of previous runs")
+    parser.add_argument("--krita-runner", default=DEFAULT_KRITA_RUNNER)
+    parser.add_argument("--cache-dir", help="where workers keep the result cache (default: Krita's cache location)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    output_dir = os.path.abspath(args.output)
+    state_dir = os.path.join(output_dir, STATE_DIR_NAME)
+    if args.restart:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    documents = find_documents(args.inputs, output_dir)
+    pending = pending_documents(documents, read_journal(state_dir))
+    print(f"{len(documents) - len(pending)} of {len(documents)} document(s) already done", flush=True)
+    if not pending:
+        return 0
+
+    run_start = time.time()
+    runner = BatchRunner(args, state_dir)
+    interrupted = False
+    try:
+        succeeded = runner.run(pending)
+    except KeyboardInterrupt:
+        interrupted = True
+        succeeded = False
+    run_end = time.time()
+
+    settings = {"operations": args.operations, "workers": args.workers, "max_requests": args.max_requests,
+                "documents_per_worker": args.documents_per_worker, "full": args.full}
+    report = throughput_report(read_journal(state_dir), run_start, run_end, settings)
+    with open(os.path.join(state_dir, REPORT_FILE_NAME), "w") as f:
+        json.dump(report, f, indent=2)
+    print(format_report(report))
+
+    remaining = len(pending_documents(documents, read_journal(state_dir)))
+    if remaining:
+        print(f"{remaining} document(s) not done; run the same command again to resume")
+    if interrupted:
+        return 130
+    return 0 if succeeded and not remaining else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import traceback
+
+import krita
+from PyQt5.QtCore import QStandardPaths
+
+from .engine import DiffusionEngine
+from .instrumentation import stage
+
+# batch.pyが起動する、Kritaを画面なしで動かすworker
+#   kritarunner -s diffusion_drawing.batch_worker <job file>
+# job fileに書かれたドキュメントを順に開いて生成し、1件終わるごとにjournalへ1行書く
+
+OPERATIONS = ("lineart", "detail", "transfer")
+
+
+def append_record(journal_path: str, record: dict):
+    # 途中で落ちても終わった分は残るように、1件ごとに書いてflushする
+    with open(journal_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def process_document(engine: DiffusionEngine, entry: dict, operations: list[str], full: bool) -> dict:
+    document = krita.Krita.instance().openDocument(entry["source"])
+    if document is None:
+        raise RuntimeError(f"failed to open {entry['source']}")
+    document.setBatchmode(True)
+    try:
+        with engine.profiler.run("document") as trace:
+            if not engine.restore_document(document):
+                engine.initialize_document(document)
+            if full:
+                engine.reset_regions(document)
+
+            for operation in operations:
+                if operation == "lineart":
+                    await engine.gen_lineart(document)
+                elif operation == "detail":
+                    await engine.gen_detail(document)
+                elif operation == "transfer":
+                    engine.transfer_all(document)
+
+            with stage("document save"):
+                os.makedirs(os.path.dirname(entry["output"]), exist_ok=True)
+                if not document.saveAs(entry["output"]):
+                    raise RuntimeError(f"failed to save {entry['output']}")
+        return {"pixels": document.width() * document.height(), "seconds": trace.duration,
+                "stages": trace.stage_totals()}
+    finally:
+        engine.forget_document(document)
+        document.close()
+
+
+async def run_job(job: dict):
+    engine = DiffusionEngine(job.get("cache_dir") or QStandardPaths.writableLocation(QStandardPaths.CacheLocation),
+                             max_concurrent_requests=job["max_concurrent_requests"],
+                             use_result_cache=not job["full"])
+    if engine.backend_pool_error is not None:
+        print(engine.backend_pool_error, file=sys.stderr, flush=True)
+    engine.start()
+    try:
+        for entry in job["documents"]:
+            record = {"source": entry["source"], "signature": entry["signature"], "output": entry["output"],
+                      "operations": job["operations"], "pid": os.getpid()}
+            start = time.time()
+            try:
+                record.update(await process_document(engine, entry, job["operations"], job["full"]))
+                record["status"] = "done"
+            except Exception as e:
+                record["status"] = "failed"
+                record["error"] = f"{type(e).__name__}: {e}"
+                traceback.print_exc()
+            record["started"] = start
+            record["finished"] = time.time()
+            append_record(job["journal"], record)
+            print(f"{record['status']}: {entry['source']}", flush=True)
+    finally:
+        engine.close()
+
+
+# kritarunnerから呼ばれる
+def __main__(args: list[str]):
+    with open(args[0]) as f:
+        job = json.load(f)
+    unknown = set(job["operations"]) - set(OPERATIONS)
+    if unknown:
+        print(f"unknown operations: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    try:
+        event_loop.run_until_complete(run_job(job))
+    finally:
+        event_loop.close()
+    return 0
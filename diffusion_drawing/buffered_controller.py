@@ -0,0 +1,247 @@
+import asyncio
+import inspect
+import os
+import tempfile
+import uuid
+from typing import Callable
+
+from .diffusion_controller import DiffusionController
+from .http_client import HttpConnectionPool
+from .instrumentation import stage
+from .preview_stream import preview_callback
+from .prompt_queue import cancel_prompts, interrupt_running
+from .wire_format import CROP, DETAIL_COLORED_ROLES, SCRIBBLE_TO_LINE_ROLES, Placement, crop_masks, negotiated_formats
+
+SHM_DIR = "/dev/shm"
+DETAIL_INPUT_NAMES = ("image", "basecolor_image", "lineart", "basecolor", "shadow", "light")
+
+
+def spool_root() -> str | None:
+    # NFS上のhomeなどを避けて、使えるならメモリ上のファイルシステムを使う
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+        return SHM_DIR
+    return None
+
+
+def accepts_kwarg(method, name: str) -> bool:
+    try:
+        return name in inspect.signature(method).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+# controllerのメソッドが受け取れる引数だけを渡す
+# previewを受け取れるcontrollerには生成中のpreviewを流してもらい、
+# parametersを受け取れるcontrollerにはdraft用のstep数などを渡す
+# maskを切り出したときは、その位置をplacementsで渡す
+# prompt_idsを渡したときは、prompt_idを受け取れるcontrollerにこちらで決めたidでpromptを投げてもらい、キャンセルのために記録する
+def controller_arguments(method, preview: Callable[[bytes], None] | None, parameters: dict | None,
+                         placements: list[Placement | None] | None = None,
+                         prompt_ids: list[str] | None = None) -> dict:
+    arguments = {}
+    if prompt_ids is not None and accepts_kwarg(method, "prompt_id"):
+        arguments["prompt_id"] = str(uuid.uuid4())
+        prompt_ids.append(arguments["prompt_id"])
+    if preview is not None and accepts_kwarg(method, "preview"):
+        arguments["preview"] = preview
+    if parameters and accepts_kwarg(method, "parameters"):
+        arguments["parameters"] = parameters
+    if placements is not None:
+        arguments["placements"] = placements
+    return arguments
+
+
+# seed違いの候補を生成できるか
+# まとめて受け取れるか、seedをparametersで受け取れる必要がある (受け取れなければ同じseedの結果が並ぶだけになる)
+def supports_variants(controller) -> bool:
+    declared = getattr(controller, "supports_variants", None)
+    if declared is not None:
+        return declared
+    if hasattr(controller, "detail_colored_variants") or hasattr(controller, "detail_colored_variants_buffers"):
+        return True
+    return accepts_kwarg(getattr(controller, "detail_colored_buffers", controller.detail_colored), "parameters")
+
+
+# 生成中のpreviewを流してもらえるか (線画と陰影のどちらかで受け取れれば、そちらだけpreviewを表示する)
+def supports_preview(controller) -> bool:
+    declared = getattr(controller, "supports_preview", None)
+    if declared is not None:
+        return declared
+    scribble_to_line = getattr(controller, "scribble_to_line_buffers", controller.scribble_to_line)
+    detail_colored = getattr(controller, "detail_colored_buffers", controller.detail_colored)
+    return accepts_kwarg(scribble_to_line, "preview") or accepts_kwarg(detail_colored, "preview")
+
+
+# キャンセルしたときに、バックエンドで実行中のpromptも止められるか
+def supports_interrupt(controller) -> bool:
+    declared = getattr(controller, "supports_interrupt", None)
+    if declared is not None:
+        return declared
+    return hasattr(controller, "interrupt")
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+# DiffusionControllerをバイト列で呼び出すためのラッパー
+# controllerがバッファを直接受け取れる場合はそれを使い、そうでなければ一時ディレクトリ経由でファイルパスのAPIを呼ぶ
+# max_concurrent_requestsを指定すると、同時にバックエンドへ投げるリクエストの数をそれ以下に抑える
+# backendを渡すと、キャンセルしたときにそのサーバーのHTTP APIでpromptを止める
+class BufferedDiffusionController:
+    def __init__(self, controller: DiffusionController, max_concurrent_requests: int | None = None,
+                 backend: HttpConnectionPool | None = None):
+        self.controller = controller
+        self.request_slots = asyncio.Semaphore(max_concurrent_requests) if max_concurrent_requests else None
+        self.backend = backend
+
+    @property
+    def supports_interrupt(self) -> bool:
+        return self.backend is not None or supports_interrupt(self.controller)
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+
+    # キャンセルされたときは、バックエンドで実行中のpromptも止めてもらう
+    # controllerがinterruptを持っていればそれを使い、なければbackendのHTTP APIで止める
+    # promptのidが分かればそのpromptだけを止め、分からなければ実行中のpromptをinterruptする
+    async def interrupt(self, prompt_ids: list[str]):
+        interrupt = getattr(self.controller, "interrupt", None)
+        if interrupt is not None:
+            result = interrupt()
+            if inspect.isawaitable(result):
+                await result
+        elif self.backend is not None and prompt_ids:
+            await cancel_prompts(self.backend, prompt_ids)
+        elif self.backend is not None:
+            await interrupt_running(self.backend)
+
+    # controllerがcropを受け取れるなら、maskを空でない範囲だけにして送る
+    def wire_inputs(self, inputs: list[bytes],
+                    roles: tuple[str, ...]) -> tuple[list[bytes], list[Placement | None] | None]:
+        if CROP not in negotiated_formats(self.controller):
+            return inputs, None
+        return crop_masks(inputs, roles)
+
+    # アップロード、キュー待ち、推論、ダウンロードはcontrollerの中で行われるので、まとめて1段階として計測する
+    # prompt_idsには、coroを作るときにcontroller_argumentsが記録したpromptのidを渡す
+    async def call(self, coro, prompt_ids: list[str]):
+        if self.request_slots is not None:
+            try:
+                with stage("backend slot wait"):
+                    await self.request_slots.acquire()
+            except asyncio.CancelledError:
+                coro.close()
+                raise
+        try:
+            with stage("backend"):
+                return await coro
+        except asyncio.CancelledError:
+            await self.interrupt(prompt_ids)
+            raise
+        finally:
+            if self.request_slots is not None:
+                self.request_slots.release()
+
+    async def scribble_to_line(self, scribble: bytes, lineart: bytes, parameters: dict | None = None) -> bytes:
+        (scribble, lineart), placements = self.wire_inputs([scribble, lineart], SCRIBBLE_TO_LINE_ROLES)
+        prompt_ids = []
+        scribble_to_line_buffers = getattr(self.controller, "scribble_to_line_buffers", None)
+        if scribble_to_line_buffers is not None:
+            arguments = controller_arguments(scribble_to_line_buffers, preview_callback(), parameters, placements,
+                                             prompt_ids)
+            return await self.call(scribble_to_line_buffers(scribble, lineart, **arguments), prompt_ids)
+
+        with tempfile.TemporaryDirectory(prefix="diffusion_drawing_", dir=spool_root()) as spool_dir:
+            scribble_path = os.path.join(spool_dir, "scribble.png")
+            lineart_path = os.path.join(spool_dir, "lineart.png")
+            output_path = os.path.join(spool_dir, "output.png")
+            with stage("spool write"):
+                write_file(scribble_path, scribble)
+                write_file(lineart_path, lineart)
+
+            arguments = controller_arguments(self.controller.scribble_to_line, preview_callback(), parameters,
+                                             placements, prompt_ids)
+            await self.call(self.controller.scribble_to_line(scribble_path, lineart_path, output_path, **arguments),
+                            prompt_ids)
+            with stage("spool read"):
+                return read_file(output_path)
+
+    async def detail_colored(self, image: bytes, basecolor_image: bytes, lineart: bytes, basecolor: bytes,
+                             shadow: bytes, light: bytes, parameters: dict | None = None) -> tuple[bytes, bytes]:
+        inputs, placements = self.wire_inputs([image, basecolor_image, lineart, basecolor, shadow, light],
+                                              DETAIL_COLORED_ROLES)
+        prompt_ids = []
+        detail_colored_buffers = getattr(self.controller, "detail_colored_buffers", None)
+        if detail_colored_buffers is not None:
+            arguments = controller_arguments(detail_colored_buffers, preview_callback(), parameters, placements,
+                                             prompt_ids)
+            return await self.call(detail_colored_buffers(*inputs, **arguments), prompt_ids)
+
+        with tempfile.TemporaryDirectory(prefix="diffusion_drawing_", dir=spool_root()) as spool_dir:
+            input_paths = {}
+            with stage("spool write"):
+                for name, data in zip(DETAIL_INPUT_NAMES, inputs):
+                    input_paths[name] = os.path.join(spool_dir, f"{name}.png")
+                    write_file(input_paths[name], data)
+            shadow_output_path = os.path.join(spool_dir, "shadow_output.png")
+            light_output_path = os.path.join(spool_dir, "light_output.png")
+
+            await self.call(self.controller.detail_colored(
+                input_paths["image"],
+                input_paths["basecolor_image"],
+                input_paths["lineart"],
+                input_paths["basecolor"],
+                input_paths["shadow"],
+                input_paths["light"],
+                shadow_output_path,
+                light_output_path,
+                **controller_arguments(self.controller.detail_colored, preview_callback(), parameters, placements,
+                                       prompt_ids)), prompt_ids)
+            with stage("spool read"):
+                return read_file(shadow_output_path), read_file(light_output_path)
+
+    # 複数のseedで同じ入力から生成する
+    # controllerがまとめて受け取れれば、入力の前処理やVAE encodeを1回にしてseedの数だけのbatchで1回推論してもらう
+    # 受け取れなければseedをparametersで渡してseedごとに通常の生成を呼ぶ (書き出した入力はそのまま使いまわす)
+    async def detail_colored_variants(self, image: bytes, basecolor_image: bytes, lineart: bytes, basecolor: bytes,
+                                      shadow: bytes, light: bytes, seeds: list[int],
+                                      parameters: dict | None = None) -> list[tuple[bytes, bytes]]:
+        inputs = [image, basecolor_image, lineart, basecolor, shadow, light]
+        detail_colored_variants = getattr(self.controller, "detail_colored_variants", None)
+        detail_colored_variants_buffers = getattr(self.controller, "detail_colored_variants_buffers", None)
+        if detail_colored_variants is None and detail_colored_variants_buffers is None:
+            if not supports_variants(self.controller):
+                raise RuntimeError("the backend cannot generate with a given seed")
+            return list(await asyncio.gather(*[
+                self.detail_colored(*inputs, parameters={**(parameters or {}), "seed": seed}) for seed in seeds]))
+
+        inputs, placements = self.wire_inputs(inputs, DETAIL_COLORED_ROLES)
+        prompt_ids = []
+        if detail_colored_variants_buffers is not None:
+            arguments = controller_arguments(detail_colored_variants_buffers, preview_callback(), parameters,
+                                             placements, prompt_ids)
+            outputs = await self.call(detail_colored_variants_buffers(*inputs, seeds, **arguments), prompt_ids)
+            return [(shadow_output, light_output) for shadow_output, light_output in outputs]
+
+        with tempfile.TemporaryDirectory(prefix="diffusion_drawing_", dir=spool_root()) as spool_dir:
+            input_paths = []
+            with stage("spool write"):
+                for name, data in zip(DETAIL_INPUT_NAMES, inputs):
+                    input_paths.append(os.path.join(spool_dir, f"{name}.png"))
+                    write_file(input_paths[-1], data)
+            output_paths = [(os.path.join(spool_dir, f"shadow_output_{i}.png"),
+                             os.path.join(spool_dir, f"light_output_{i}.png")) for i in range(len(seeds))]
+
+            arguments = controller_arguments(detail_colored_variants, preview_callback(), parameters, placements,
+                                             prompt_ids)
+            await self.call(detail_colored_variants(*input_paths, seeds, output_paths, **arguments), prompt_ids)
+            with stage("spool read"):
+                return [(read_file(shadow_path), read_file(light_path)) for shadow_path, light_path in output_paths]
@@ -1,63 +1,33 @@
 import asyncio
-import os
-import shutil
-import tempfile
-from dataclasses import dataclass
-from typing import Coroutine
+from typing import Callable, Coroutine
 
 import krita
 from PyQt5.QtCore import *
+from PyQt5.QtGui import QIcon, QPixmap
 from PyQt5.QtWidgets import *
 
-from .diffusion_controller import DiffusionController
+from .dirty_region import Region
+from .engine import (LIGHT_COLOR_LABEL, LINEART_COLOR_LABEL, LINEART_FILE_NAME, SHADOW_COLOR_LABEL, SHADOW_FILE_NAME,
+                     DiffusionEngine, SystemLayers)
+from .instrumentation import Trace
+from .job_scheduler import JobScheduler
+from .preview_stream import DEFAULT_PREVIEW_INTERVAL_MSEC
+from .qt_event_loop import install_event_loop
+from .variants import DEFAULT_VARIANT_COUNT, MAX_VARIANT_COUNT, THUMBNAIL_SIZE, variant_thumbnail
 
-EMBEDDED_EMPTY_IMAGE_FILE_NAME = "empty.png"
-
-DIFFUSION_DRAWING_LAYER_MARKER = "[DiffusionDrawing SystemLayer]"
-LINEART_LAYER_NAME = f"lineart{DIFFUSION_DRAWING_LAYER_MARKER}"
-SHADOW_LAYER_NAME = f"shadow{DIFFUSION_DRAWING_LAYER_MARKER}"
-LIGHT_LAYER_NAME = f"light{DIFFUSION_DRAWING_LAYER_MARKER}"
-
-LINEART_FILE_NAME = "lineart.png"
-SHADOW_FILE_NAME = "shadow.png"
-LIGHT_FILE_NAME = "light.png"
-
-SYSTEM_LAYER_DEFAULT_OPACITY = 127
-
-SCRIBBLE_COLOR_LABEL = 1
-LINEART_COLOR_LABEL = 2
-BASE_COLOR_COLOR_LABEL = 3
-SHADOW_COLOR_LABEL = 4
-LIGHT_COLOR_LABEL = 5
-
-
-def hide_layers(node: krita.Node, allow_labels: list[int]):
-    if node.type() != "grouplayer" and node.colorLabel() not in allow_labels:
-        node.setVisible(False)
-    for n in node.childNodes():
-        hide_layers(n, allow_labels)
-
-
-@dataclass
-class SystemLayers:
-    tmp_dir: str
-    lineart: QUuid | None = None
-    shadow: QUuid | None = None
-    light: QUuid | None = None
+# draftの後のフル解像度の生成は、draftとは別のlaneで待たせる
+REFINE_LANE_SUFFIX = ":refine"
 
 
 class DiffusionDrawingDocker(krita.DockWidget):
     def __init__(self):
         super().__init__()
-        self.diffusion_controller = DiffusionController()
-
+        self.engine = DiffusionEngine(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), self.log)
         self.active_document: krita.Document = None
-        self.document_nodes_map: dict[QUuid, SystemLayers] = {}
 
-        self.event_loop = asyncio.get_event_loop()
-        self.async_timer = QTimer(self)
-        self.async_timer.timeout.connect(self.asyncio_step)
-        self.async_timer.start(10)
+        self.event_loop, self.polling_driver = install_event_loop(self)
+        self.engine.start()
+        self.job_scheduler = JobScheduler(on_idle=self.enable_buttons)
 
         self.setWindowTitle("DiffusionDrawing Control Panel")
 
@@ -109,19 +79,116 @@ class DiffusionDrawingDocker(krita.DockWidget):
         self.main_area.layout().addWidget(light_label, 2, 0)
         self.main_area.layout().addWidget(self.light_transfer_toggle, 2, 1)
 
+        # row=3に3つまとめてのTransferを配置
+        self.transfer_all_button = QPushButton("Transfer All")
+        self.transfer_all_button.clicked.connect(self.transfer_all)
+        self.main_area.layout().addWidget(self.transfer_all_button, 3, 1)
+
+        # tile
+        self.tiled_toggle = QCheckBox("Tiled")
+        self.tiled_toggle.stateChanged.connect(lambda state: self.handle_tile_settings())
+        self.tile_size_box = QSpinBox()
+        self.tile_size_box.setRange(256, 4096)
+        self.tile_size_box.setSingleStep(64)
+        self.tile_size_box.setSuffix("px")
+        self.tile_size_box.setValue(self.engine.tile_settings.tile_size)
+        self.tile_size_box.valueChanged.connect(lambda value: self.handle_tile_settings())
+        self.tile_overlap_box = QSpinBox()
+        self.tile_overlap_box.setRange(0, 1024)
+        self.tile_overlap_box.setSingleStep(16)
+        self.tile_overlap_box.setPrefix("overlap ")
+        self.tile_overlap_box.setSuffix("px")
+        self.tile_overlap_box.setValue(self.engine.tile_settings.overlap)
+        self.tile_overlap_box.valueChanged.connect(lambda value: self.handle_tile_settings())
+
+        # row=4にtile関連を配置
+        self.main_area.layout().addWidget(self.tiled_toggle, 4, 0)
+        self.main_area.layout().addWidget(self.tile_size_box, 4, 1)
+        self.main_area.layout().addWidget(self.tile_overlap_box, 4, 2)
+
+        # preview
+        self.preview_toggle = QCheckBox("Preview")
+        self.preview_interval_box = QSpinBox()
+        self.preview_interval_box.setRange(50, 5000)
+        self.preview_interval_box.setSingleStep(50)
+        self.preview_interval_box.setPrefix("every ")
+        self.preview_interval_box.setSuffix("ms")
+        self.preview_interval_box.setValue(DEFAULT_PREVIEW_INTERVAL_MSEC)
+        self.preview_toggle.stateChanged.connect(lambda state: self.handle_preview_settings())
+        self.preview_interval_box.valueChanged.connect(lambda value: self.handle_preview_settings())
+
+        # row=5にpreview関連を配置
+        self.main_area.layout().addWidget(self.preview_toggle, 5, 0)
+        self.main_area.layout().addWidget(self.preview_interval_box, 5, 1)
+
+        # draft
+        self.draft_toggle = QCheckBox("Draft")
+        self.draft_toggle.stateChanged.connect(lambda state: self.handle_draft_settings())
+        self.draft_scale_box = QSpinBox()
+        self.draft_scale_box.setRange(10, 100)
+        self.draft_scale_box.setSingleStep(5)
+        self.draft_scale_box.setSuffix("%")
+        self.draft_scale_box.setValue(round(self.engine.draft_settings.scale * 100))
+        self.draft_scale_box.valueChanged.connect(lambda value: self.handle_draft_settings())
+        self.refine_delay_box = QSpinBox()
+        self.refine_delay_box.setRange(0, 60000)
+        self.refine_delay_box.setSingleStep(500)
+        self.refine_delay_box.setPrefix("refine after ")
+        self.refine_delay_box.setSuffix("ms")
+        self.refine_delay_box.setValue(round(self.engine.draft_settings.refine_delay * 1000))
+        self.refine_delay_box.valueChanged.connect(lambda value: self.handle_draft_settings())
+
+        # row=6にdraft関連を配置
+        self.main_area.layout().addWidget(self.draft_toggle, 6, 0)
+        self.main_area.layout().addWidget(self.draft_scale_box, 6, 1)
+        self.main_area.layout().addWidget(self.refine_delay_box, 6, 2)
+
+        # variants
+        variants_label = QLabel("variants")
+        self.variant_count_box = QSpinBox()
+        self.variant_count_box.setRange(2, MAX_VARIANT_COUNT)
+        self.variant_count_box.setValue(DEFAULT_VARIANT_COUNT)
+        self.gen_variants_button = QPushButton("Gen")
+        self.gen_variants_button.clicked.connect(self.gen_detail_variants)
+        self.variant_strip = QListWidget()
+        self.variant_strip.setViewMode(QListView.IconMode)
+        self.variant_strip.setFlow(QListView.LeftToRight)
+        self.variant_strip.setWrapping(False)
+        self.variant_strip.setIconSize(THUMBNAIL_SIZE)
+        self.variant_strip.setFixedHeight(THUMBNAIL_SIZE.height() + 48)
+        self.variant_strip.itemClicked.connect(lambda item: self.select_variant(self.variant_strip.row(item)))
+
+        # row=7,8にshadow/lightの候補の生成と選択を配置
+        self.main_area.layout().addWidget(variants_label, 7, 0)
+        self.main_area.layout().addWidget(self.variant_count_box, 7, 1)
+        self.main_area.layout().addWidget(self.gen_variants_button, 7, 2)
+        self.main_area.layout().addWidget(self.variant_strip, 8, 0, 1, 3)
+
+        # row=9に計測結果の書き出しを配置
+        self.export_trace_button = QPushButton("Export Trace")
+        self.export_trace_button.clicked.connect(self.export_trace)
+        self.main_area.layout().addWidget(self.export_trace_button, 9, 0, 1, 3)
+
         self.log_window = QTextBrowser(self.main_widget)
         self.log_window.setReadOnly(True)
         self.main_widget.layout().addWidget(self.log_window)
 
+        if self.engine.backend_pool_error is not None:
+            self.log(self.engine.backend_pool_error)
+        if not self.engine.supports_variants:
+            self.variant_count_box.setEnabled(False)
+            self.gen_variants_button.setEnabled(False)
+            self.variant_strip.setEnabled(False)
+            self.log("variants are not supported: the backend cannot generate with a given seed")
+        if not self.engine.supports_preview:
+            self.preview_toggle.setEnabled(False)
+            self.preview_interval_box.setEnabled(False)
+            self.log("preview is not supported: the backend does not stream previews while generating")
+
         self.setup_area_none()
 
     def __del__(self):
-        for system_layers in self.document_nodes_map.values():
-            os.removedirs(system_layers.tmp_dir)
-
-    def asyncio_step(self):
-        self.event_loop.call_soon(self.event_loop.stop)
-        self.event_loop.run_forever()
+        self.engine.close()
 
     def clear_setup_area(self):
         for i in reversed(range(self.setup_area.layout().count())):
@@ -153,14 +220,13 @@ class DiffusionDrawingDocker(krita.DockWidget):
         if self.initialize_button is not None:
             self.initialize_button.setEnabled(False)
 
-        self.gen_lineart_button.setEnabled(False)
-        self.gen_detail_button.setEnabled(False)
         self.lineart_transfer_toggle.setChecked(False)
         self.shadow_transfer_toggle.setChecked(False)
         self.light_transfer_toggle.setChecked(False)
         self.lineart_transfer_toggle.setEnabled(False)
         self.shadow_transfer_toggle.setEnabled(False)
         self.light_transfer_toggle.setEnabled(False)
+        self.transfer_all_button.setEnabled(False)
 
     def enable_buttons(self):
         if self.initialize_button is not None:
@@ -168,325 +234,250 @@ class DiffusionDrawingDocker(krita.DockWidget):
 
         self.gen_lineart_button.setEnabled(True)
         self.gen_detail_button.setEnabled(True)
+        self.gen_variants_button.setEnabled(self.engine.supports_variants)
         self.lineart_transfer_toggle.setEnabled(True)
         self.shadow_transfer_toggle.setEnabled(True)
         self.light_transfer_toggle.setEnabled(True)
+        self.transfer_all_button.setEnabled(True)
+
+    def handle_tile_settings(self):
+        tile_settings = self.engine.tile_settings
+        tile_settings.enabled = self.tiled_toggle.isChecked()
+        tile_settings.tile_size = self.tile_size_box.value()
+        # 重なりがタイルより大きいと進まなくなるので半分までにする
+        tile_settings.overlap = min(self.tile_overlap_box.value(), self.tile_size_box.value() // 2)
 
-    def export_image_filtered_color_label(self, allow_labels: list[int], alpha: bool, output_path: str):
-        document = self.active_document.clone()
-        hide_layers(document.rootNode(), allow_labels)
-        output_info = krita.InfoObject()
-        output_info.setProperties(
-            {"alpha": alpha, "compression": 1, "forceSRGB": False, "indexed": False, "interlaced": False,
-             "saveSRGBProfile": False, "transparencyFillcolor": [255, 255, 255]})
-        document.refreshProjection()
-        document.waitForDone()
-        document.setBatchmode(True)
-
-        document.exportImage(output_path, output_info)
-
-    def apply_layer_mask_filtered_color_label(self, allow_labels: list[int]):
-        def traverse(node: krita.Node):
-            if node.type() == "grouplayer":
-                for n in node.childNodes():
-                    traverse(n)
-            elif node.colorLabel() in allow_labels:
-                bounds = node.bounds()
-                pixels = node.projectionPixelData(bounds.left(), bounds.top(), bounds.width(), bounds.height())
-
-                node.setPixelData(pixels, bounds.left(), bounds.top(), bounds.width(), bounds.height())
-                for n in node.childNodes():
-                    node.removeChildNode(n)
-
-        traverse(self.active_document.rootNode())
-
-    def create_transparency_mask_from_layer_filtered_color_label(self, allow_labels: list[int], base_layer: krita.Node):
-        base_layer_blending_mode = base_layer.blendingMode()
-        base_layer.setBlendingMode("normal")
-        self.active_document.refreshProjection()
-        self.active_document.waitForDone()
-
-        width = self.active_document.width()
-        height = self.active_document.height()
-
-        base_layer_pixels = base_layer.projectionPixelData(0, 0, width, height)
-        base_layer.setBlendingMode(base_layer_blending_mode)
-
-        def traverse(node: krita.Node):
-            if node.type() == "grouplayer":
-                for n in node.childNodes():
-                    traverse(n)
-            elif node.colorLabel() in allow_labels:
-                tmp_document = krita.Krita.instance().createDocument(
-                    width,
-                    height,
-                    "Image",
-                    self.active_document.colorModel(),
-                    self.active_document.colorDepth(),
-                    self.active_document.colorProfile(),
-                    self.active_document.resolution()
-                )
-                foreground_layer = tmp_document.rootNode().childNodes()[0]
-                tmp_document.rootNode().removeChildNode(foreground_layer)
-                foreground_layer.setInheritAlpha(True)
-
-                base_layer_clone = tmp_document.createNode("base_layer", "paintLayer")
-                base_layer_clone.setPixelData(base_layer_pixels, 0, 0, width, height)
-
-                pixels = node.projectionPixelData(0, 0, width, height)
-                n = tmp_document.createNode("l", "paintLayer")
-                n.setPixelData(pixels, 0, 0, width, height)
-
-                tmp_document.rootNode().addChildNode(base_layer_clone, None)
-                tmp_document.rootNode().addChildNode(n, None)
-                tmp_document.rootNode().addChildNode(foreground_layer, None)
-                tmp_document.refreshProjection()
-                tmp_document.waitForDone()
-
-                s = krita.Selection()
-                s.select(0, 0, width, height, 255)
-                binarize_filter = tmp_document.createFilterMask("binarize_filter_mask",
-                                                                krita.Krita.instance().filter("levels"), s)
-                n.addChildNode(binarize_filter, None)
-                binarize_filter.filter().configuration().setProperties(
-                    {'blackvalue': 0, 'channel_0': '0;1;1;0;1', 'channel_1': '0;1;1;0;1', 'channel_2': '0;1;1;0;1',
-                     'channel_3': '0;1;1;0;1', 'channel_4': '0;1;1;0;1', 'channel_5': '0;1;1;0;1',
-                     'channel_6': '0;1;1;0;1', 'channel_7': '0;1;1;0;1', 'gammavalue': 1.0,
-                     'histogram_mode': 'logarithmic', 'lightness': '0;1;1;0;1', 'mode': 'channels',
-                     'number_of_channels': 8, 'outblackvalue': 0, 'outwhitevalue': 255, 'whitevalue': 255})
-                binarize_filter.filter().configuration().setProperty("channel_4", "0;1;10;0;1")
-
-                s = krita.Selection()
-                s.select(0, 0, width, height, 255)
-                binarize_filter = tmp_document.createFilterMask("binarize_filter_mask",
-                                                                krita.Krita.instance().filter("levels"), s)
-                n.addChildNode(binarize_filter, None)
-                binarize_filter.filter().configuration().setProperties(
-                    {'blackvalue': 0, 'channel_0': '0;1;1;0;1', 'channel_1': '0;1;1;0;1', 'channel_2': '0;1;1;0;1',
-                     'channel_3': '0;1;1;0;1', 'channel_4': '0;1;1;0;1', 'channel_5': '0;1;1;0;1',
-                     'channel_6': '0;1;1;0;1', 'channel_7': '0;1;1;0;1', 'gammavalue': 1.0,
-                     'histogram_mode': 'logarithmic', 'lightness': '0;1;1;0;1', 'mode': 'channels',
-                     'number_of_channels': 8, 'outblackvalue': 0, 'outwhitevalue': 255, 'whitevalue': 255})
-                binarize_filter.filter().configuration().setProperty("channel_4", "0;1;10;0;1")
-
-                tmp_document.refreshProjection()
-                tmp_document.waitForDone()
-
-                pixels = tmp_document.rootNode().projectionPixelData(0, 0, width, height)
-                base_layer_clone.setPixelData(pixels, 0, 0, width, height)
-                tmp_document.rootNode().removeChildNode(n)
-                tmp_document.rootNode().removeChildNode(foreground_layer)
-                tmp_document.refreshProjection()
-                tmp_document.waitForDone()
-                tmp_document.setColorSpace("A", "U8", "")
-                tmp_document.refreshProjection()
-                tmp_document.waitForDone()
-
-                pixels = tmp_document.rootNode().projectionPixelData(0, 0, width, height)
-
-                transparency_mask = self.active_document.createTransparencyMask("mask")
-                transparency_mask.setPixelData(pixels, 0, 0, width, height)
-                transparency_mask.setLocked(True)
-                node.addChildNode(transparency_mask, None)
-
-        traverse(self.active_document.rootNode())
-        self.active_document.refreshProjection()
-        self.active_document.waitForDone()
-        pass
+    def handle_draft_settings(self):
+        draft_settings = self.engine.draft_settings
+        draft_settings.enabled = self.draft_toggle.isChecked()
+        draft_settings.scale = self.draft_scale_box.value() / 100
+        draft_settings.refine_delay = self.refine_delay_box.value() / 1000
+
+    def handle_preview_settings(self):
+        self.engine.preview_settings.enabled = self.preview_toggle.isChecked()
+        self.engine.preview_settings.interval = self.preview_interval_box.value() / 1000
 
     def handle_lineart_transfer(self, transfer: bool):
-        self.apply_layer_mask_filtered_color_label([LINEART_COLOR_LABEL])
+        self.transfer("lineart_transfer", [(LINEART_COLOR_LABEL, self.system_layers().lineart, transfer)])
+
+    def handle_shadow_transfer(self, transfer: bool):
+        self.transfer("shadow_transfer", [(SHADOW_COLOR_LABEL, self.system_layers().shadow, transfer)])
+
+    def handle_light_transfer(self, transfer: bool):
+        self.transfer("light_transfer", [(LIGHT_COLOR_LABEL, self.system_layers().light, transfer)])
+
+    def system_layers(self) -> SystemLayers:
+        return self.engine.system_layers(self.active_document)
 
-        if transfer:
-            active_node = self.active_document.activeNode()
-            self.create_transparency_mask_from_layer_filtered_color_label(
-                [LINEART_COLOR_LABEL],
-                self.active_document.nodeByUniqueID(
-                    self.document_nodes_map[self.active_document.rootNode().uniqueId()].lineart))
-            self.active_document.setActiveNode(active_node)
+    def transfer(self, operation: str, transfers: list[tuple[int, QUuid, bool]]):
+        with self.engine.profiler.run(operation) as trace:
+            self.engine.transfer(self.active_document, transfers)
+        self.log_trace(trace)
+
+    @pyqtSlot(bool)
+    def transfer_all(self):
+        self.log("transfer_all")
+        if self.active_document is None:
+            return
+
+        # checkboxの表示だけ合わせて、個別のhandlerは呼ばない
+        for toggle in (self.lineart_transfer_toggle, self.shadow_transfer_toggle, self.light_transfer_toggle):
+            toggle.blockSignals(True)
+            toggle.setChecked(True)
+            toggle.blockSignals(False)
+
+        with self.engine.profiler.run("transfer_all") as trace:
+            self.engine.transfer_all(self.active_document)
+        self.log_trace(trace)
 
     @pyqtSlot(bool)
     def gen_lineart(self):
         self.log("gen_lineart")
-        self.spawn_future(self.gen_lineart_inner())
-
-    async def gen_lineart_inner(self):
         if self.active_document is None:
             return
 
-        try:
-            self.disable_buttons()
-            lineart_output_path = os.path.join(
-                self.document_nodes_map[self.active_document.rootNode().uniqueId()].tmp_dir,
-                LINEART_FILE_NAME)
-
-            with tempfile.NamedTemporaryFile(suffix=".png") as scribble_file:
-                with tempfile.NamedTemporaryFile(suffix=".png") as lineart_file:
-                    self.export_image_filtered_color_label([SCRIBBLE_COLOR_LABEL], False, scribble_file.name)
-                    self.export_image_filtered_color_label([LINEART_COLOR_LABEL], True, lineart_file.name)
+        document = self.active_document
+        self.submit_generation((document.rootNode().uniqueId(), LINEART_FILE_NAME),
+                               lambda: self.gen_lineart_inner(document), lambda: self.gen_lineart_draft(document))
 
-                    await self.diffusion_controller.scribble_to_line(
-                        scribble_file.name, lineart_file.name, lineart_output_path)
+    async def gen_lineart_inner(self, document: krita.Document):
+        with self.engine.profiler.run("gen_lineart") as trace:
+            regions = await self.engine.gen_lineart(document)
+        self.log_regions(regions)
+        self.log_trace(trace)
 
-            self.lineart_transfer_toggle.setChecked(False)
-        finally:
-            self.enable_buttons()
+        self.lineart_transfer_toggle.setChecked(False)
 
-    def handle_shadow_transfer(self, transfer: bool):
-        self.apply_layer_mask_filtered_color_label([SHADOW_COLOR_LABEL])
+    async def gen_lineart_draft(self, document: krita.Document):
+        with self.engine.profiler.run("gen_lineart_draft") as trace:
+            await self.engine.gen_lineart_draft(document)
+        self.log_trace(trace)
 
-        if transfer:
-            active_node = self.active_document.activeNode()
-            self.create_transparency_mask_from_layer_filtered_color_label(
-                [SHADOW_COLOR_LABEL],
-                self.active_document.nodeByUniqueID(
-                    self.document_nodes_map[self.active_document.rootNode().uniqueId()].shadow))
-            self.active_document.setActiveNode(active_node)
+        self.lineart_transfer_toggle.setChecked(False)
 
     @pyqtSlot(bool)
     def gen_detail_colored(self):
         self.log("gen_detail_colored")
-        self.spawn_future(self.gen_detail_inner())
-        pass
+        if self.active_document is None:
+            return
 
-    def handle_light_transfer(self, transfer: bool):
-        self.apply_layer_mask_filtered_color_label([LIGHT_COLOR_LABEL])
+        document = self.active_document
+        self.submit_generation((document.rootNode().uniqueId(), SHADOW_FILE_NAME),
+                               lambda: self.gen_detail_inner(document), lambda: self.gen_detail_draft(document))
 
-        if transfer:
-            active_node = self.active_document.activeNode()
-            self.create_transparency_mask_from_layer_filtered_color_label(
-                [LIGHT_COLOR_LABEL],
-                self.active_document.nodeByUniqueID(
-                    self.document_nodes_map[self.active_document.rootNode().uniqueId()].light))
-            self.active_document.setActiveNode(active_node)
+    async def gen_detail_inner(self, document: krita.Document):
+        with self.engine.profiler.run("gen_detail_colored") as trace:
+            regions = await self.engine.gen_detail(document)
+        self.log_regions(regions)
+        self.log_trace(trace)
 
-    async def gen_detail_inner(self):
+        self.shadow_transfer_toggle.setChecked(False)
+        self.light_transfer_toggle.setChecked(False)
+
+    async def gen_detail_draft(self, document: krita.Document):
+        with self.engine.profiler.run("gen_detail_colored_draft") as trace:
+            await self.engine.gen_detail_draft(document)
+        self.log_trace(trace)
+
+        self.shadow_transfer_toggle.setChecked(False)
+        self.light_transfer_toggle.setChecked(False)
+
+    @pyqtSlot(bool)
+    def gen_detail_variants(self):
+        self.log("gen_detail_variants")
         if self.active_document is None:
             return
+        if not self.engine.supports_variants:
+            self.log("variants are not supported: the backend cannot generate with a given seed")
+            return
 
-        try:
-            self.disable_buttons()
-            shadow_output_path = os.path.join(
-                self.document_nodes_map[self.active_document.rootNode().uniqueId()].tmp_dir,
-                SHADOW_FILE_NAME)
-            light_output_path = os.path.join(
-                self.document_nodes_map[self.active_document.rootNode().uniqueId()].tmp_dir,
-                LIGHT_FILE_NAME)
-
-            with tempfile.NamedTemporaryFile(suffix=".png") as image_file:
-                with tempfile.NamedTemporaryFile(suffix=".png") as basecolor_image_file:
-                    with tempfile.NamedTemporaryFile(suffix=".png") as lineart_file:
-                        with tempfile.NamedTemporaryFile(suffix=".png") as basecolor_file:
-                            with tempfile.NamedTemporaryFile(suffix=".png") as shadow_file:
-                                with tempfile.NamedTemporaryFile(suffix=".png") as light_file:
-                                    self.export_image_filtered_color_label(
-                                        [LINEART_COLOR_LABEL, BASE_COLOR_COLOR_LABEL,
-                                         SHADOW_COLOR_LABEL, LIGHT_COLOR_LABEL],
-                                        False, image_file.name)
-                                    self.export_image_filtered_color_label(
-                                        [LINEART_COLOR_LABEL, BASE_COLOR_COLOR_LABEL],
-                                        False, basecolor_image_file.name)
-                                    self.export_image_filtered_color_label([LINEART_COLOR_LABEL], True,
-                                                                           lineart_file.name)
-                                    self.export_image_filtered_color_label(
-                                        [BASE_COLOR_COLOR_LABEL], True, basecolor_file.name)
-                                    self.export_image_filtered_color_label([SHADOW_COLOR_LABEL], True, shadow_file.name)
-                                    self.export_image_filtered_color_label([LIGHT_COLOR_LABEL], True, light_file.name)
-
-                                    await self.diffusion_controller.detail_colored(
-                                        image_file.name,
-                                        basecolor_image_file.name,
-                                        lineart_file.name,
-                                        basecolor_file.name,
-                                        shadow_file.name,
-                                        light_file.name,
-                                        shadow_output_path,
-                                        light_output_path)
-
-            self.shadow_transfer_toggle.setChecked(False)
-            self.light_transfer_toggle.setChecked(False)
-        finally:
-            self.enable_buttons()
+        document = self.active_document
+        document_id = document.rootNode().uniqueId()
+        # 待っているrefineが選んだ候補を上書きしないように捨てる
+        self.job_scheduler.cancel((document_id, SHADOW_FILE_NAME + REFINE_LANE_SUFFIX))
+        self.submit_job((document_id, SHADOW_FILE_NAME), lambda: self.gen_detail_variants_inner(document))
+
+    async def gen_detail_variants_inner(self, document: krita.Document):
+        with self.engine.profiler.run("gen_detail_variants") as trace:
+            variants = await self.engine.gen_detail_variants(document, self.variant_count_box.value())
+        self.log(f"generated {len(variants)} variant(s)")
+        self.log(self.engine.result_cache.stats)
+        self.log_trace(trace)
+
+        if document == self.active_document:
+            self.show_variants()
+
+    def show_variants(self):
+        self.variant_strip.clear()
+        if self.active_document is None:
+            return
+        variant_set = self.engine.variants.get(self.active_document.rootNode().uniqueId())
+        if variant_set is None:
+            return
+        for variant in variant_set.variants:
+            item = QListWidgetItem(QIcon(QPixmap.fromImage(variant_thumbnail(variant))), f"seed {variant.seed}")
+            self.variant_strip.addItem(item)
+
+    def select_variant(self, index: int):
+        if self.active_document is None:
+            return
+        variant_set = self.engine.variants[self.active_document.rootNode().uniqueId()]
+        with self.engine.profiler.run("select_variant") as trace:
+            self.engine.select_variant(self.active_document, index)
+        self.log(f"selected seed {variant_set.variants[index].seed}")
+        self.log_trace(trace)
+
+        self.shadow_transfer_toggle.setChecked(False)
+        self.light_transfer_toggle.setChecked(False)
 
     @pyqtSlot(bool)
     def initialize_document(self):
         self.log("initialize_document")
-        document_id = self.active_document.rootNode().uniqueId()
-        if document_id not in self.document_nodes_map:
-            self.log("Open unknown document")
-            empty_image = os.path.join(os.path.dirname(__file__), EMBEDDED_EMPTY_IMAGE_FILE_NAME)
-            tmp_dir = tempfile.mkdtemp(prefix="diffusion_drawing_")
-
-            shutil.copy(empty_image, os.path.join(tmp_dir, LINEART_FILE_NAME))
-            shutil.copy(empty_image, os.path.join(tmp_dir, SHADOW_FILE_NAME))
-            shutil.copy(empty_image, os.path.join(tmp_dir, LIGHT_FILE_NAME))
-
-            self.document_nodes_map[document_id] = SystemLayers(tmp_dir)
-
-        system_layers = self.document_nodes_map[document_id]
-        rootNode = self.active_document.rootNode()
-        for n in filter(lambda n: n.name().find(DIFFUSION_DRAWING_LAYER_MARKER) != -1, rootNode.childNodes()):
-            rootNode.removeChildNode(n)
-
-        lineart_layer = self.active_document.createFileLayer(
-            LINEART_LAYER_NAME,
-            os.path.join(str(system_layers.tmp_dir), LINEART_FILE_NAME),
-            "ToImageSize")
-        lineart_layer.setOpacity(SYSTEM_LAYER_DEFAULT_OPACITY)
-        self.active_document.rootNode().addChildNode(lineart_layer, None)
-        lineart_layer.setLocked(True)
-        system_layers.lineart = lineart_layer.uniqueId()
-
-        shadow_layer = self.active_document.createFileLayer(
-            SHADOW_LAYER_NAME,
-            os.path.join(str(system_layers.tmp_dir), SHADOW_FILE_NAME),
-            "ToImageSize")
-        shadow_layer.setOpacity(SYSTEM_LAYER_DEFAULT_OPACITY)
-        shadow_layer.setBlendingMode("multiply")
-        self.active_document.rootNode().addChildNode(shadow_layer, None)
-        shadow_layer.setLocked(True)
-        system_layers.shadow = shadow_layer.uniqueId()
-
-        light_layer = self.active_document.createFileLayer(
-            LIGHT_LAYER_NAME,
-            os.path.join(str(system_layers.tmp_dir), LIGHT_FILE_NAME),
-            "ToImageSize")
-        light_layer.setOpacity(SYSTEM_LAYER_DEFAULT_OPACITY)
-        light_layer.setBlendingMode("add")
-        self.active_document.rootNode().addChildNode(light_layer, None)
-        light_layer.setLocked(True)
-        system_layers.light = light_layer.uniqueId()
-
+        self.engine.initialize_document(self.active_document)
         self.setup_area_ready()
 
-    def spawn_future(self, coro: Coroutine):
-        async def wrapper():
-            try:
-                await coro
-            except Exception as e:
-                self.log(e)
-                import traceback
-                traceback_str = traceback.format_exc()
-                self.log(traceback_str)
+    async def log_errors(self, coro: Coroutine):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            if self.engine.supports_interrupt:
+                self.log("cancelled")
+            else:
+                self.log("cancelled locally; the backend still finishes any request it has already received")
+            raise
+        except Exception as e:
+            self.log(e)
+            import traceback
+            traceback_str = traceback.format_exc()
+            self.log(traceback_str)
+
+    # 同じドキュメントの同じ操作がまだ終わっていなければ、それをキャンセルして新しい方を実行する
+    def submit_job(self, lane: tuple[QUuid, str], job: Callable[[], Coroutine]):
+        self.disable_buttons()
+        self.job_scheduler.submit(lane, lambda: self.log_errors(job()))
+
+    # draftモードでは縮小したdraftをすぐに表示し、手が止まったらフル解像度で生成しなおして置き換える
+    def submit_generation(self, lane: tuple[QUuid, str], generate: Callable[[], Coroutine],
+                          draft: Callable[[], Coroutine]):
+        document_id, name = lane
+        refine_lane = (document_id, name + REFINE_LANE_SUFFIX)
+        # 待っているrefineは古い入力のものなので捨てる
+        self.job_scheduler.cancel(refine_lane)
+        if not self.engine.draft_settings.enabled:
+            self.submit_job(lane, generate)
+            return
+
+        async def draft_then_refine():
+            await draft()
+            self.job_scheduler.submit(refine_lane, lambda: self.log_errors(generate()),
+                                      self.engine.draft_settings.refine_delay)
 
-        asyncio.ensure_future(wrapper())
+        self.submit_job(lane, draft_then_refine)
 
     # メインで開いているドキュメントが変わったときには呼ばれるらしい
     # @override
     def canvasChanged(self, canvas: krita.Canvas) -> None:
+        # 生成した後に保存されたドキュメントは、閉じられる前に結果を保存先のパスへ移しておく
+        self.engine.update_identities()
         active_document = krita.Krita.instance().activeDocument()
 
         if active_document == self.active_document:
             return
 
         self.active_document = active_document
+        self.show_variants()
 
         if self.active_document is None:
             self.setup_area_none()
-        elif self.active_document.rootNode().uniqueId() in self.document_nodes_map:
+        elif self.engine.is_initialized(self.active_document) or self.engine.restore_document(self.active_document):
             self.setup_area_ready()
         else:
             self.setup_area_initialize()
 
+    def log_regions(self, regions: list[Region] | None):
+        if regions is None:
+            self.log("regenerated whole canvas")
+        elif not regions:
+            self.log("no changes since last generation")
+        else:
+            self.log(f"regenerated {len(regions)} changed region(s)")
+        self.log(self.engine.result_cache.stats)
+
+    def log_trace(self, trace: Trace):
+        self.log(trace.breakdown())
+        self.log(self.engine.profiler.summary(trace.operation))
+
+    @pyqtSlot(bool)
+    def export_trace(self):
+        path, selected_filter = QFileDialog.getSaveFileName(
+            self, "Export Trace", "diffusion_drawing_trace.json", "Chrome trace (*.json);;Stage report (*.json)")
+        if not path:
+            return
+        if selected_filter.startswith("Stage report"):
+            self.engine.profiler.export_stage_report(path)
+        else:
+            self.engine.profiler.export_chrome_trace(path)
+        self.log(f"exported trace to {path}")
+
     def log(self, message: any) -> None:
         self.log_window.append(str(message))
@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import os
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Hashable
+
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QImage, QPainter
+
+from .instrumentation import stage
+from .label_export import LabelExport, decode_image, encode_png
+from .preview_stream import preview_area
+from .wire_format import encode_inputs
+
+TILE_SIZE = 128
+# 変更された範囲の周りにこれだけ余白をつけて生成し、境界の継ぎ目が出ないようにする
+REGION_OVERLAP = 64
+# diffusionモデルに渡す画像サイズはこの倍数にそろえる
+REGION_ALIGNMENT = 64
+# 変更範囲がキャンバスのこの割合を超えたら全体を生成しなおす
+FULL_REGENERATION_RATIO = 0.5
+
+Tile = tuple[int, int]
+
+
+def tile_hashes(image: QImage) -> dict[Tile, bytes]:
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    data = bits.asstring()
+    bytes_per_line = image.bytesPerLine()
+
+    hashes = {}
+    for ty in range((image.height() + TILE_SIZE - 1) // TILE_SIZE):
+        rows = range(ty * TILE_SIZE, min((ty + 1) * TILE_SIZE, image.height()))
+        for tx in range((image.width() + TILE_SIZE - 1) // TILE_SIZE):
+            left = tx * TILE_SIZE * 4
+            right = min((tx + 1) * TILE_SIZE, image.width()) * 4
+            h = hashlib.blake2b(digest_size=16)
+            for y in rows:
+                h.update(data[y * bytes_per_line + left:y * bytes_per_line + right])
+            hashes[(tx, ty)] = h.digest()
+    return hashes
+
+
+def group_tiles(tiles: set[Tile]) -> list[set[Tile]]:
+    groups = []
+    remaining = set(tiles)
+    while remaining:
+        stack = [remaining.pop()]
+        group = set(stack)
+        while stack:
+            tx, ty = stack.pop()
+            for neighbour in ((tx - 1, ty), (tx + 1, ty), (tx, ty - 1), (tx, ty + 1)):
+                if neighbour in remaining:
+                    remaining.remove(neighbour)
+                    group.add(neighbour)
+                    stack.append(neighbour)
+        groups.append(group)
+    return groups
+
+
+def align_span(start: int, end: int, limit: int) -> tuple[int, int]:
+    size = min(-(-(end - start) // REGION_ALIGNMENT) * REGION_ALIGNMENT, limit)
+    end = min(start + size, limit)
+    return end - size, end
+
+
+@dataclass
+class Region:
+    # 生成結果のうち書き戻す範囲
+    inner: QRect
+    # 生成に渡す範囲 (innerに余白をつけたもの)
+    outer: QRect
+
+
+def expand_region(inner: QRect, width: int, height: int) -> Region:
+    outer = inner.adjusted(-REGION_OVERLAP, -REGION_OVERLAP, REGION_OVERLAP, REGION_OVERLAP)
+    left, right = align_span(max(outer.left(), 0), min(outer.right() + 1, width), width)
+    top, bottom = align_span(max(outer.top(), 0), min(outer.bottom() + 1, height), height)
+    return Region(inner, QRect(left, top, right - left, bottom - top))
+
+
+def tiles_to_regions(tiles: set[Tile], width: int, height: int) -> list[Region]:
+    regions = []
+    for group in group_tiles(tiles):
+        inner = QRect()
+        for tx, ty in group:
+            inner = inner.united(QRect(tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+        regions.append(expand_region(inner.intersected(QRect(0, 0, width, height)), width, height))
+
+    # 余白をつけた範囲が重なるものはまとめて1回で生成する
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                if regions[i].outer.intersects(regions[j].outer):
+                    inner = regions[i].inner.united(regions[j].inner)
+                    regions[i] = expand_region(inner, width, height)
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+@dataclass
+class LabelSnapshot:
+    width: int
+    height: int
+    hashes: dict[LabelExport, dict[Tile, bytes]] = field(default_factory=dict)
+
+    # result storeに保存するためのJSONにできる形
+    def to_dict(self) -> dict:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "hashes": [{"labels": sorted(target.allow_labels), "alpha": target.alpha,
+                        "tiles": {f"{tx},{ty}": h.hex() for (tx, ty), h in hashes.items()}}
+                       for target, hashes in self.hashes.items()],
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "LabelSnapshot":
+        snapshot = LabelSnapshot(data["width"], data["height"])
+        for entry in data["hashes"]:
+            hashes = {}
+            for tile, h in entry["tiles"].items():
+                tx, ty = map(int, tile.split(","))
+                hashes[(tx, ty)] = bytes.fromhex(h)
+            snapshot.hashes[LabelExport.of(entry["labels"], entry["alpha"])] = hashes
+        return snapshot
+
+
+# 前回生成したときの入力をタイルごとのハッシュで覚えておき、変わった範囲を求める
+class DirtyRegionTracker:
+    def __init__(self):
+        self.snapshots: dict[Hashable, LabelSnapshot] = {}
+
+    def snapshot(self, images: dict[LabelExport, QImage]) -> LabelSnapshot:
+        image = next(iter(images.values()))
+        snapshot = LabelSnapshot(image.width(), image.height())
+        for target, image in images.items():
+            snapshot.hashes[target] = tile_hashes(image)
+        return snapshot
+
+    # 全体を生成しなおすべきときはNoneを返す
+    def changed_regions(self, key: Hashable, snapshot: LabelSnapshot) -> list[Region] | None:
+        previous = self.snapshots.get(key)
+        if previous is None or (previous.width, previous.height) != (snapshot.width, snapshot.height):
+            return None
+        if previous.hashes.keys() != snapshot.hashes.keys():
+            return None
+
+        dirty = set()
+        for target, hashes in snapshot.hashes.items():
+            previous_hashes = previous.hashes[target]
+            dirty.update(tile for tile, h in hashes.items() if previous_hashes.get(tile) != h)
+
+        regions = tiles_to_regions(dirty, snapshot.width, snapshot.height)
+        area = sum(region.outer.width() * region.outer.height() for region in regions)
+        if area > snapshot.width * snapshot.height * FULL_REGENERATION_RATIO:
+            return None
+        return regions
+
+    def commit(self, key: Hashable, snapshot: LabelSnapshot):
+        self.snapshots[key] = snapshot
+
+    def reset(self, key: Hashable):
+        self.snapshots.pop(key, None)
+
+
+def paste_region(output: QImage, patch: QImage, region: Region):
+    if patch.size() != region.outer.size():
+        patch = patch.scaled(region.outer.size())
+    painter = QPainter(output)
+    painter.setCompositionMode(QPainter.CompositionMode_Source)
+    source = region.inner.translated(-region.outer.topLeft())
+    painter.drawImage(region.inner.topLeft(), patch, source)
+    painter.end()
+
+
+# 変更された範囲だけを生成して、既存の出力ファイルに書き戻す
+# generateは inputs の順に並べた入力画像を受け取り、output_paths の順に出力画像を返す
+# 入力画像はcontrollerと取り決めた formats で書き出す (alpha maskの入力はalphaだけにできる)
+async def regenerate(tracker: DirtyRegionTracker, key: Hashable, images: dict[LabelExport, QImage],
+                     inputs: list[LabelExport], roles: tuple[str, ...], output_paths: list[str],
+                     generate: Callable[[list[bytes]], Awaitable[tuple[bytes, ...]]],
+                     formats: frozenset[str] = frozenset()) -> list[Region] | None:
+    with stage("tile hashing"):
+        snapshot = tracker.snapshot(images)
+    regions = tracker.changed_regions(key, snapshot)
+    if regions is not None and not all(os.path.exists(path) for path in output_paths):
+        regions = None
+
+    if regions is None:
+        outputs = await generate(encode_inputs(images, inputs, roles, formats))
+        with stage("result write"):
+            for output_path, output in zip(output_paths, outputs):
+                with open(output_path, "wb") as f:
+                    f.write(output)
+    elif regions:
+        async def generate_region(region: Region) -> tuple[bytes, ...]:
+            with preview_area(region.outer):
+                return await generate(encode_inputs(images, inputs, roles, formats, region.outer))
+
+        patches = await asyncio.gather(*[generate_region(region) for region in regions])
+        for i, output_path in enumerate(output_paths):
+            with stage("result composite"):
+                output = QImage(output_path).convertToFormat(QImage.Format_ARGB32)
+                if output.size() != images[inputs[0]].size():
+                    output = output.scaled(images[inputs[0]].size())
+                for region, patch in zip(regions, patches):
+                    paste_region(output, decode_image(patch[i]), region)
+            data = encode_png(output)
+            with stage("result write"):
+                with open(output_path, "wb") as f:
+                    f.write(data)
+
+    tracker.commit(key, snapshot)
+    return regions
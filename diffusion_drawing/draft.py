@@ -0,0 +1,51 @@
+from dataclasses import dataclass
+
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QImage
+
+from .instrumentation import stage
+from .label_export import LabelExport, decode_image
+from .wire_format import encode_inputs
+
+DEFAULT_DRAFT_SCALE = 0.5
+DEFAULT_REFINE_DELAY = 2.0
+# draftではstep数を減らして、構図や光の当たり方が分かる程度で止める
+DRAFT_STEPS = 8
+# latentは1/8の解像度になるので、縮小後のサイズも8の倍数にそろえる
+DRAFT_ALIGNMENT = 8
+MIN_DRAFT_SIZE = 64
+
+
+@dataclass
+class DraftSettings:
+    enabled: bool = False
+    scale: float = DEFAULT_DRAFT_SCALE
+    # 最後のdraftからこの秒数だけ次のdraftが来なければ、フル解像度で生成しなおす
+    refine_delay: float = DEFAULT_REFINE_DELAY
+
+    # controllerがparametersを受け取れるときにだけ渡る (受け取れなければ小さい画像で通常の生成をする)
+    def parameters(self) -> dict:
+        return {"draft": True, "steps": DRAFT_STEPS}
+
+
+def draft_length(length: int, scale: float) -> int:
+    scaled = round(length * scale / DRAFT_ALIGNMENT) * DRAFT_ALIGNMENT
+    return min(max(scaled, MIN_DRAFT_SIZE), length)
+
+
+def draft_size(size: QSize, scale: float) -> QSize:
+    return QSize(draft_length(size.width(), scale), draft_length(size.height(), scale))
+
+
+def draft_buffers(images: dict[LabelExport, QImage], inputs: list[LabelExport], roles: tuple[str, ...],
+                  scale: float, formats: frozenset[str]) -> list[bytes]:
+    with stage("draft downscale"):
+        size = draft_size(images[inputs[0]].size(), scale)
+        scaled = {target: images[target].scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+                  for target in inputs}
+    return encode_inputs(scaled, inputs, roles, formats)
+
+
+def upscale_draft(data: bytes, size: QSize) -> QImage:
+    with stage("draft upscale"):
+        return decode_image(data).scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
@@ -0,0 +1,689 @@
+import os
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Callable, Coroutine
+
+import krita
+from PyQt5.QtCore import QByteArray, QRect, QSize, QUuid
+from PyQt5.QtGui import QImage
+
+from .alpha_mask import PixelFormat, alpha_digest, fill_transparency_mask, mask_signature, read_alpha
+from .backend_pool import BackendPool, configured_backend_addresses, parse_address, single_backend_address
+from .buffered_controller import BufferedDiffusionController, supports_interrupt, supports_preview, supports_variants
+from .diffusion_controller import DiffusionController
+from .dirty_region import DirtyRegionTracker, Region, regenerate
+from .draft import DraftSettings, draft_buffers, upscale_draft
+from .http_client import HttpConnectionPool
+from .instrumentation import Profiler, stage
+from .label_export import LabelExport, encode_png, export_label_images
+from .layer_index import LayerIndex
+from .preview_stream import PreviewSettings, PreviewStream, supports_pixel_writes, write_layer_image
+from .result_cache import CachedDiffusionController, ResultCache
+from .result_store import RESULT_STORE_DIR_NAME, ResultStore, document_identity, is_unsaved
+from .tiling import TileSettings, TiledDiffusionController
+from .variants import Variant, VariantSet, new_seeds
+from .wire_format import DETAIL_COLORED_ROLES, SCRIBBLE_TO_LINE_ROLES, encode_inputs, negotiated_formats
+
+EMBEDDED_EMPTY_IMAGE_FILE_NAME = "empty.png"
+
+DIFFUSION_DRAWING_LAYER_MARKER = "[DiffusionDrawing SystemLayer]"
+LINEART_LAYER_NAME = f"lineart{DIFFUSION_DRAWING_LAYER_MARKER}"
+SHADOW_LAYER_NAME = f"shadow{DIFFUSION_DRAWING_LAYER_MARKER}"
+LIGHT_LAYER_NAME = f"light{DIFFUSION_DRAWING_LAYER_MARKER}"
+
+LINEART_FILE_NAME = "lineart.png"
+SHADOW_FILE_NAME = "shadow.png"
+LIGHT_FILE_NAME = "light.png"
+
+# 出力ファイル名 -> system layerの名前
+SYSTEM_LAYER_FILE_NAMES = {
+    LINEART_FILE_NAME: LINEART_LAYER_NAME,
+    SHADOW_FILE_NAME: SHADOW_LAYER_NAME,
+    LIGHT_FILE_NAME: LIGHT_LAYER_NAME,
+}
+
+SYSTEM_LAYER_DEFAULT_OPACITY = 127
+
+RESULT_CACHE_DIR_NAME = "diffusion_drawing_results"
+
+SCRIBBLE_COLOR_LABEL = 1
+LINEART_COLOR_LABEL = 2
+BASE_COLOR_COLOR_LABEL = 3
+SHADOW_COLOR_LABEL = 4
+LIGHT_COLOR_LABEL = 5
+
+
+# 書き換えた出力ファイルをsystem layerに反映する
+# paint layerなら生成しなおした範囲だけを書き込み、file layerならファイルから読み込みなおす
+def update_system_layers(document: krita.Document, outputs: list[tuple[QUuid, str]], regions: list[Region] | None):
+    for node_id, output_path in outputs:
+        node = document.nodeByUniqueID(node_id)
+        if node is None:
+            continue
+        if node.type() == "filelayer":
+            with stage("file-layer reload"):
+                node.resetCache()
+        elif supports_pixel_writes(document, node):
+            with stage("layer write"):
+                output = QImage(output_path)
+                if output.width() != document.width() or output.height() != document.height():
+                    output = output.scaled(document.width(), document.height())
+                # previewは余白を含めた範囲に書かれているので、その範囲ごと書き戻す
+                rects = [QRect(0, 0, document.width(), document.height())] if regions is None else \
+                    [region.outer for region in regions]
+                for rect in rects:
+                    write_layer_image(node, output.copy(rect), rect.left(), rect.top())
+    document.refreshProjection()
+
+
+@dataclass
+class SystemLayers:
+    identity: str
+    result_dir: str
+    document: krita.Document
+    lineart: QUuid | None = None
+    shadow: QUuid | None = None
+    light: QUuid | None = None
+
+
+# 書き出し、生成、transferの処理をUIから切り離したもの
+# dockerからも、Kritaを画面なしで動かすbatchからも、ドキュメントを明示的に渡して使う
+class DiffusionEngine:
+    # use_result_cache=Falseなら、同じ入力でも前回の結果を使わずにバックエンドで生成しなおす (モデルを更新したときなど)
+    def __init__(self, cache_dir: str, log: Callable[[object], None] = print,
+                 max_concurrent_requests: int | None = None, use_result_cache: bool = True):
+        self.log = log
+        self.backend_pool = None
+        # backend poolを作れなかった理由 (dockerはlogを出せるようになってから表示する)
+        self.backend_pool_error: str | None = None
+        backend = None
+        backend_addresses = configured_backend_addresses()
+        if backend_addresses:
+            try:
+                self.backend_pool = BackendPool(backend_addresses, DiffusionController)
+            except RuntimeError as e:
+                # 振り分けられなくても、1台のバックエンドとしては使えるようにする
+                self.backend_pool_error = f"{e}; using a single backend"
+        if self.backend_pool is not None:
+            self.diffusion_controller = self.backend_pool
+        else:
+            self.diffusion_controller = DiffusionController()
+            # 1台だけのときも、キャンセルしたpromptはそのサーバーのHTTP APIで止める
+            backend = HttpConnectionPool(*parse_address(single_backend_address(self.diffusion_controller)))
+        self.buffered_controller = BufferedDiffusionController(self.diffusion_controller, max_concurrent_requests,
+                                                               backend)
+        # 入力画像を書き出す形式 (controllerが受け取れると申告したもの)
+        self.input_formats = negotiated_formats(self.diffusion_controller)
+        # seed違いの候補を生成できるか (できなければdockerの候補の行を使えなくする)
+        self.supports_variants = supports_variants(self.diffusion_controller)
+        # 生成中のpreviewを受け取れるか (受け取れなければdockerのpreviewの行を使えなくする)
+        self.supports_preview = supports_preview(self.diffusion_controller)
+        # キャンセルでバックエンドのpromptも止められるか (止められなければキャンセルはこのプロセスの中だけ)
+        self.supports_interrupt = supports_interrupt(self.buffered_controller)
+        self.result_cache = ResultCache(os.path.join(cache_dir, RESULT_CACHE_DIR_NAME))
+        self.cached_controller = CachedDiffusionController(self.buffered_controller, self.result_cache)
+        self.tile_settings = TileSettings()
+        self.tiled_controller = TiledDiffusionController(
+            self.cached_controller if use_result_cache else self.buffered_controller, self.tile_settings)
+        self.dirty_regions = DirtyRegionTracker()
+        self.result_store = ResultStore(os.path.join(cache_dir, RESULT_STORE_DIR_NAME))
+        self.draft_settings = DraftSettings()
+        self.preview_settings = PreviewSettings()
+        # draftを表示していて、まだフル解像度の結果で置き換えていない (document id, 出力ファイル名)
+        self.drafted: set[tuple[QUuid, str]] = set()
+        # ドキュメントごとに、最後に生成したshadow/lightの候補
+        self.variants: dict[QUuid, VariantSet] = {}
+        self.profiler = Profiler()
+
+        self.document_nodes_map: dict[QUuid, SystemLayers] = {}
+        self.layer_indexes: dict[QUuid, LayerIndex] = {}
+
+    # backend poolのヘルスチェックはevent loopの上で動くので、loopを用意してから呼ぶ
+    def start(self):
+        if self.backend_pool is not None:
+            self.backend_pool.start()
+
+    def close(self):
+        if self.backend_pool is not None:
+            self.backend_pool.close()
+        self.buffered_controller.close()
+        # 保存されたドキュメントの結果は次に開いたときのために残し、ディスク使用量はresult storeのLRUで抑える
+        # 生成した後に保存されたドキュメントの結果を消さないように、先にidentityを付けなおす
+        self.update_identities()
+        for system_layers in self.document_nodes_map.values():
+            if is_unsaved(system_layers.identity):
+                self.result_store.remove(system_layers.identity)
+
+    def system_layers(self, document: krita.Document) -> SystemLayers:
+        return self.document_nodes_map[document.rootNode().uniqueId()]
+
+    def is_initialized(self, document: krita.Document) -> bool:
+        return document.rootNode().uniqueId() in self.document_nodes_map
+
+    # 次の生成では、前回から変わった範囲だけでなく全体を生成しなおす
+    def reset_regions(self, document: krita.Document):
+        document_id = document.rootNode().uniqueId()
+        for name in SYSTEM_LAYER_FILE_NAMES:
+            self.dirty_regions.reset((document_id, name))
+
+    # 閉じたドキュメントの分をメモリから消す (保存した結果はresult storeに残る)
+    def forget_document(self, document: krita.Document):
+        document_id = document.rootNode().uniqueId()
+        self.reset_regions(document)
+        self.document_nodes_map.pop(document_id, None)
+        self.layer_indexes.pop(document_id, None)
+        self.variants.pop(document_id, None)
+        for name in SYSTEM_LAYER_FILE_NAMES:
+            self.drafted.discard((document_id, name))
+
+    # ドキュメントのlayer indexを、現在のlayer構造に合わせてから返す
+    def layer_index(self, document: krita.Document) -> LayerIndex:
+        document_id = document.rootNode().uniqueId()
+        layer_index = self.layer_indexes.get(document_id)
+        if layer_index is None or layer_index.document != document:
+            layer_index = LayerIndex(document)
+            self.layer_indexes[document_id] = layer_index
+        with stage("layer index sync"):
+            layer_index.sync()
+        return layer_index
+
+    def apply_layer_mask_filtered_color_label(self, document: krita.Document, allow_labels: list[int],
+                                              layer_index: LayerIndex | None = None):
+        if layer_index is None:
+            layer_index = self.layer_index(document)
+
+        with stage("mask apply"):
+            for entry in layer_index.layers(allow_labels):
+                # 子が無ければprojectionはlayerそのものなので、焼き込む必要はない
+                if entry.has_masks:
+                    self.bake_layer_masks(entry.node, layer_index)
+
+    @staticmethod
+    def bake_layer_masks(node: krita.Node, layer_index: LayerIndex):
+        bounds = node.bounds()
+        pixels = node.projectionPixelData(bounds.left(), bounds.top(), bounds.width(), bounds.height())
+
+        node.setPixelData(pixels, bounds.left(), bounds.top(), bounds.width(), bounds.height())
+        for n in node.childNodes():
+            node.removeChildNode(n)
+        layer_index.set_masks(node.uniqueId(), 0)
+
+    # base layerはblending modeでprojectionが変わらないように全部normalにして、1回だけrefreshしてから読む
+    @staticmethod
+    def read_base_layers(document: krita.Document,
+                         base_layers: list[krita.Node]) -> tuple[PixelFormat | None, list[bytes]]:
+        width = document.width()
+        height = document.height()
+        pixel_format = PixelFormat.of(document.colorModel(), document.colorDepth())
+
+        blending_modes = [base_layer.blendingMode() for base_layer in base_layers]
+        for base_layer in base_layers:
+            base_layer.setBlendingMode("normal")
+        with stage("projection refresh"):
+            document.refreshProjection()
+            document.waitForDone()
+
+        with stage("base layer read"):
+            if pixel_format is None:
+                bases = [bytes(base_layer.projectionPixelData(0, 0, width, height)) for base_layer in base_layers]
+            else:
+                bases = [read_alpha(base_layer, pixel_format, width, height) for base_layer in base_layers]
+        for base_layer, blending_mode in zip(base_layers, blending_modes):
+            base_layer.setBlendingMode(blending_mode)
+        return pixel_format, bases
+
+    # 前回このプラグインが付けたmaskと入力が変わっていないlayerは、焼き込みもmaskの作り直しもしない
+    def create_transparency_masks(self, document: krita.Document, allow_labels: list[int], base: bytes,
+                                  pixel_format: PixelFormat | None, layer_index: LayerIndex):
+        width = document.width()
+        height = document.height()
+        base_alpha_digest = alpha_digest(base)
+
+        for entry in layer_index.layers(allow_labels):
+            node = entry.node
+            signature = mask_signature(base_alpha_digest, node)
+            if entry.has_masks:
+                if entry.mask_count == 1 and entry.mask_signature == signature:
+                    continue
+                self.bake_layer_masks(node, layer_index)
+                # 焼き込むとlayerの画素が変わり、次に比べるのは焼き込んだ後の画素なので、そのときだけ計算しなおす
+                signature = mask_signature(base_alpha_digest, node)
+
+            transparency_mask = document.createTransparencyMask("mask")
+            if pixel_format is None:
+                pixels = self.create_mask_pixels_with_levels_filter(document, node, base, width, height)
+                transparency_mask.setPixelData(pixels, 0, 0, width, height)
+            else:
+                fill_transparency_mask(transparency_mask, node, base, pixel_format, width, height)
+            transparency_mask.setLocked(True)
+            node.addChildNode(transparency_mask, None)
+            layer_index.set_masks(node.uniqueId(), 1, signature)
+
+    def create_transparency_mask_from_layer_filtered_color_label(self, document: krita.Document,
+                                                                 allow_labels: list[int], base_layer: krita.Node,
+                                                                 layer_index: LayerIndex | None = None):
+        if layer_index is None:
+            layer_index = self.layer_index(document)
+
+        pixel_format, (base,) = self.read_base_layers(document, [base_layer])
+        with stage("mask creation"):
+            self.create_transparency_masks(document, allow_labels, base, pixel_format, layer_index)
+        with stage("projection refresh"):
+            document.refreshProjection()
+            document.waitForDone()
+
+    # (label, base layer, transferするか) の組をまとめて処理する
+    # base layerの読み込みとドキュメントのrefreshは、組の数によらずそれぞれ1回だけ
+    def transfer(self, document: krita.Document, transfers: list[tuple[int, QUuid, bool]]):
+        layer_index = self.layer_index(document)
+        for label, _, transfer in transfers:
+            if not transfer:
+                self.apply_layer_mask_filtered_color_label(document, [label], layer_index)
+
+        enabled = [(label, document.nodeByUniqueID(base_layer_id)) for label, base_layer_id, transfer in transfers
+                   if transfer]
+        if enabled:
+            active_node = document.activeNode()
+            pixel_format, bases = self.read_base_layers(document, [base_layer for _, base_layer in enabled])
+            with stage("mask creation"):
+                for (label, _), base in zip(enabled, bases):
+                    self.create_transparency_masks(document, [label], base, pixel_format, layer_index)
+            with stage("projection refresh"):
+                document.refreshProjection()
+                document.waitForDone()
+            document.setActiveNode(active_node)
+
+    def transfer_all(self, document: krita.Document):
+        system_layers = self.system_layers(document)
+        self.transfer(document, [
+            (LINEART_COLOR_LABEL, system_layers.lineart, True),
+            (SHADOW_COLOR_LABEL, system_layers.shadow, True),
+            (LIGHT_COLOR_LABEL, system_layers.light, True),
+        ])
+
+    # PixelFormatで扱えない色空間のときだけ使う、一時ドキュメントとlevelsフィルタによる以前の実装
+    @staticmethod
+    def create_mask_pixels_with_levels_filter(document: krita.Document, node: krita.Node,
+                                              base_layer_pixels: QByteArray, width: int, height: int) -> QByteArray:
+        tmp_document = krita.Krita.instance().createDocument(
+            width,
+            height,
+            "Image",
+            document.colorModel(),
+            document.colorDepth(),
+            document.colorProfile(),
+            document.resolution()
+        )
+        foreground_layer = tmp_document.rootNode().childNodes()[0]
+        tmp_document.rootNode().removeChildNode(foreground_layer)
+        foreground_layer.setInheritAlpha(True)
+
+        base_layer_clone = tmp_document.createNode("base_layer", "paintLayer")
+        base_layer_clone.setPixelData(base_layer_pixels, 0, 0, width, height)
+
+        pixels = node.projectionPixelData(0, 0, width, height)
+        n = tmp_document.createNode("l", "paintLayer")
+        n.setPixelData(pixels, 0, 0, width, height)
+
+        tmp_document.rootNode().addChildNode(base_layer_clone, None)
+        tmp_document.rootNode().addChildNode(n, None)
+        tmp_document.rootNode().addChildNode(foreground_layer, None)
+        tmp_document.refreshProjection()
+        tmp_document.waitForDone()
+
+        s = krita.Selection()
+        s.select(0, 0, width, height, 255)
+        binarize_filter = tmp_document.createFilterMask("binarize_filter_mask",
+                                                        krita.Krita.instance().filter("levels"), s)
+        n.addChildNode(binarize_filter, None)
+        binarize_filter.filter().configuration().setProperties(
+            {'blackvalue': 0, 'channel_0': '0;1;1;0;1', 'channel_1': '0;1;1;0;1', 'channel_2': '0;1;1;0;1',
+             'channel_3': '0;1;1;0;1', 'channel_4': '0;1;1;0;1', 'channel_5': '0;1;1;0;1',
+             'channel_6': '0;1;1;0;1', 'channel_7': '0;1;1;0;1', 'gammavalue': 1.0,
+             'histogram_mode': 'logarithmic', 'lightness': '0;1;1;0;1', 'mode': 'channels',
+             'number_of_channels': 8, 'outblackvalue': 0, 'outwhitevalue': 255, 'whitevalue': 255})
+        binarize_filter.filter().configuration().setProperty("channel_4", "0;1;10;0;1")
+
+        s = krita.Selection()
+        s.select(0, 0, width, height, 255)
+        binarize_filter = tmp_document.createFilterMask("binarize_filter_mask",
+                                                        krita.Krita.instance().filter("levels"), s)
+        n.addChildNode(binarize_filter, None)
+        binarize_filter.filter().configuration().setProperties(
+            {'blackvalue': 0, 'channel_0': '0;1;1;0;1', 'channel_1': '0;1;1;0;1', 'channel_2': '0;1;1;0;1',
+             'channel_3': '0;1;1;0;1', 'channel_4': '0;1;1;0;1', 'channel_5': '0;1;1;0;1',
+             'channel_6': '0;1;1;0;1', 'channel_7': '0;1;1;0;1', 'gammavalue': 1.0,
+             'histogram_mode': 'logarithmic', 'lightness': '0;1;1;0;1', 'mode': 'channels',
+             'number_of_channels': 8, 'outblackvalue': 0, 'outwhitevalue': 255, 'whitevalue': 255})
+        binarize_filter.filter().configuration().setProperty("channel_4", "0;1;10;0;1")
+
+        tmp_document.refreshProjection()
+        tmp_document.waitForDone()
+
+        pixels = tmp_document.rootNode().projectionPixelData(0, 0, width, height)
+        base_layer_clone.setPixelData(pixels, 0, 0, width, height)
+        tmp_document.rootNode().removeChildNode(n)
+        tmp_document.rootNode().removeChildNode(foreground_layer)
+        tmp_document.refreshProjection()
+        tmp_document.waitForDone()
+        tmp_document.setColorSpace("A", "U8", "")
+        tmp_document.refreshProjection()
+        tmp_document.waitForDone()
+
+        pixels = tmp_document.rootNode().projectionPixelData(0, 0, width, height)
+        tmp_document.close()
+        return pixels
+
+    async def gen_lineart(self, document: krita.Document) -> list[Region] | None:
+        document_id = document.rootNode().uniqueId()
+        system_layers = self.document_nodes_map[document_id]
+        lineart_output_path = os.path.join(system_layers.result_dir, LINEART_FILE_NAME)
+
+        inputs = self.lineart_inputs()
+        images = export_label_images(document, inputs)
+
+        async def generate(buffers: list[bytes]) -> tuple[bytes]:
+            return (await self.tiled_controller.scribble_to_line(*buffers),)
+
+        return await self.regenerate_system_layers(
+            document, (document_id, LINEART_FILE_NAME), images, inputs, SCRIBBLE_TO_LINE_ROLES,
+            [(system_layers.lineart, lineart_output_path)], generate)
+
+    async def gen_lineart_draft(self, document: krita.Document):
+        document_id = document.rootNode().uniqueId()
+        system_layers = self.document_nodes_map[document_id]
+        lineart_output_path = os.path.join(system_layers.result_dir, LINEART_FILE_NAME)
+
+        inputs = self.lineart_inputs()
+        images = export_label_images(document, inputs)
+
+        output = await self.tiled_controller.scribble_to_line(
+            *draft_buffers(images, inputs, SCRIBBLE_TO_LINE_ROLES, self.draft_settings.scale, self.input_formats),
+            parameters=self.draft_settings.parameters())
+        self.show_draft(document, (document_id, LINEART_FILE_NAME),
+                        [(system_layers.lineart, lineart_output_path)], (output,))
+
+    async def gen_detail(self, document: krita.Document) -> list[Region] | None:
+        document_id = document.rootNode().uniqueId()
+        system_layers = self.document_nodes_map[document_id]
+        shadow_output_path = os.path.join(system_layers.result_dir, SHADOW_FILE_NAME)
+        light_output_path = os.path.join(system_layers.result_dir, LIGHT_FILE_NAME)
+
+        inputs = self.detail_inputs()
+        images = export_label_images(document, inputs)
+
+        async def generate(buffers: list[bytes]) -> tuple[bytes, bytes]:
+            return await self.tiled_controller.detail_colored(*buffers)
+
+        # previewはsamplerの出力1枚なので、shadow layerに流す
+        return await self.regenerate_system_layers(
+            document, (document_id, SHADOW_FILE_NAME), images, inputs, DETAIL_COLORED_ROLES,
+            [(system_layers.shadow, shadow_output_path), (system_layers.light, light_output_path)], generate)
+
+    async def gen_detail_draft(self, document: krita.Document):
+        document_id = document.rootNode().uniqueId()
+        system_layers = self.document_nodes_map[document_id]
+        shadow_output_path = os.path.join(system_layers.result_dir, SHADOW_FILE_NAME)
+        light_output_path = os.path.join(system_layers.result_dir, LIGHT_FILE_NAME)
+
+        inputs = self.detail_inputs()
+        images = export_label_images(document, inputs)
+
+        outputs = await self.tiled_controller.detail_colored(
+            *draft_buffers(images, inputs, DETAIL_COLORED_ROLES, self.draft_settings.scale, self.input_formats),
+            parameters=self.draft_settings.parameters())
+        self.show_draft(document, (document_id, SHADOW_FILE_NAME),
+                        [(system_layers.shadow, shadow_output_path), (system_layers.light, light_output_path)],
+                        outputs)
+
+    # 書き出しとPNG化は1回だけ行い、seed違いの候補をまとめて生成する
+    # 候補は出力ファイルには書かず、select_variantで選ばれたものだけをsystem layerに反映する
+    async def gen_detail_variants(self, document: krita.Document, count: int) -> list[Variant]:
+        if not self.supports_variants:
+            raise RuntimeError("the backend cannot generate with a given seed")
+        document_id = document.rootNode().uniqueId()
+        inputs = self.detail_inputs()
+        images = export_label_images(document, inputs)
+        with stage("tile hashing"):
+            snapshot = self.dirty_regions.snapshot(images)
+
+        seeds = new_seeds(count)
+        outputs = await self.tiled_controller.detail_colored_variants(
+            *encode_inputs(images, inputs, DETAIL_COLORED_ROLES, self.input_formats), seeds)
+        variant_set = VariantSet(snapshot, [Variant(seed, shadow, light)
+                                            for seed, (shadow, light) in zip(seeds, outputs)])
+        self.variants[document_id] = variant_set
+        return variant_set.variants
+
+    def select_variant(self, document: krita.Document, index: int):
+        document_id = document.rootNode().uniqueId()
+        system_layers = self.document_nodes_map[document_id]
+        variant_set = self.variants[document_id]
+        variant = variant_set.variants[index]
+        shadow_output_path = os.path.join(system_layers.result_dir, SHADOW_FILE_NAME)
+        light_output_path = os.path.join(system_layers.result_dir, LIGHT_FILE_NAME)
+
+        with stage("result write"):
+            for output_path, data in ((shadow_output_path, variant.shadow), (light_output_path, variant.light)):
+                with open(output_path, "wb") as f:
+                    f.write(data)
+        # 次のGenでは、この候補を生成したときの入力から変わった範囲だけを生成しなおす
+        key = (document_id, SHADOW_FILE_NAME)
+        self.dirty_regions.commit(key, variant_set.snapshot)
+        self.drafted.discard(key)
+        update_system_layers(document, [(system_layers.shadow, shadow_output_path),
+                                        (system_layers.light, light_output_path)], None)
+        self.save_results(document)
+
+    @staticmethod
+    def lineart_inputs() -> list[LabelExport]:
+        scribble = LabelExport.of([SCRIBBLE_COLOR_LABEL], False)
+        lineart = LabelExport.of([LINEART_COLOR_LABEL], True)
+        return [scribble, lineart]
+
+    @staticmethod
+    def detail_inputs() -> list[LabelExport]:
+        image = LabelExport.of(
+            [LINEART_COLOR_LABEL, BASE_COLOR_COLOR_LABEL, SHADOW_COLOR_LABEL, LIGHT_COLOR_LABEL], False)
+        basecolor_image = LabelExport.of([LINEART_COLOR_LABEL, BASE_COLOR_COLOR_LABEL], False)
+        lineart = LabelExport.of([LINEART_COLOR_LABEL], True)
+        basecolor = LabelExport.of([BASE_COLOR_COLOR_LABEL], True)
+        shadow = LabelExport.of([SHADOW_COLOR_LABEL], True)
+        light = LabelExport.of([LIGHT_COLOR_LABEL], True)
+        return [image, basecolor_image, lineart, basecolor, shadow, light]
+
+    # draftはpaint layerの画素にだけ書き、出力ファイルは前回のフル解像度の結果のまま残す
+    # file layerはファイルを書き換えるしかないので、次は全体を生成しなおすように前回の入力の記録を捨てる
+    def show_draft(self, document: krita.Document, key: tuple[QUuid, str], outputs: list[tuple[QUuid, str]],
+                   drafts: tuple[bytes, ...]):
+        size = QSize(document.width(), document.height())
+        for (node_id, output_path), data in zip(outputs, drafts):
+            image = upscale_draft(data, size)
+            node = document.nodeByUniqueID(node_id)
+            if node is None:
+                continue
+            with stage("layer write"):
+                if supports_pixel_writes(document, node):
+                    write_layer_image(node, image, 0, 0)
+                elif node.type() == "filelayer":
+                    with open(output_path, "wb") as f:
+                        f.write(encode_png(image))
+                    node.resetCache()
+                    self.dirty_regions.reset(key)
+        document.refreshProjection()
+        self.drafted.add(key)
+        self.save_results(document)
+
+    def preview_stream(self, document: krita.Document, node_id: QUuid) -> PreviewStream | None:
+        if not self.preview_settings.enabled or not self.supports_preview:
+            return None
+        node = document.nodeByUniqueID(node_id)
+        if not supports_pixel_writes(document, node):
+            return None
+        return PreviewStream(document, node, self.preview_settings.interval)
+
+    # outputsの先頭のsystem layerには、生成中のpreviewを流す
+    async def regenerate_system_layers(self, document: krita.Document, key: tuple[QUuid, str],
+                                       images: dict[LabelExport, QImage], inputs: list[LabelExport],
+                                       roles: tuple[str, ...], outputs: list[tuple[QUuid, str]],
+                                       generate: Callable[[list[bytes]], Coroutine]) -> list[Region] | None:
+        preview = self.preview_stream(document, outputs[0][0])
+        try:
+            with preview.activate() if preview is not None else nullcontext():
+                regions = await regenerate(self.dirty_regions, key, images, inputs, roles,
+                                           [output_path for _, output_path in outputs], generate, self.input_formats)
+        except BaseException:
+            # 途中までのpreviewが残らないように、前回の結果に戻す
+            if preview is not None and preview.frames:
+                update_system_layers(document, outputs, None)
+            raise
+        if key in self.drafted:
+            # draftはキャンバス全体に書かれているので、変更範囲によらず全体を置き換える
+            update_system_layers(document, outputs, None)
+            self.drafted.discard(key)
+        elif regions != [] or (preview is not None and preview.frames):
+            update_system_layers(document, outputs, regions)
+        if regions != []:
+            self.save_results(document)
+        return regions
+
+    def initialize_document(self, document: krita.Document) -> SystemLayers:
+        document_id = document.rootNode().uniqueId()
+        if document_id not in self.document_nodes_map:
+            self.log("Open unknown document")
+            # 前に生成した結果が残っていれば、空の画像で上書きせずにそのまま使う
+            self.open_result_store(document)
+
+        system_layers = self.document_nodes_map[document_id]
+        rootNode = document.rootNode()
+        for n in filter(lambda n: n.name().find(DIFFUSION_DRAWING_LAYER_MARKER) != -1, rootNode.childNodes()):
+            rootNode.removeChildNode(n)
+
+        lineart_layer = self.create_system_layer(
+            document,
+            LINEART_LAYER_NAME,
+            os.path.join(system_layers.result_dir, LINEART_FILE_NAME))
+        lineart_layer.setOpacity(SYSTEM_LAYER_DEFAULT_OPACITY)
+        document.rootNode().addChildNode(lineart_layer, None)
+        lineart_layer.setLocked(True)
+        self.load_system_layer(document, lineart_layer, os.path.join(system_layers.result_dir, LINEART_FILE_NAME))
+        system_layers.lineart = lineart_layer.uniqueId()
+
+        shadow_layer = self.create_system_layer(
+            document,
+            SHADOW_LAYER_NAME,
+            os.path.join(system_layers.result_dir, SHADOW_FILE_NAME))
+        shadow_layer.setOpacity(SYSTEM_LAYER_DEFAULT_OPACITY)
+        shadow_layer.setBlendingMode("multiply")
+        document.rootNode().addChildNode(shadow_layer, None)
+        shadow_layer.setLocked(True)
+        self.load_system_layer(document, shadow_layer, os.path.join(system_layers.result_dir, SHADOW_FILE_NAME))
+        system_layers.shadow = shadow_layer.uniqueId()
+
+        light_layer = self.create_system_layer(
+            document,
+            LIGHT_LAYER_NAME,
+            os.path.join(system_layers.result_dir, LIGHT_FILE_NAME))
+        light_layer.setOpacity(SYSTEM_LAYER_DEFAULT_OPACITY)
+        light_layer.setBlendingMode("add")
+        document.rootNode().addChildNode(light_layer, None)
+        light_layer.setLocked(True)
+        self.load_system_layer(document, light_layer, os.path.join(system_layers.result_dir, LIGHT_FILE_NAME))
+        system_layers.light = light_layer.uniqueId()
+        return system_layers
+
+    def open_result_store(self, document: krita.Document) -> SystemLayers:
+        document_id = document.rootNode().uniqueId()
+        identity = document_identity(document)
+        empty_image = os.path.join(os.path.dirname(__file__), EMBEDDED_EMPTY_IMAGE_FILE_NAME)
+        result_dir = self.result_store.open(identity, list(SYSTEM_LAYER_FILE_NAMES), empty_image)
+        system_layers = SystemLayers(identity, result_dir, document)
+        self.document_nodes_map[document_id] = system_layers
+
+        for name, snapshot in self.result_store.load_snapshots(identity).items():
+            self.dirty_regions.commit((document_id, name), snapshot)
+        self.result_store.evict(self.open_identities())
+        return system_layers
+
+    def open_identities(self) -> set[str]:
+        return {system_layers.identity for system_layers in self.document_nodes_map.values()}
+
+    # 前回のセッションで生成した結果があり、ドキュメントにsystem layerが残っていれば、初期化せずにそのまま使う
+    def restore_document(self, document: krita.Document) -> bool:
+        if not self.result_store.contains(document_identity(document)):
+            return False
+        nodes = {n.name(): n for n in document.rootNode().childNodes()
+                 if n.name().find(DIFFUSION_DRAWING_LAYER_MARKER) != -1}
+        if any(layer_name not in nodes for layer_name in SYSTEM_LAYER_FILE_NAMES.values()):
+            return False
+
+        system_layers = self.open_result_store(document)
+        system_layers.lineart = nodes[LINEART_LAYER_NAME].uniqueId()
+        system_layers.shadow = nodes[SHADOW_LAYER_NAME].uniqueId()
+        system_layers.light = nodes[LIGHT_LAYER_NAME].uniqueId()
+        # ドキュメントに保存されている画素は最後の生成結果より古いことがあるので、保存した結果で置き換える
+        for file_name, layer_name in SYSTEM_LAYER_FILE_NAMES.items():
+            path = os.path.join(system_layers.result_dir, file_name)
+            node = nodes[layer_name]
+            if node.type() == "filelayer":
+                if node.path() != path:
+                    node.setProperties(path, "ToImageSize")
+                node.resetCache()
+            else:
+                self.load_system_layer(document, node, path)
+        document.refreshProjection()
+        self.log("restored results of the last session")
+        return True
+
+    # 保存されていなかったドキュメントが保存されていたら、結果を保存先のパスで引けるように移す
+    def update_identity(self, system_layers: SystemLayers):
+        document = system_layers.document
+        # 閉じられたドキュメントのfileNameは空になるので、そのときは今のidentityのままにする
+        if not document.fileName():
+            return
+        identity = document_identity(document)
+        if identity != system_layers.identity:
+            system_layers.result_dir = self.result_store.rename(system_layers.identity, identity)
+            system_layers.identity = identity
+            self.repoint_file_layers(document, system_layers)
+
+    def update_identities(self):
+        for system_layers in self.document_nodes_map.values():
+            self.update_identity(system_layers)
+
+    # 生成結果と入力のハッシュを、ドキュメントを開きなおしたときのために保存する
+    def save_results(self, document: krita.Document):
+        document_id = document.rootNode().uniqueId()
+        system_layers = self.document_nodes_map[document_id]
+        self.update_identity(system_layers)
+        identity = system_layers.identity
+
+        snapshots = {name: self.dirty_regions.snapshots[(document_id, name)] for name in SYSTEM_LAYER_FILE_NAMES
+                     if (document_id, name) in self.dirty_regions.snapshots}
+        with stage("result store write"):
+            self.result_store.save_snapshots(identity, snapshots)
+            self.result_store.evict(self.open_identities())
+
+    @staticmethod
+    def repoint_file_layers(document: krita.Document, system_layers: SystemLayers):
+        for file_name, node_id in ((LINEART_FILE_NAME, system_layers.lineart), (SHADOW_FILE_NAME, system_layers.shadow),
+                                   (LIGHT_FILE_NAME, system_layers.light)):
+            node = document.nodeByUniqueID(node_id)
+            if node is not None and node.type() == "filelayer":
+                node.setProperties(os.path.join(system_layers.result_dir, file_name), "ToImageSize")
+
+    # 画素を直接書き込めるドキュメントではpaint layerにして、previewや生成結果をファイルを介さずに反映する
+    # それ以外の色空間では以前と同じくfile layerにする
+    @staticmethod
+    def create_system_layer(document: krita.Document, name: str, path: str) -> krita.Node:
+        if document.colorModel() == "RGBA" and document.colorDepth() == "U8":
+            return document.createNode(name, "paintLayer")
+        return document.createFileLayer(name, path, "ToImageSize")
+
+    @staticmethod
+    def load_system_layer(document: krita.Document, node: krita.Node, path: str):
+        if node.type() != "paintlayer":
+            return
+        image = QImage(path)
+        if not image.isNull():
+            write_layer_image(node, image.scaled(document.width(), document.height()), 0, 0)
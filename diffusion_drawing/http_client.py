@@ -0,0 +1,175 @@
+import asyncio
+import base64
+import os
+import struct
+
+REQUEST_TIMEOUT = 10.0
+MAX_IDLE_CONNECTIONS = 4
+
+WEBSOCKET_CONTINUATION = 0x0
+WEBSOCKET_TEXT = 0x1
+WEBSOCKET_BINARY = 0x2
+WEBSOCKET_CLOSE = 0x8
+WEBSOCKET_PING = 0x9
+WEBSOCKET_PONG = 0xA
+
+CONNECTION_ERRORS = (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+
+async def read_headers(reader: asyncio.StreamReader) -> tuple[int, dict[str, str]]:
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by server")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple[int, dict[str, str], bytes]:
+    status, headers = await read_headers(reader)
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        return status, headers, bytes(body)
+    if "content-length" in headers:
+        return status, headers, await reader.readexactly(int(headers["content-length"]))
+    # 長さが分からないときは接続が閉じられるまで読む
+    headers["connection"] = "close"
+    return status, headers, await reader.read()
+
+
+# 1つのサーバーへのkeep-aliveなHTTP/1.1接続を使い回す
+class HttpConnectionPool:
+    def __init__(self, host: str, port: int, max_idle: int = MAX_IDLE_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def acquire(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), REQUEST_TIMEOUT)
+        return reader, writer, False
+
+    def release(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self.idle) < self.max_idle:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def request(self, method: str, path: str, body: bytes | None = None,
+                      content_type: str = "application/json") -> tuple[int, bytes]:
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nConnection: keep-alive\r\n"
+        if body is not None:
+            head += f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        data = head.encode("latin-1") + b"\r\n" + (body or b"")
+
+        # 使い回した接続がサーバー側で閉じられていたときは、新しい接続で1回だけやり直す
+        for retry in (True, False):
+            reader, writer, reused = await self.acquire()
+            try:
+                writer.write(data)
+                await writer.drain()
+                status, headers, response = await asyncio.wait_for(read_response(reader), REQUEST_TIMEOUT)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused and retry:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            if headers.get("connection", "").lower() == "close":
+                writer.close()
+            else:
+                self.release(reader, writer)
+            return status, response
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+class WebSocketConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    async def connect(host: str, port: int, path: str) -> "WebSocketConnection":
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), REQUEST_TIMEOUT)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode("latin-1"))
+        await writer.drain()
+        status, _ = await asyncio.wait_for(read_headers(reader), REQUEST_TIMEOUT)
+        if status != 101:
+            writer.close()
+            raise ConnectionError(f"websocket handshake failed with status {status}")
+        return WebSocketConnection(reader, writer)
+
+    async def read_frame(self) -> tuple[bool, int, bytes]:
+        b0, b1 = await self.reader.readexactly(2)
+        length = b1 & 0x7F
+        if length == 126:
+            (length,) = struct.unpack("!H", await self.reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", await self.reader.readexactly(8))
+        mask = await self.reader.readexactly(4) if b1 & 0x80 else None
+        payload = await self.reader.readexactly(length)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return bool(b0 & 0x80), b0 & 0x0F, payload
+
+    async def receive(self) -> tuple[int, bytes]:
+        opcode = None
+        message = bytearray()
+        while True:
+            fin, frame_opcode, payload = await self.read_frame()
+            if frame_opcode == WEBSOCKET_PING:
+                await self.send(WEBSOCKET_PONG, payload)
+                continue
+            if frame_opcode == WEBSOCKET_PONG:
+                continue
+            if frame_opcode == WEBSOCKET_CLOSE:
+                self.close()
+                raise ConnectionError("websocket closed by server")
+            if frame_opcode != WEBSOCKET_CONTINUATION:
+                opcode = frame_opcode
+            message += payload
+            if fin:
+                return opcode, bytes(message)
+
+    async def send(self, opcode: int, payload: bytes):
+        # クライアントから送るフレームはマスクが必須
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x80 | opcode, 0x80 | len(payload))
+        elif len(payload) < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, len(payload))
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, len(payload))
+        self.writer.write(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,152 @@
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+# 操作ごとに、この回数分の実行結果からパーセンタイルを出す
+ROLLING_WINDOW = 100
+PERCENTILES = (50, 90, 99)
+# 同時に走った区間の合計がこの割合を超えて長ければ、breakdownに合計も出す
+CONCURRENCY_REPORT_RATIO = 1.05
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    duration: float
+    thread_id: int
+
+
+# 区間を重ねたときに覆われる時間
+def covered_time(spans: list[Span]) -> float:
+    total = 0.0
+    end = None
+    for span in sorted(spans, key=lambda span: span.start):
+        span_end = span.start + span.duration
+        if end is None or span.start >= end:
+            total += span.duration
+            end = span_end
+        elif span_end > end:
+            total += span_end - end
+            end = span_end
+    return total
+
+
+@dataclass
+class Trace:
+    operation: str
+    start: float
+    duration: float = 0.0
+    spans: list[Span] = field(default_factory=list)
+
+    def spans_by_stage(self) -> dict[str, list[Span]]:
+        stages = {}
+        for span in self.spans:
+            stages.setdefault(span.name, []).append(span)
+        return stages
+
+    # gatherで同時に走った同じ段階の区間は重ねて数えないので、どの段階も操作全体の時間を超えない
+    def stage_totals(self) -> dict[str, float]:
+        return {name: covered_time(spans) for name, spans in self.spans_by_stage().items()}
+
+    # 同時に走った区間をそれぞれ足した時間 (並列にした分だけstage_totalsより長くなる)
+    def stage_busy_totals(self) -> dict[str, float]:
+        return {name: sum(span.duration for span in spans) for name, spans in self.spans_by_stage().items()}
+
+    def breakdown(self) -> str:
+        lines = [f"{self.operation}: {self.duration * 1000:.0f} ms"]
+        busy_totals = self.stage_busy_totals()
+        for name, duration in sorted(self.stage_totals().items(), key=lambda item: -item[1]):
+            line = f"  {name}: {duration * 1000:.0f} ms"
+            if busy_totals[name] > duration * CONCURRENCY_REPORT_RATIO:
+                line += f" ({busy_totals[name] * 1000:.0f} ms summed over concurrent spans)"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+
+
+# 実行中の操作があれば、その中の1段階として時間を記録する
+@contextmanager
+def stage(name: str):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append(Span(name, start, time.perf_counter() - start, threading.get_ident()))
+
+
+def percentile(values: list[float], p: int) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Profiler:
+    def __init__(self, window: int = ROLLING_WINDOW):
+        self.traces: deque[Trace] = deque(maxlen=window * 4)
+        self.window = window
+
+    @contextmanager
+    def run(self, operation: str):
+        trace = Trace(operation, time.perf_counter())
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+            trace.duration = time.perf_counter() - trace.start
+            self.traces.append(trace)
+
+    def percentiles(self, operation: str) -> dict[str, dict[int, float]]:
+        traces = [trace for trace in self.traces if trace.operation == operation][-self.window:]
+        samples: dict[str, list[float]] = {"total": [trace.duration for trace in traces]}
+        for trace in traces:
+            for name, duration in trace.stage_totals().items():
+                samples.setdefault(name, []).append(duration)
+        return {name: {p: percentile(values, p) for p in PERCENTILES} for name, values in samples.items() if values}
+
+    def summary(self, operation: str) -> str:
+        total = self.percentiles(operation).get("total")
+        if total is None:
+            return ""
+        return f"{operation} " + ", ".join(f"p{p}: {total[p] * 1000:.0f} ms" for p in PERCENTILES)
+
+    def chrome_trace(self) -> dict:
+        events = []
+        for index, trace in enumerate(self.traces):
+            events.append({"name": trace.operation, "cat": "run", "ph": "X", "pid": 1, "tid": index,
+                           "ts": trace.start * 1e6, "dur": trace.duration * 1e6})
+            for span in trace.spans:
+                events.append({"name": span.name, "cat": trace.operation, "ph": "X", "pid": 1, "tid": index,
+                               "ts": span.start * 1e6, "dur": span.duration * 1e6,
+                               "args": {"thread": span.thread_id}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def stage_report(self) -> dict:
+        operations = sorted({trace.operation for trace in self.traces})
+        return {
+            "runs": [{"operation": trace.operation, "duration": trace.duration, "stages": trace.stage_totals(),
+                      "stages_summed": trace.stage_busy_totals()} for trace in self.traces],
+            "percentiles": {operation: {name: {f"p{p}": value for p, value in values.items()}
+                                        for name, values in self.percentiles(operation).items()}
+                            for operation in operations},
+        }
+
+    def export_chrome_trace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def export_stage_report(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.stage_report(), f, indent=2)
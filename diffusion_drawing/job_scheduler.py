@@ -0,0 +1,46 @@
+import asyncio
+from typing import Callable, Coroutine, Hashable
+
+MAX_CONCURRENT_JOBS = 2
+
+
+# ドキュメントと操作の組ごとにlaneを持ち、各laneでは最後に投入されたjobだけを実行する
+# 別のlaneのjobは max_concurrent_jobs まで同時に実行する
+class JobScheduler:
+    def __init__(self, max_concurrent_jobs: int = MAX_CONCURRENT_JOBS, on_idle: Callable[[], None] | None = None):
+        self.semaphore = asyncio.Semaphore(max_concurrent_jobs)
+        self.lanes: dict[Hashable, asyncio.Task] = {}
+        self.on_idle = on_idle
+
+    # delayを指定すると、その間に同じlaneへ次のjobが来なかったときだけ実行する
+    def submit(self, lane: Hashable, job: Callable[[], Coroutine], delay: float = 0.0) -> asyncio.Task:
+        previous = self.lanes.get(lane)
+        if previous is not None:
+            previous.cancel()
+        task = asyncio.ensure_future(self.run(lane, previous, job, delay))
+        self.lanes[lane] = task
+        return task
+
+    def cancel(self, lane: Hashable):
+        task = self.lanes.get(lane)
+        if task is not None:
+            task.cancel()
+
+    def is_idle(self) -> bool:
+        return not self.lanes
+
+    async def run(self, lane: Hashable, previous: asyncio.Task | None, job: Callable[[], Coroutine], delay: float):
+        try:
+            if previous is not None:
+                # 前のjobがキャンセルされて後始末を終えるまで待ってから始める
+                await asyncio.wait([previous])
+            if delay > 0:
+                # 待っている間は同時実行数の枠を使わない
+                await asyncio.sleep(delay)
+            async with self.semaphore:
+                await job()
+        finally:
+            if self.lanes.get(lane) is asyncio.current_task():
+                del self.lanes[lane]
+                if self.is_idle() and self.on_idle is not None:
+                    self.on_idle()
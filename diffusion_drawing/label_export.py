@@ -0,0 +1,138 @@
+from dataclasses import dataclass
+
+import krita
+from PyQt5.QtCore import QBuffer, QByteArray, QIODevice, QSize
+from PyQt5.QtGui import QColor, QImage, QImageReader, QPainter
+
+from .instrumentation import stage
+
+# qpnghandlerでは compression = (100 - quality) * 9 / 91 なので、89でzlib圧縮レベル1相当になる
+PNG_QUALITY = 89
+TRANSPARENCY_FILL_COLOR = QColor(255, 255, 255)
+
+
+@dataclass(frozen=True)
+class LabelExport:
+    allow_labels: frozenset[int]
+    alpha: bool
+
+    @staticmethod
+    def of(allow_labels: list[int], alpha: bool) -> "LabelExport":
+        return LabelExport(frozenset(allow_labels), alpha)
+
+
+def encode_png(image: QImage) -> bytes:
+    with stage("png export"):
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.WriteOnly)
+        if not image.save(buffer, "PNG", PNG_QUALITY):
+            raise RuntimeError("failed to encode image as PNG")
+        buffer.close()
+        return bytes(data)
+
+
+def decode_image(data: bytes) -> QImage:
+    image = QImage()
+    if not image.loadFromData(data):
+        raise RuntimeError("failed to decode image")
+    return image
+
+
+# 画像全体をデコードせずにヘッダーからサイズだけ読む
+def image_size(data: bytes) -> QSize:
+    buffer = QBuffer()
+    buffer.setData(data)
+    buffer.open(QIODevice.ReadOnly)
+    return QImageReader(buffer).size()
+
+
+def flatten_alpha(image: QImage) -> QImage:
+    # exportImageの alpha=False, transparencyFillcolor=白 と同じく白背景に合成する
+    flattened = QImage(image.size(), QImage.Format_RGB888)
+    flattened.fill(TRANSPARENCY_FILL_COLOR)
+    painter = QPainter(flattened)
+    painter.drawImage(0, 0, image)
+    painter.end()
+    return flattened
+
+
+# 1回のcloneから複数のcolor label合成画像を書き出す
+# labelごとにレイヤーをまとめて表示/非表示するので、連続する出力で共通のlabelのレイヤーは再描画されない
+class LabelCompositeExporter:
+    def __init__(self, document: krita.Document):
+        with stage("document clone"):
+            self.document = document.clone()
+            self.document.setBatchmode(True)
+        # label -> [(node, 元のvisible)]
+        self.label_nodes: dict[int, list[tuple[krita.Node, bool]]] = {}
+        self.visible_labels: set[int] = set()
+
+        # cloneもunique idは同じだが、KritaのnodeByUniqueIDは呼ぶたびに木全体を辿るので、
+        # layer indexからidで引くよりもcloneを1回走査する方が安い
+        with stage("hide_layers"):
+            stack = [self.document.rootNode()]
+            while stack:
+                node = stack.pop()
+                if node.type() != "grouplayer":
+                    self.label_nodes.setdefault(node.colorLabel(), []).append((node, node.visible()))
+                    node.setVisible(False)
+                stack.extend(node.childNodes())
+
+    def show_labels(self, allow_labels: frozenset[int]):
+        with stage("hide_layers"):
+            for label in self.visible_labels - allow_labels:
+                for node, _ in self.label_nodes.get(label, []):
+                    node.setVisible(False)
+            for label in allow_labels - self.visible_labels:
+                for node, visible in self.label_nodes.get(label, []):
+                    node.setVisible(visible)
+            self.visible_labels = set(allow_labels)
+
+    def refresh(self):
+        with stage("projection refresh"):
+            self.document.refreshProjection()
+            self.document.waitForDone()
+
+    def export_image(self, alpha: bool) -> QImage:
+        with stage("projection read"):
+            image = self.document.projection(0, 0, self.document.width(), self.document.height())
+            if alpha:
+                return image.convertToFormat(QImage.Format_ARGB32)
+            return flatten_alpha(image)
+
+    def close(self):
+        self.document.close()
+
+
+def ordered_label_sets(targets: list[LabelExport]) -> list[frozenset[int]]:
+    # labelの多い順に並べると、次の出力へ移るときに隠すだけで済むことが多い
+    label_sets = {target.allow_labels for target in targets}
+    return sorted(label_sets, key=lambda labels: (-len(labels), sorted(labels)))
+
+
+def export_label_images(document: krita.Document, targets: list[LabelExport]) -> dict[LabelExport, QImage]:
+    exporter = LabelCompositeExporter(document)
+    images = {}
+    try:
+        for allow_labels in ordered_label_sets(targets):
+            exporter.show_labels(allow_labels)
+            exporter.refresh()
+            for target in targets:
+                if target.allow_labels == allow_labels and target not in images:
+                    images[target] = exporter.export_image(target.alpha)
+    finally:
+        exporter.close()
+    return images
+
+
+def export_label_buffers(document: krita.Document, targets: list[LabelExport]) -> dict[LabelExport, bytes]:
+    return {target: encode_png(image) for target, image in export_label_images(document, targets).items()}
+
+
+# ファイルパスで受け取る旧API
+def export_images_filtered_color_label(document: krita.Document, targets: list[tuple[LabelExport, str]]):
+    buffers = export_label_buffers(document, [target for target, _ in targets])
+    for target, output_path in targets:
+        with open(output_path, "wb") as f:
+            f.write(buffers[target])
@@ -0,0 +1,78 @@
+from dataclasses import dataclass
+
+import krita
+from PyQt5.QtCore import QUuid
+
+
+@dataclass
+class LayerEntry:
+    node: krita.Node
+    label: int
+    node_type: str
+    parent: QUuid | None
+    # labelのついたlayerの子 (transparency maskなど) の数
+    mask_count: int = 0
+    # このプラグインが付けたmaskの元になったbase layerとlayerのハッシュ (ユーザーが付けたmaskならNone)
+    mask_signature: bytes | None = None
+
+    @property
+    def has_masks(self) -> bool:
+        return self.mask_count > 0
+
+
+# color labelごとのlayerと、group構造、maskの有無を覚えておく
+# Kritaはlayerの追加/削除/label変更をPythonに通知しないので、変更が無いことも走査しないと分からない
+# そのため操作のたびにsyncで1回走査し (labelのついたlayerはmaskの数を見るためにchildNodesも呼ぶ)、差分を反映する
+# 1回のTransferの中ではこの走査を共有し、maskの元になった入力のハッシュはTransferをまたいで覚えておく
+# このプラグイン自身が付けたり焼き込んだりしたmaskは、set_masksで直接更新する
+class LayerIndex:
+    def __init__(self, document: krita.Document):
+        self.document = document
+        self.entries: dict[QUuid, LayerEntry] = {}
+        # label -> [unique id] (layerの並び順)
+        self.labels: dict[int, list[QUuid]] = {}
+
+    def sync(self) -> int:
+        changed = 0
+        seen = set()
+        labels: dict[int, list[QUuid]] = {}
+        stack: list[tuple[krita.Node, QUuid | None]] = [(self.document.rootNode(), None)]
+        while stack:
+            node, parent = stack.pop()
+            node_id = node.uniqueId()
+            label = node.colorLabel()
+            entry = self.entries.get(node_id)
+            if entry is None:
+                entry = LayerEntry(node, label, node.type(), parent)
+                self.entries[node_id] = entry
+                changed += 1
+            elif entry.label != label or entry.parent != parent:
+                entry.label = label
+                entry.parent = parent
+                changed += 1
+            seen.add(node_id)
+
+            if entry.node_type == "grouplayer":
+                stack.extend((child, node_id) for child in reversed(entry.node.childNodes()))
+            else:
+                labels.setdefault(label, []).append(node_id)
+                if label != 0:
+                    mask_count = len(entry.node.childNodes())
+                    if mask_count != entry.mask_count:
+                        entry.mask_count = mask_count
+                        entry.mask_signature = None
+
+        for node_id in self.entries.keys() - seen:
+            del self.entries[node_id]
+            changed += 1
+        self.labels = labels
+        return changed
+
+    def layers(self, allow_labels: list[int]) -> list[LayerEntry]:
+        return [self.entries[node_id] for label in allow_labels for node_id in self.labels.get(label, [])]
+
+    def set_masks(self, node_id: QUuid, mask_count: int, mask_signature: bytes | None = None):
+        entry = self.entries.get(node_id)
+        if entry is not None:
+            entry.mask_count = mask_count
+            entry.mask_signature = mask_signature
@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import struct
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable
+
+import krita
+from PyQt5.QtCore import QRect, Qt
+from PyQt5.QtGui import QImage
+
+from .instrumentation import stage
+
+DEFAULT_PREVIEW_INTERVAL_MSEC = 250
+
+# ComfyUIがwebsocketのbinary frameで送ってくるpreview: [event type][image type][画像] (先頭2つはbig endianのuint32)
+PREVIEW_EVENT_TYPE = 1
+PREVIEW_IMAGE_TYPES = {1: "JPEG", 2: "PNG"}
+
+
+@dataclass
+class PreviewSettings:
+    enabled: bool = False
+    # 秒
+    interval: float = DEFAULT_PREVIEW_INTERVAL_MSEC / 1000
+
+
+def parse_preview_frame(payload: bytes) -> bytes | None:
+    if len(payload) < 8:
+        return None
+    event_type, image_type = struct.unpack(">II", payload[:8])
+    if event_type != PREVIEW_EVENT_TYPE or image_type not in PREVIEW_IMAGE_TYPES:
+        return None
+    return payload[8:]
+
+
+# previewを書き込めるのは、RGBA U8のpaint layerだけ (QImage.Format_ARGB32のメモリ上の並びがKritaと同じB, G, R, A)
+def supports_pixel_writes(document: krita.Document, node: krita.Node | None) -> bool:
+    return (node is not None and node.type() == "paintlayer" and
+            document.colorModel() == "RGBA" and document.colorDepth() == "U8")
+
+
+# system layerはユーザーが描き込まないようにロックしてあり、ロックされたnodeにはsetPixelDataが書き込めない
+# 書き込むあいだだけロックを外す
+def write_layer_image(node: krita.Node, image: QImage, x: int, y: int):
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    locked = node.locked()
+    if locked:
+        node.setLocked(False)
+    try:
+        node.setPixelData(bits.asstring(), x, y, image.width(), image.height())
+    finally:
+        if locked:
+            node.setLocked(True)
+
+
+current_preview: contextvars.ContextVar["PreviewStream | None"] = contextvars.ContextVar("current_preview",
+                                                                                        default=None)
+# 今の呼び出しの出力がキャンバスのどこに当たるか (タイルや変更範囲だけを生成しているとき)
+preview_region: contextvars.ContextVar[QRect | None] = contextvars.ContextVar("preview_region", default=None)
+
+
+@contextmanager
+def preview_area(rect: QRect):
+    parent = preview_region.get()
+    token = preview_region.set(rect.translated(parent.topLeft()) if parent is not None else rect)
+    try:
+        yield
+    finally:
+        preview_region.reset(token)
+
+
+# controllerに渡すcallback (ComfyUIのbinary frameをそのまま受け取る)
+# previewを流していないときはNoneを返す
+def preview_callback() -> Callable[[bytes], None] | None:
+    stream = current_preview.get()
+    if stream is None:
+        return None
+    region = preview_region.get()
+    return lambda payload: stream.push(payload, region)
+
+
+# 生成中のpreviewを、system layerの画素に直接書き込む
+# previewは届くたびに最新のものだけを覚えておき、intervalごとにまとめて書き込む
+class PreviewStream:
+    def __init__(self, document: krita.Document, node: krita.Node, interval: float):
+        self.document = document
+        self.node = node
+        self.interval = interval
+        self.canvas = QRect(0, 0, document.width(), document.height())
+        self.pending: dict[tuple[int, int, int, int], tuple[QRect, bytes]] = {}
+        self.last_flush = 0.0
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.closed = False
+        self.frames = 0
+
+    def push(self, payload: bytes, region: QRect | None):
+        data = parse_preview_frame(payload)
+        if data is None or self.closed:
+            return
+        rect = self.canvas if region is None else region.intersected(self.canvas)
+        self.pending[rect.getRect()] = (rect, data)
+
+        delay = self.last_flush + self.interval - time.monotonic()
+        if delay <= 0:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(delay, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        if self.closed or not self.pending:
+            return
+        self.last_flush = time.monotonic()
+        pending = list(self.pending.values())
+        self.pending.clear()
+
+        with stage("preview write"):
+            for rect, data in pending:
+                preview = QImage()
+                if not preview.loadFromData(data) or rect.isEmpty():
+                    continue
+                preview = preview.scaled(rect.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+                write_layer_image(self.node, preview, rect.left(), rect.top())
+            self.document.refreshProjection()
+        self.frames += 1
+
+    def close(self):
+        self.closed = True
+        self.pending.clear()
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+    @contextmanager
+    def activate(self):
+        token = current_preview.set(self)
+        try:
+            yield self
+        finally:
+            current_preview.reset(token)
+            self.close()
@@ -0,0 +1,32 @@
+import json
+
+from .http_client import CONNECTION_ERRORS, HttpConnectionPool
+
+
+# サーバーは他の人と共有していることがあるので、自分のpromptだけを止める
+# キューで待っているものはキューから消し、実行中のときだけinterruptする
+async def cancel_prompts(http: HttpConnectionPool, prompt_ids: list[str]):
+    if not prompt_ids:
+        return
+    try:
+        status, body = await http.request("GET", "/queue")
+        if status != 200:
+            return
+        queue = json.loads(body)
+        running = {entry[1] for entry in queue.get("queue_running", [])} & set(prompt_ids)
+        pending = {entry[1] for entry in queue.get("queue_pending", [])} & set(prompt_ids)
+        if pending:
+            await http.request("POST", "/queue", json.dumps({"delete": sorted(pending)}).encode())
+        for prompt_id in sorted(running):
+            # prompt_idを受け取るサーバーは、そのpromptが実行中のときだけ止める
+            await http.request("POST", "/interrupt", json.dumps({"prompt_id": prompt_id}).encode())
+    except CONNECTION_ERRORS + (ValueError, LookupError):
+        pass
+
+
+# どれが自分のpromptか分からないときは、実行中のpromptをinterruptする
+async def interrupt_running(http: HttpConnectionPool):
+    try:
+        await http.request("POST", "/interrupt", b"{}")
+    except CONNECTION_ERRORS:
+        pass
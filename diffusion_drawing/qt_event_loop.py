@@ -0,0 +1,139 @@
+import asyncio
+import math
+import selectors
+
+from PyQt5.QtCore import QObject, QSocketNotifier, QTimer, Qt
+
+# QtEventLoopが使えなかったときに、一定間隔でasyncioを回す間隔
+POLLING_INTERVAL_MSEC = 10
+
+
+# selectorに登録されたfdをQSocketNotifierでも監視し、読み書きできるようになったらevent loopを1回進める
+class QtSelector(selectors.DefaultSelector):
+    def __init__(self, on_ready):
+        super().__init__()
+        self.on_ready = on_ready
+        self.notifiers: dict[int, list[QSocketNotifier]] = {}
+
+    def register(self, fileobj, events, data=None):
+        key = super().register(fileobj, events, data)
+        self.add_notifiers(key.fd, events)
+        return key
+
+    def unregister(self, fileobj):
+        key = super().unregister(fileobj)
+        self.remove_notifiers(key.fd)
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        key = super().modify(fileobj, events, data)
+        self.remove_notifiers(key.fd)
+        self.add_notifiers(key.fd, events)
+        return key
+
+    def close(self):
+        for fd in list(self.notifiers):
+            self.remove_notifiers(fd)
+        super().close()
+
+    def add_notifiers(self, fd: int, events: int):
+        notifiers = []
+        if events & selectors.EVENT_READ:
+            notifiers.append(QSocketNotifier(fd, QSocketNotifier.Read))
+        if events & selectors.EVENT_WRITE:
+            notifiers.append(QSocketNotifier(fd, QSocketNotifier.Write))
+        for notifier in notifiers:
+            notifier.activated.connect(self.on_ready)
+        self.notifiers[fd] = notifiers
+
+    def remove_notifiers(self, fd: int):
+        for notifier in self.notifiers.pop(fd, []):
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+
+
+# Qtのevent loopからasyncioを駆動する
+# 実行できるcallbackがあるとき、fdが読み書きできるようになったとき、次のtimerの時刻になったときだけ起きるので、
+# 何もしていないときはCPUを使わない
+class QtEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.stepping = False
+        self.step_timer = QTimer()
+        self.step_timer.setSingleShot(True)
+        self.step_timer.setTimerType(Qt.PreciseTimer)
+        self.step_timer.timeout.connect(self.step)
+        super().__init__(QtSelector(self.wake))
+
+    def call_soon(self, callback, *args, context=None):
+        handle = super().call_soon(callback, *args, context=context)
+        self.schedule_step()
+        return handle
+
+    def call_at(self, when, callback, *args, context=None):
+        handle = super().call_at(when, callback, *args, context=context)
+        self.schedule_step()
+        return handle
+
+    def step(self):
+        if self.stepping or self.is_running() or self.is_closed():
+            return
+
+        self.stepping = True
+        try:
+            # readyにstopがあるので、selectは待たずにfdを確認して、実行できるcallbackを1巡だけ実行する
+            super().call_soon(self.stop)
+            self.run_forever()
+        finally:
+            self.stepping = False
+        self.schedule_step()
+
+    def wake(self, *_):
+        if not self.stepping and not self.is_closed():
+            self.step_timer.start(0)
+
+    def schedule_step(self):
+        # step中に追加されたcallbackやtimerは、step終了時にまとめて次の時刻を決める
+        if self.stepping or self.is_closed():
+            return
+
+        # asyncioには次に起きるべき時刻を得る公開APIが無いので、BaseEventLoopの_readyと_scheduledを見る
+        if self._ready:
+            delay = 0
+        elif self._scheduled:
+            delay = max(0, math.ceil((self._scheduled[0].when() - self.time()) * 1000))
+        else:
+            self.step_timer.stop()
+            return
+
+        if not self.step_timer.isActive() or self.step_timer.remainingTime() > delay:
+            self.step_timer.start(delay)
+
+    def close(self):
+        self.step_timer.stop()
+        super().close()
+
+
+# QtEventLoopが使えない環境向けに、以前と同じくtimerで定期的にasyncioを回す
+class PollingEventLoopDriver(QObject):
+    def __init__(self, event_loop: asyncio.AbstractEventLoop, parent: QObject | None = None):
+        super().__init__(parent)
+        self.event_loop = event_loop
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.step)
+        self.timer.start(POLLING_INTERVAL_MSEC)
+
+    def step(self):
+        self.event_loop.call_soon(self.event_loop.stop)
+        self.event_loop.run_forever()
+
+
+def install_event_loop(parent: QObject) -> tuple[asyncio.AbstractEventLoop, PollingEventLoopDriver | None]:
+    try:
+        event_loop = QtEventLoop()
+    except Exception:
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        return event_loop, PollingEventLoopDriver(event_loop, parent)
+
+    asyncio.set_event_loop(event_loop)
+    return event_loop, None
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from .buffered_controller import BufferedDiffusionController, read_file
+
+MEMORY_CACHE_BUDGET = 256 * 1024 * 1024
+DISK_CACHE_BUDGET = 2 * 1024 * 1024 * 1024
+CACHE_FILE_SUFFIX = ".result"
+
+
+def cache_key(operation: str, inputs: list[bytes], parameters: dict) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps({"operation": operation, "parameters": parameters}, sort_keys=True).encode())
+    for data in inputs:
+        # 入力の区切りが変わっても同じハッシュにならないように長さも含める
+        h.update(struct.pack("<Q", len(data)))
+        h.update(data)
+    return h.hexdigest()
+
+
+def pack_outputs(outputs: tuple[bytes, ...]) -> bytes:
+    return b"".join(struct.pack("<Q", len(output)) + output for output in outputs)
+
+
+def unpack_outputs(data: bytes) -> tuple[bytes, ...]:
+    outputs = []
+    offset = 0
+    while offset < len(data):
+        (length,) = struct.unpack_from("<Q", data, offset)
+        offset += 8
+        outputs.append(data[offset:offset + length])
+        offset += length
+    return tuple(outputs)
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    def __str__(self):
+        return f"cache hits: {self.memory_hits + self.disk_hits} " \
+               f"(memory {self.memory_hits}, disk {self.disk_hits}), misses: {self.misses}"
+
+
+class MemoryCache:
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.entries: OrderedDict[str, tuple[bytes, ...]] = OrderedDict()
+
+    def get(self, key: str) -> tuple[bytes, ...] | None:
+        outputs = self.entries.get(key)
+        if outputs is not None:
+            self.entries.move_to_end(key)
+        return outputs
+
+    def put(self, key: str, outputs: tuple[bytes, ...]):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = outputs
+        self.size += sum(map(len, outputs))
+        while self.size > self.budget and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= sum(map(len, evicted))
+
+
+class DiskCache:
+    def __init__(self, directory: str, budget: int):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self.scan())
+
+    def scan(self) -> list[os.DirEntry]:
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith(CACHE_FILE_SUFFIX)]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + CACHE_FILE_SUFFIX)
+
+    def get(self, key: str) -> tuple[bytes, ...] | None:
+        path = self.path(key)
+        try:
+            data = read_file(path)
+        except FileNotFoundError:
+            return None
+        # 最終利用時刻としてmtimeを更新しておく
+        os.utime(path)
+        return unpack_outputs(data)
+
+    def put(self, key: str, outputs: tuple[bytes, ...]):
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        data = pack_outputs(outputs)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.size += len(data)
+        if self.size > self.budget:
+            self.evict()
+
+    def evict(self):
+        # 最後に使われたのが古いものから消す
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in self.scan())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+class ResultCache:
+    def __init__(self, directory: str, memory_budget: int = MEMORY_CACHE_BUDGET, disk_budget: int = DISK_CACHE_BUDGET):
+        self.memory = MemoryCache(memory_budget)
+        self.disk = DiskCache(directory, disk_budget)
+        self.stats = CacheStats()
+
+    def get(self, key: str) -> tuple[bytes, ...] | None:
+        outputs = self.memory.get(key)
+        if outputs is not None:
+            self.stats.memory_hits += 1
+            return outputs
+
+        outputs = self.disk.get(key)
+        if outputs is not None:
+            self.stats.disk_hits += 1
+            self.memory.put(key, outputs)
+            return outputs
+
+        self.stats.misses += 1
+        return None
+
+    def put(self, key: str, outputs: tuple[bytes, ...]):
+        self.memory.put(key, outputs)
+        self.disk.put(key, outputs)
+
+
+# 入力画像が同じならバックエンドに問い合わせずに前回の結果を返す
+class CachedDiffusionController:
+    def __init__(self, controller: BufferedDiffusionController, cache: ResultCache):
+        self.controller = controller
+        self.cache = cache
+
+    async def scribble_to_line(self, scribble: bytes, lineart: bytes, parameters: dict | None = None) -> bytes:
+        key = cache_key("scribble_to_line", [scribble, lineart], parameters or {})
+        outputs = self.cache.get(key)
+        if outputs is None:
+            outputs = (await self.controller.scribble_to_line(scribble, lineart, parameters),)
+            self.cache.put(key, outputs)
+        return outputs[0]
+
+    async def detail_colored(self, image: bytes, basecolor_image: bytes, lineart: bytes, basecolor: bytes,
+                             shadow: bytes, light: bytes, parameters: dict | None = None) -> tuple[bytes, bytes]:
+        inputs = [image, basecolor_image, lineart, basecolor, shadow, light]
+        key = cache_key("detail_colored", inputs, parameters or {})
+        outputs = self.cache.get(key)
+        if outputs is None:
+            outputs = await self.controller.detail_colored(*inputs, parameters)
+            self.cache.put(key, outputs)
+        return outputs[0], outputs[1]
+
+    # seedごとの結果を (shadow, light, shadow, light, ...) と並べて1件として保存する
+    async def detail_colored_variants(self, image: bytes, basecolor_image: bytes, lineart: bytes, basecolor: bytes,
+                                      shadow: bytes, light: bytes, seeds: list[int],
+                                      parameters: dict | None = None) -> list[tuple[bytes, bytes]]:
+        inputs = [image, basecolor_image, lineart, basecolor, shadow, light]
+        key = cache_key("detail_colored_variants", inputs, {**(parameters or {}), "seeds": seeds})
+        outputs = self.cache.get(key)
+        if outputs is None:
+            variants = await self.controller.detail_colored_variants(*inputs, seeds, parameters)
+            outputs = tuple(output for variant in variants for output in variant)
+            self.cache.put(key, outputs)
+        return [(outputs[i], outputs[i + 1]) for i in range(0, len(outputs), 2)]
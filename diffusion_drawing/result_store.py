@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import krita
+
+from .dirty_region import LabelSnapshot
+
+RESULT_STORE_DIR_NAME = "diffusion_drawing_documents"
+RESULT_STORE_BUDGET = 1024 * 1024 * 1024
+SNAPSHOTS_FILE_NAME = "snapshots.json"
+# 保存されていないドキュメントは開きなおせないので、プロセスが終わるときに消す
+UNSAVED_IDENTITY_PREFIX = "unsaved-"
+
+
+# KritaのrootNode().uniqueId()は起動しなおすと変わることがあるので、保存先のパスで見分ける
+def document_identity(document: krita.Document) -> str:
+    file_name = document.fileName()
+    if not file_name:
+        return UNSAVED_IDENTITY_PREFIX + document.rootNode().uniqueId().toString().strip("{}")
+    return hashlib.blake2b(os.path.abspath(file_name).encode(), digest_size=16).hexdigest()
+
+
+def is_unsaved(identity: str) -> bool:
+    return identity.startswith(UNSAVED_IDENTITY_PREFIX)
+
+
+def directory_size(path: str) -> int:
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+
+# ドキュメントごとに最後の生成結果 (lineart, shadow, light) と、それを生成したときの入力のハッシュを保存する
+# ディレクトリのmtimeを最終利用時刻として、合計が budget を超えたら古いものから消す
+class ResultStore:
+    def __init__(self, directory: str, budget: int = RESULT_STORE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, identity: str) -> str:
+        return os.path.join(self.directory, identity)
+
+    def contains(self, identity: str) -> bool:
+        return os.path.isdir(self.path(identity))
+
+    # 足りない出力ファイルだけをinitial_fileで埋めて、ディレクトリを返す
+    def open(self, identity: str, file_names: list[str], initial_file: str) -> str:
+        path = self.path(identity)
+        os.makedirs(path, exist_ok=True)
+        for file_name in file_names:
+            if not os.path.exists(os.path.join(path, file_name)):
+                shutil.copy(initial_file, os.path.join(path, file_name))
+        self.touch(identity)
+        return path
+
+    def touch(self, identity: str):
+        try:
+            os.utime(self.path(identity))
+        except FileNotFoundError:
+            pass
+
+    def save_snapshots(self, identity: str, snapshots: dict[str, LabelSnapshot]):
+        data = json.dumps({name: snapshot.to_dict() for name, snapshot in snapshots.items()})
+        fd, tmp_path = tempfile.mkstemp(dir=self.path(identity))
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.path(identity), SNAPSHOTS_FILE_NAME))
+        self.touch(identity)
+
+    def load_snapshots(self, identity: str) -> dict[str, LabelSnapshot]:
+        try:
+            with open(os.path.join(self.path(identity), SNAPSHOTS_FILE_NAME)) as f:
+                data = json.load(f)
+            return {name: LabelSnapshot.from_dict(snapshot) for name, snapshot in data.items()}
+        except (OSError, ValueError, KeyError):
+            # 読めなければ全体を生成しなおすだけなので、無かったことにする
+            return {}
+
+    # 保存されていなかったドキュメントが保存されたときなどに、結果を新しいidentityへ移す
+    def rename(self, identity: str, new_identity: str) -> str:
+        self.remove(new_identity)
+        os.replace(self.path(identity), self.path(new_identity))
+        return self.path(new_identity)
+
+    def remove(self, identity: str):
+        shutil.rmtree(self.path(identity), ignore_errors=True)
+
+    # 開いているドキュメントの分 (keep) は消さない
+    def evict(self, keep: set[str]):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                entries.append((entry.stat().st_mtime, directory_size(entry.path), entry.name))
+        entries.sort()
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, identity in entries:
+            if size <= self.budget:
+                break
+            if identity in keep:
+                continue
+            self.remove(identity)
+            size -= entry_size
@@ -0,0 +1,136 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from PyQt5.QtCore import QRect, QSize
+from PyQt5.QtGui import QBrush, QColor, QImage, QLinearGradient, QPainter
+
+from .buffered_controller import BufferedDiffusionController
+from .label_export import decode_image, encode_png, image_size
+from .preview_stream import preview_area
+from .result_cache import CachedDiffusionController
+
+DEFAULT_TILE_SIZE = 1024
+DEFAULT_TILE_OVERLAP = 128
+
+
+@dataclass
+class TileSettings:
+    enabled: bool = False
+    tile_size: int = DEFAULT_TILE_SIZE
+    overlap: int = DEFAULT_TILE_OVERLAP
+
+
+def tile_positions(length: int, tile_size: int, overlap: int) -> list[int]:
+    if length <= tile_size:
+        return [0]
+    step = max(tile_size - overlap, 1)
+    positions = list(range(0, length - tile_size, step))
+    # 最後のタイルは端にそろえる
+    positions.append(length - tile_size)
+    return positions
+
+
+@dataclass
+class Tile:
+    rect: QRect
+    # 左隣、上隣のタイルと重なっている幅
+    left_overlap: int
+    top_overlap: int
+
+
+def split_tiles(size: QSize, settings: TileSettings) -> list[Tile]:
+    tile_width = min(settings.tile_size, size.width())
+    tile_height = min(settings.tile_size, size.height())
+    xs = tile_positions(size.width(), tile_width, settings.overlap)
+    ys = tile_positions(size.height(), tile_height, settings.overlap)
+
+    tiles = []
+    for j, y in enumerate(ys):
+        for i, x in enumerate(xs):
+            left_overlap = xs[i - 1] + tile_width - x if i > 0 else 0
+            top_overlap = ys[j - 1] + tile_height - y if j > 0 else 0
+            tiles.append(Tile(QRect(x, y, tile_width, tile_height), left_overlap, top_overlap))
+    return tiles
+
+
+# 先に描いたタイルと重なる部分のalphaを0から1へ徐々に上げて、継ぎ目が目立たないようにする
+def feather(image: QImage, tile: Tile) -> QImage:
+    image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    painter.setCompositionMode(QPainter.CompositionMode_DestinationIn)
+    if tile.left_overlap > 0:
+        gradient = QLinearGradient(0, 0, tile.left_overlap, 0)
+        gradient.setColorAt(0, QColor(0, 0, 0, 0))
+        gradient.setColorAt(1, QColor(0, 0, 0, 255))
+        painter.fillRect(QRect(0, 0, tile.left_overlap, image.height()), QBrush(gradient))
+    if tile.top_overlap > 0:
+        gradient = QLinearGradient(0, 0, 0, tile.top_overlap)
+        gradient.setColorAt(0, QColor(0, 0, 0, 0))
+        gradient.setColorAt(1, QColor(0, 0, 0, 255))
+        painter.fillRect(QRect(0, 0, image.width(), tile.top_overlap), QBrush(gradient))
+    painter.end()
+    return image
+
+
+def stitch(size: QSize, tiles: list[Tile], images: list[QImage]) -> QImage:
+    output = QImage(size, QImage.Format_ARGB32_Premultiplied)
+    output.fill(QColor(0, 0, 0, 0))
+    painter = QPainter(output)
+    for tile, image in zip(tiles, images):
+        if image.size() != tile.rect.size():
+            image = image.scaled(tile.rect.size())
+        painter.drawImage(tile.rect.topLeft(), feather(image, tile))
+    painter.end()
+    return output.convertToFormat(QImage.Format_ARGB32)
+
+
+# モデルの解像度より大きいキャンバスを重なりのあるタイルに分けて並行して生成し、結果をつなぎ合わせる
+class TiledDiffusionController:
+    def __init__(self, controller: CachedDiffusionController | BufferedDiffusionController, settings: TileSettings):
+        self.controller = controller
+        self.settings = settings
+
+    async def run(self, inputs: list[bytes],
+                  generate: Callable[[list[bytes]], Awaitable[tuple[bytes, ...]]]) -> tuple[bytes, ...]:
+        size = image_size(inputs[0])
+        if not self.settings.enabled or (size.width() <= self.settings.tile_size and
+                                         size.height() <= self.settings.tile_size):
+            return await generate(inputs)
+
+        images = [decode_image(data) for data in inputs]
+        tiles = split_tiles(size, self.settings)
+        async def generate_tile(tile: Tile) -> tuple[bytes, ...]:
+            with preview_area(tile.rect):
+                return await generate([encode_png(image.copy(tile.rect)) for image in images])
+
+        outputs = await asyncio.gather(*[generate_tile(tile) for tile in tiles])
+        return tuple(encode_png(stitch(size, tiles, [decode_image(output[i]) for output in outputs]))
+                     for i in range(len(outputs[0])))
+
+    async def scribble_to_line(self, scribble: bytes, lineart: bytes, parameters: dict | None = None) -> bytes:
+        async def generate(buffers: list[bytes]) -> tuple[bytes]:
+            return (await self.controller.scribble_to_line(*buffers, parameters=parameters),)
+
+        (output,) = await self.run([scribble, lineart], generate)
+        return output
+
+    async def detail_colored(self, image: bytes, basecolor_image: bytes, lineart: bytes, basecolor: bytes,
+                             shadow: bytes, light: bytes, parameters: dict | None = None) -> tuple[bytes, bytes]:
+        async def generate(buffers: list[bytes]) -> tuple[bytes, bytes]:
+            return await self.controller.detail_colored(*buffers, parameters=parameters)
+
+        shadow_output, light_output = await self.run([image, basecolor_image, lineart, basecolor, shadow, light],
+                                                     generate)
+        return shadow_output, light_output
+
+    # タイルごとに同じseedの組で生成し、seedごとにつなぎ合わせる
+    async def detail_colored_variants(self, image: bytes, basecolor_image: bytes, lineart: bytes, basecolor: bytes,
+                                      shadow: bytes, light: bytes, seeds: list[int],
+                                      parameters: dict | None = None) -> list[tuple[bytes, bytes]]:
+        async def generate(buffers: list[bytes]) -> tuple[bytes, ...]:
+            variants = await self.controller.detail_colored_variants(*buffers, seeds, parameters=parameters)
+            return tuple(output for variant in variants for output in variant)
+
+        outputs = await self.run([image, basecolor_image, lineart, basecolor, shadow, light], generate)
+        return [(outputs[i], outputs[i + 1]) for i in range(0, len(outputs), 2)]
@@ -0,0 +1,49 @@
+import random
+from dataclasses import dataclass, field
+
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+from .dirty_region import LabelSnapshot
+from .instrumentation import stage
+from .label_export import decode_image
+
+DEFAULT_VARIANT_COUNT = 4
+MAX_VARIANT_COUNT = 16
+SEED_RANGE = 2 ** 32
+THUMBNAIL_SIZE = QSize(96, 96)
+
+
+@dataclass
+class Variant:
+    seed: int
+    shadow: bytes
+    light: bytes
+
+
+# 同じ入力から生成したseed違いの結果
+# 選ばれたものを出力ファイルに書くときに、そのときの入力をdirty regionの基準として記録する
+@dataclass
+class VariantSet:
+    snapshot: LabelSnapshot
+    variants: list[Variant] = field(default_factory=list)
+
+
+def new_seeds(count: int) -> list[int]:
+    return [random.randrange(SEED_RANGE) for _ in range(count)]
+
+
+# system layerと同じく、白地にshadowを乗算、lightを加算で重ねた縮小画像
+def variant_thumbnail(variant: Variant, size: QSize = THUMBNAIL_SIZE) -> QImage:
+    with stage("variant thumbnail"):
+        shadow = decode_image(variant.shadow).scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        light = decode_image(variant.light).scaled(shadow.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        thumbnail = QImage(shadow.size(), QImage.Format_ARGB32)
+        thumbnail.fill(QColor(255, 255, 255))
+        painter = QPainter(thumbnail)
+        painter.setCompositionMode(QPainter.CompositionMode_Multiply)
+        painter.drawImage(0, 0, shadow)
+        painter.setCompositionMode(QPainter.CompositionMode_Plus)
+        painter.drawImage(0, 0, light)
+        painter.end()
+        return thumbnail
@@ -0,0 +1,120 @@
+from PyQt5.QtCore import QRect, Qt
+from PyQt5.QtGui import QImage
+
+from .instrumentation import stage
+from .label_export import LabelExport, decode_image, encode_png
+
+# バックエンドに送る入力画像の形式
+# controllerが input_formats で受け取れると申告したものだけを使い、申告がなければ今まで通りRGBAのPNGで送る
+# gray8: 白背景に合成した入力が無彩色なら、1チャンネル8bitのPNGにする
+GRAY8 = "gray8"
+# alpha8: alphaだけを使う入力 (線画やshadow/lightのmask) は、alphaだけを1チャンネル8bitのPNGにする
+ALPHA8 = "alpha8"
+# alpha1: alpha8のうちalphaが0か255だけのものは、1bitに詰めたPNGにする
+ALPHA1 = "alpha1"
+# crop: maskは空でない範囲だけを送り、元の画像の中での位置を placements で添える
+CROP = "crop"
+WIRE_FORMATS = frozenset({GRAY8, ALPHA8, ALPHA1, CROP})
+
+# 入力ごとの使われ方
+# image: 色を使う画像
+IMAGE = "image"
+# color mask: alphaで範囲を表し、色も使う (basecolor)。cropはできるが、RGBAのまま送る
+COLOR_MASK = "color mask"
+# alpha mask: alphaだけを使う (線画やshadow/lightのmask)。alpha8/alpha1とcropの対象
+ALPHA_MASK = "alpha mask"
+SCRIBBLE_TO_LINE_ROLES = (IMAGE, ALPHA_MASK)
+DETAIL_COLORED_ROLES = (IMAGE, IMAGE, ALPHA_MASK, COLOR_MASK, ALPHA_MASK, ALPHA_MASK)
+
+# 空でない範囲がこれより広ければ、切り出してもほとんど減らないのでそのまま送る
+CROP_MAX_RATIO = 0.75
+
+# 切り出した画像の (x, y, 元の幅, 元の高さ)
+Placement = tuple[int, int, int, int]
+
+
+def negotiated_formats(controller) -> frozenset[str]:
+    return frozenset(getattr(controller, "input_formats", ())) & WIRE_FORMATS
+
+
+def image_bytes(image: QImage) -> bytes:
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    return bits.asstring()
+
+
+# alphaの値をそのまま明るさとして持つ1チャンネルの画像
+def alpha_channel(image: QImage) -> QImage:
+    alpha = image.convertToFormat(QImage.Format_Alpha8)
+    alpha.reinterpretAsFormat(QImage.Format_Grayscale8)
+    return alpha
+
+
+def is_binary(image: QImage) -> bool:
+    data = image_bytes(image)
+    bytes_per_line = image.bytesPerLine()
+    # 行末の詰め物は見ない
+    return all(not data[y * bytes_per_line:y * bytes_per_line + image.width()].translate(None, b"\x00\xff")
+               for y in range(image.height()))
+
+
+def encode_input(image: QImage, target: LabelExport, role: str, formats: frozenset[str]) -> bytes:
+    with stage("input format"):
+        if role == ALPHA_MASK and ALPHA8 in formats:
+            image = alpha_channel(image)
+            if ALPHA1 in formats and is_binary(image):
+                image = image.convertToFormat(QImage.Format_Mono, Qt.ThresholdDither)
+        elif not target.alpha and GRAY8 in formats and image.allGray():
+            image = image.convertToFormat(QImage.Format_Grayscale8)
+    return encode_png(image)
+
+
+# rolesは inputs の順に、それぞれの入力の使われ方
+def encode_inputs(images: dict[LabelExport, QImage], inputs: list[LabelExport], roles: tuple[str, ...],
+                  formats: frozenset[str], rect: QRect | None = None) -> list[bytes]:
+    return [encode_input(images[target] if rect is None else images[target].copy(rect), target, role, formats)
+            for target, role in zip(inputs, roles)]
+
+
+# alphaが0でない画素を含む最小の矩形 (全部空なら空のQRect)
+def content_rect(mask: QImage) -> QRect:
+    data = image_bytes(mask)
+    bytes_per_line = mask.bytesPerLine()
+    width = mask.width()
+    left, right, top, bottom = width, 0, None, 0
+    for y in range(mask.height()):
+        row = data[y * bytes_per_line:y * bytes_per_line + width]
+        trimmed = row.lstrip(b"\x00")
+        if not trimmed:
+            continue
+        if top is None:
+            top = y
+        bottom = y
+        left = min(left, width - len(trimmed))
+        right = max(right, len(row.rstrip(b"\x00")))
+    if top is None:
+        return QRect()
+    return QRect(left, top, right - left, bottom - top + 1)
+
+
+# maskの空でない範囲だけを元と同じ形式で切り出す
+def crop_mask(data: bytes) -> tuple[bytes, Placement | None]:
+    image = decode_image(data)
+    if image.hasAlphaChannel():
+        mask = alpha_channel(image)
+    else:
+        mask = image.convertToFormat(QImage.Format_Grayscale8)
+    rect = content_rect(mask)
+    if rect.isEmpty():
+        # 何も描かれていなければ1画素だけ送る
+        rect = QRect(0, 0, 1, 1)
+    elif rect.width() * rect.height() > image.width() * image.height() * CROP_MAX_RATIO:
+        return data, None
+    return encode_png(image.copy(rect)), (rect.x(), rect.y(), image.width(), image.height())
+
+
+# maskとして使う入力 (color mask, alpha mask) だけを切り出す
+def crop_masks(inputs: list[bytes], roles: tuple[str, ...]) -> tuple[list[bytes], list[Placement | None]]:
+    with stage("input crop"):
+        cropped = [crop_mask(data) if role != IMAGE else (data, None) for data, role in zip(inputs, roles)]
+    return [data for data, _ in cropped], [placement for _, placement in cropped]